@@ -0,0 +1,112 @@
+"""
+Benchmark finding users by e-mail, regardless of case, with and without the
+indexes on the lower case of the e-mails (migration 7a90203961bd).
+
+A synthetic users table is filled, the lookups are timed with the indexes
+dropped, and then again once they are created. The database is SQLite by
+default; pass a database URL to measure against PostgreSQL instead (the
+users table there is emptied first). Run from the project root:
+
+    python -m benchmarks.email_lookup [number of users] [database URL]
+"""
+import os
+import sys
+import time
+import tempfile
+PROJECT_HOME = os.path.abspath(
+    os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(PROJECT_HOME)
+
+from harbour.app import create_app
+from harbour.models import db, Users, select_users_by_email
+
+NUMBER_OF_LOOKUPS = 20
+BATCH_SIZE = 10000
+
+
+def fill(number_of_users):
+    """
+    Insert the synthetic users, in batches
+    """
+    table = Users.__table__
+    for start in xrange(0, number_of_users, BATCH_SIZE):
+        db.session.execute(table.insert(), [
+            {
+                'absolute_uid': uid,
+                'classic_email': 'User{0}@ADS.com'.format(uid),
+                'classic_mirror': 'adsabs.harvard.edu',
+                'classic_cookie': '{0:032x}'.format(uid),
+                'twopointoh_email': 'user{0}@ads.com'.format(uid)
+            }
+            for uid in xrange(start, min(start + BATCH_SIZE, number_of_users))
+        ])
+    db.session.commit()
+
+
+def time_lookups(number_of_users):
+    """
+    Seconds taken by each lookup, on average
+    """
+    step = number_of_users // NUMBER_OF_LOOKUPS
+    start = time.time()
+    for uid in xrange(0, step * NUMBER_OF_LOOKUPS, step):
+        users = select_users_by_email('user{0}@ads.com'.format(uid))
+        assert [user.absolute_uid for user in users] == [uid]
+        db.session.remove()
+    return (time.time() - start) / NUMBER_OF_LOOKUPS
+
+
+def main(number_of_users=1000000, database=None):
+    """
+    Time the lookups without and with the indexes, and print the results
+    """
+    path = None
+    if database is None:
+        handle, path = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+        database = 'sqlite:///' + path
+
+    app = create_app()
+    app.config['SQLALCHEMY_BINDS'] = {'harbour': database}
+    indexes = [
+        index for index in Users.__table__.indexes
+        if index.name.startswith('ix_users_lower_')
+    ]
+
+    try:
+        with app.app_context():
+            engine = db.get_engine(app, bind='harbour')
+            db.create_all(bind='harbour')
+            Users.query.delete()
+            db.session.commit()
+            for index in indexes:
+                index.drop(bind=engine)
+
+            start = time.time()
+            fill(number_of_users)
+            print('users: {0} rows in {1:.1f}s'.format(
+                number_of_users, time.time() - start
+            ))
+
+            without = time_lookups(number_of_users)
+            print('without indexes: {0:.2f} ms/lookup'.format(without * 1e3))
+
+            start = time.time()
+            for index in indexes:
+                index.create(bind=engine)
+            print('indexes built in {0:.1f}s'.format(time.time() - start))
+
+            with_ = time_lookups(number_of_users)
+            print('with indexes:    {0:.2f} ms/lookup ({1:.0f}x faster)'
+                  .format(with_ * 1e3, without / with_))
+
+            if path is None:
+                Users.query.delete()
+                db.session.commit()
+    finally:
+        if path is not None:
+            os.remove(path)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) if arg.isdigit() else arg for arg in sys.argv[1:]])
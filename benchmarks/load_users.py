@@ -0,0 +1,108 @@
+"""
+Benchmark the loading of the ADS 2.0 users.json mapping, comparing the previous
+approach (buffer the body, then json.loads) against the incremental parse.
+
+Each loader runs in a fresh child process so that its peak RSS can be measured
+in isolation. Run from the project root:
+
+    python -m benchmarks.load_users [number of users]
+"""
+import os
+import sys
+import json
+import time
+import resource
+import tempfile
+import multiprocessing
+PROJECT_HOME = os.path.abspath(
+    os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(PROJECT_HOME)
+
+from StringIO import StringIO
+from harbour.utils import iter_json_object
+
+CHUNK_SIZE = 64 * 1024
+
+
+def load_buffered(path):
+    """
+    The loader as it was: read everything into a StringIO then json.loads
+    """
+    with open(path, 'rb') as body:
+        user_data = StringIO()
+        for chunk in iter(lambda: body.read(1024), b''):
+            user_data.write(chunk)
+        return json.loads(user_data.getvalue())
+
+
+def load_streaming(path):
+    """
+    The incremental loader used by harbour.app.load_s3
+    """
+    with open(path, 'rb') as body:
+        return dict(iter_json_object(body, chunk_size=CHUNK_SIZE))
+
+
+def max_rss_kb():
+    """
+    Peak resident set size of the current process in KB (Linux units)
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def run(loader, path, queue):
+    """
+    Child process entry point: load the users and report timings and memory
+    """
+    baseline = max_rss_kb()
+    start = time.time()
+    users = loader(path)
+    elapsed = time.time() - start
+    queue.put((len(users), elapsed, max_rss_kb() - baseline))
+
+
+def write_users(path, number_of_users):
+    """
+    Write a synthetic users.json in the same shape as the MongoDB dump
+    """
+    with open(path, 'wb') as users_file:
+        users_file.write('{')
+        for i in xrange(number_of_users):
+            if i:
+                users_file.write(', ')
+            users_file.write(
+                '"user{0}@ads.com": "{0:08x}-cdba-406b-bfff-edfd428248be.json"'
+                .format(i)
+            )
+        users_file.write('}')
+
+
+def main(number_of_users=1000000):
+    """
+    Run each loader against the same synthetic file and print the results
+    """
+    handle, path = tempfile.mkstemp(suffix='.json')
+    os.close(handle)
+    try:
+        write_users(path, number_of_users)
+        print('users.json: {0} users, {1:.1f} MB'.format(
+            number_of_users, os.path.getsize(path) / 1024.0 ** 2
+        ))
+
+        for loader in [load_buffered, load_streaming]:
+            queue = multiprocessing.Queue()
+            process = multiprocessing.Process(
+                target=run,
+                args=(loader, path, queue)
+            )
+            process.start()
+            count, elapsed, peak_kb = queue.get()
+            process.join()
+            print('{0:<16} users={1} time={2:.2f}s peak_rss_delta={3:.1f} MB'
+                  .format(loader.__name__, count, elapsed, peak_kb / 1024.0))
+    finally:
+        os.remove(path)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,252 @@
+"""
+Benchmark the serving modes (see harbour/serving.py) on an upstream-bound end
+point: how many requests to /libraries/classic/<uid> a process keeps in flight
+while ADS Classic takes a while to answer, and how much memory that costs.
+
+A stub ADS Classic mirror answers every request after a fixed delay. Each
+serving mode runs the application in a fresh interpreter, against a SQLite
+database of stub users, with the libraries cache disabled so that every
+request goes to the mirror. The requests in flight are derived from the
+throughput and the delay (Little's law), and divided by the peak RSS of the
+process serving them. Run from the project root:
+
+    python -m benchmarks.serving [concurrency ...] [--delay seconds]
+
+gevent mode is skipped if gevent is not installed.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import threading
+import subprocess
+PROJECT_HOME = os.path.abspath(
+    os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(PROJECT_HOME)
+
+from SocketServer import ThreadingMixIn
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+STUB_LIBRARIES = json.dumps({
+    'libraries': [{
+        'name': 'Name',
+        'desc': 'Description',
+        'entries': [{'bibcode': '2015MNRAS.446.4239E'}] * 50
+    }]
+})
+
+
+class StubMirror(ThreadingMixIn, HTTPServer):
+    """
+    ADS Classic mirror that answers every request after a delay
+    """
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, delay):
+        self.delay = delay
+        HTTPServer.__init__(self, ('127.0.0.1', 0), StubMirrorHandler)
+
+
+class StubMirrorHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        time.sleep(self.server.delay)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(STUB_LIBRARIES)))
+        self.end_headers()
+        self.wfile.write(STUB_LIBRARIES)
+
+    def log_message(self, *args):
+        pass
+
+
+def serve(mode, mirror, number_of_users, database):
+    """
+    Child process entry point: serve the application in a serving mode, and
+    print the port it listens on
+    """
+    from harbour import serving
+    serving.patch(mode)
+
+    from werkzeug.serving import make_server
+    from harbour.app import create_app
+    from harbour.cache import LRUCache
+    from harbour.models import db, Users
+
+    app = create_app()
+    app.config['SQLALCHEMY_BINDS'] = {'harbour': 'sqlite:///' + database}
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    for key in ['ADS_CLASSIC_MAX_CONCURRENCY', 'ADS_CLASSIC_POOL_MAXSIZE']:
+        app.config[key] = number_of_users
+    app.extensions['classic_libraries_cache'] = LRUCache(0, 0)
+    # Nothing but the requests being measured goes upstream
+    app.extensions['background_tasks'].tasks[:] = []
+
+    with app.app_context():
+        db.create_all(bind='harbour')
+        for uid in xrange(1, number_of_users + 1):
+            db.session.add(Users(
+                absolute_uid=uid,
+                classic_email='user{0}@ads.com'.format(uid),
+                classic_cookie='cookie{0}'.format(uid),
+                classic_mirror=mirror
+            ))
+        db.session.commit()
+
+    if mode == serving.GEVENT:
+        from gevent.pool import Pool
+        from gevent.pywsgi import WSGIServer
+        server = WSGIServer(
+            ('127.0.0.1', 0), app, spawn=Pool(number_of_users), log=None
+        )
+        server.start()
+        port = server.server_port
+    else:
+        server = make_server('127.0.0.1', 0, app, threaded=True)
+        server.request_queue_size = 1024
+        port = server.server_port
+
+    print(port)
+    sys.stdout.flush()
+    server.serve_forever()
+
+
+def rss_kb(pid):
+    """
+    Resident set size of a process in KB (Linux)
+    """
+    with open('/proc/{0}/status'.format(pid)) as status:
+        for line in status:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+    return 0
+
+
+def load(port, concurrency, requests_per_client):
+    """
+    Make requests from concurrency clients at once, each for its own user
+
+    :return: requests made, failures, seconds taken
+    """
+    import requests
+
+    failures = [0]
+    lock = threading.Lock()
+
+    def client(uid):
+        url = 'http://127.0.0.1:{0}/libraries/classic/{1}'.format(port, uid)
+        for _ in xrange(requests_per_client):
+            try:
+                ok = requests.get(url, timeout=60).status_code == 200
+            except requests.exceptions.RequestException:
+                ok = False
+            if not ok:
+                with lock:
+                    failures[0] += 1
+
+    clients = [
+        threading.Thread(target=client, args=(uid,))
+        for uid in xrange(1, concurrency + 1)
+    ]
+    start = time.time()
+    for thread in clients:
+        thread.start()
+    for thread in clients:
+        thread.join()
+
+    return concurrency * requests_per_client, failures[0], time.time() - start
+
+
+def run(mode, mirror, concurrency, delay, requests_per_client):
+    """
+    Benchmark a serving mode at a level of concurrency, and print the results
+    """
+    handle, database = tempfile.mkstemp(suffix='.db')
+    os.close(handle)
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'benchmarks.serving', '--serve', mode,
+         '--mirror', mirror, '--users', str(concurrency),
+         '--database', database],
+        cwd=PROJECT_HOME,
+        stdout=subprocess.PIPE,
+        stderr=open(os.devnull, 'w')
+    )
+    try:
+        port = int(process.stdout.readline())
+        idle_kb = rss_kb(process.pid)
+
+        peak_kb = [idle_kb]
+        done = threading.Event()
+
+        def sample():
+            while not done.wait(0.02):
+                peak_kb[0] = max(peak_kb[0], rss_kb(process.pid))
+
+        sampler = threading.Thread(target=sample)
+        sampler.start()
+        try:
+            made, failures, elapsed = load(
+                port, concurrency, requests_per_client
+            )
+        finally:
+            done.set()
+            sampler.join()
+
+        in_flight = (made - failures) / elapsed * delay
+        print('{0:<9} clients={1:<5} req/s={2:<8.1f} failures={3:<4} '
+              'in_flight={4:<7.1f} rss={5:.1f}->{6:.1f} MB '
+              'in_flight_per_MB={7:.2f}'
+              .format(mode, concurrency, made / elapsed, failures, in_flight,
+                      idle_kb / 1024.0, peak_kb[0] / 1024.0,
+                      in_flight / (peak_kb[0] / 1024.0)))
+    finally:
+        process.kill()
+        process.wait()
+        os.remove(database)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('concurrency', type=int, nargs='*',
+                        default=[10, 100, 400])
+    parser.add_argument('--delay', type=float, default=0.5,
+                        help='seconds the stub mirror takes to answer')
+    parser.add_argument('--requests', type=int, default=3,
+                        help='requests made by each client')
+    parser.add_argument('--serve', help=argparse.SUPPRESS)
+    parser.add_argument('--mirror', help=argparse.SUPPRESS)
+    parser.add_argument('--users', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--database', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.serve, args.mirror, args.users, args.database)
+        return
+
+    modes = ['threaded']
+    try:
+        import gevent
+        modes.append('gevent')
+    except ImportError:
+        print('gevent is not installed, only the threaded mode is measured')
+
+    mirror = StubMirror(args.delay)
+    thread = threading.Thread(target=mirror.serve_forever)
+    thread.daemon = True
+    thread.start()
+    print('stub mirror delay={0}s'.format(args.delay))
+
+    try:
+        for concurrency in args.concurrency:
+            for mode in modes:
+                run(mode, '127.0.0.1:{0}'.format(mirror.server_port),
+                    concurrency, args.delay, args.requests)
+    finally:
+        mirror.shutdown()
+
+
+if __name__ == '__main__':
+    main()
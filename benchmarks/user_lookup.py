@@ -0,0 +1,106 @@
+"""
+Benchmark the lookup of a users row on the read end points, comparing the ORM
+query they used to make against the compiled Core SELECT of
+harbour.models.select_users.
+
+Each lookup is followed by the end of the session, as at the end of a
+request. The database is SQLite by default, so that the time measured is
+mostly that spent in Python rather than waiting on the database; pass a
+database URL to measure against PostgreSQL instead. Run from the project root:
+
+    python -m benchmarks.user_lookup [number of lookups] [database URL]
+"""
+import os
+import sys
+import time
+import tempfile
+PROJECT_HOME = os.path.abspath(
+    os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(PROJECT_HOME)
+
+from harbour.app import create_app
+from harbour.models import db, Users, select_users
+
+NUMBER_OF_USERS = 1000
+
+
+def orm_one(uid):
+    """
+    The lookup as it was: Users.query...one(), then the fields of the row
+    """
+    user = Users.query.filter(Users.absolute_uid == uid).one()
+    return user.record()
+
+
+def orm_in(uid):
+    """
+    The same through the ORM, as an IN query as used for many users
+    """
+    return [user.record() for user in
+            Users.query.filter(Users.absolute_uid.in_([uid]))][0]
+
+
+def core_compiled(uid):
+    """
+    The compiled Core SELECT used by the read end points
+    """
+    return select_users([uid])[0]
+
+
+def main(number_of_lookups=10000, database=None):
+    """
+    Time each lookup against the same users, and print the results
+    """
+    path = None
+    if database is None:
+        handle, path = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+        database = 'sqlite:///' + path
+
+    app = create_app()
+    app.config['SQLALCHEMY_BINDS'] = {'harbour': database}
+
+    try:
+        with app.app_context():
+            db.create_all(bind='harbour')
+            Users.query.delete()
+            for uid in xrange(NUMBER_OF_USERS):
+                db.session.add(Users(
+                    absolute_uid=uid,
+                    classic_email='user{0}@ads.com'.format(uid),
+                    classic_mirror='adsabs.harvard.edu',
+                    classic_cookie='{0:032x}'.format(uid)
+                ))
+            db.session.commit()
+
+            baseline = None
+            for lookup in [orm_one, orm_in, core_compiled]:
+                # Warm up: compile the statements, open the connections
+                for uid in xrange(10):
+                    lookup(uid)
+                    db.session.remove()
+
+                start_cpu, start = time.clock(), time.time()
+                for i in xrange(number_of_lookups):
+                    lookup(i % NUMBER_OF_USERS)
+                    db.session.remove()
+                cpu = (time.clock() - start_cpu) / number_of_lookups
+                wall = (time.time() - start) / number_of_lookups
+
+                baseline = baseline or cpu
+                print('{0:<14} cpu={1:.1f} us/lookup wall={2:.1f} us/lookup '
+                      'cpu_saved={3:.1f} us ({4:.0%})'
+                      .format(lookup.__name__, cpu * 1e6, wall * 1e6,
+                              (baseline - cpu) * 1e6,
+                              (baseline - cpu) / baseline))
+
+            if path is None:
+                Users.query.delete()
+                db.session.commit()
+    finally:
+        if path is not None:
+            os.remove(path)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) if arg.isdigit() else arg for arg in sys.argv[1:]])
@@ -3,8 +3,7 @@
 Application factory
 """
 
-import json
-import boto3
+import threading
 import logging.config
 
 from flask import Flask
@@ -12,12 +11,21 @@ from flask.ext.watchman import Watchman
 from flask.ext.restful import Api
 from flask.ext.discoverer import Discoverer
 from flask.ext.consulate import Consul, ConsulConnectionError
+from botocore.exceptions import ClientError
 from views import AuthenticateUserClassic, AuthenticateUserTwoPointOh, \
-    AllowedMirrors, ClassicLibraries, ClassicUser, TwoPointOhLibraries, \
-    ExportTwoPointOhLibraries
+    AllowedMirrors, ClassicLibraries, BulkClassicLibraries, ClassicUser, \
+    TwoPointOhLibraries, BulkTwoPointOhLibraries, ExportTwoPointOhLibraries, \
+    Readiness, Metrics
 
 from models import db
-from StringIO import StringIO
+from s3 import S3
+from classic import ClassicClient
+from cache import LRUCache, PresignedUrlCache, FileBackend
+from background import BackgroundTasks, WorkerPools
+from exports import ExportIndex
+from singleflight import SingleFlight
+from utils import iter_json_object, not_modified
+from users_index import UsersIndex, get_users_index, open_users_index
 
 
 def create_app():
@@ -35,14 +43,90 @@ def create_app():
     logging.config.dictConfig(
         app.config['HARBOUR_LOGGING']
     )
-
-    load_s3(app)
+    S3(app)
+    ClassicClient(app)
 
     # Register extensions
     watchman = Watchman(app, version=dict(scopes=['']))
     api = Api(app)
     Discoverer(app)
     db.init_app(app)
+    tasks = BackgroundTasks(app)
+    WorkerPools(app)
+    app.extensions['library_cache'] = LRUCache(
+        app.config['ADS_TWO_POINT_OH_LIBRARY_CACHE_BYTES'],
+        app.config['ADS_TWO_POINT_OH_LIBRARY_CACHE_TTL']
+    )
+    app.extensions['users_cache'] = LRUCache(
+        app.config['HARBOUR_USERS_CACHE_BYTES'],
+        app.config['HARBOUR_USERS_CACHE_TTL']
+    )
+    app.extensions['classic_libraries_cache'] = LRUCache(
+        app.config['ADS_CLASSIC_LIBRARIES_CACHE_BYTES'],
+        app.config['ADS_CLASSIC_LIBRARIES_CACHE_TTL']
+    )
+    app.extensions['single_flight'] = SingleFlight(
+        app.config['HARBOUR_SINGLE_FLIGHT_DIR'] or None,
+        app.config['HARBOUR_SINGLE_FLIGHT_TTL']
+    )
+    if app.config['HARBOUR_SINGLE_FLIGHT_DIR']:
+        tasks.add(
+            app.extensions['single_flight'].sweep,
+            app.config['HARBOUR_SINGLE_FLIGHT_TTL'],
+            name='single-flight-sweep',
+            run_first=True
+        )
+    app.extensions['presigned_url_cache'] = PresignedUrlCache(
+        app.config['HARBOUR_EXPORT_URL_EXPIRES_IN'],
+        app.config['HARBOUR_EXPORT_URL_MIN_VALIDITY'],
+        backend=FileBackend(app.config['HARBOUR_EXPORT_URL_CACHE_DIR'])
+        if app.config['HARBOUR_EXPORT_URL_CACHE_DIR'] else None
+    )
+
+    app.extensions['export_index'] = ExportIndex(
+        app.config['HARBOUR_EXPORT_TYPES']
+    )
+    if app.config['HARBOUR_EXPORT_INDEX_INTERVAL']:
+        tasks.add(
+            lambda: load_export_index(app),
+            app.config['HARBOUR_EXPORT_INDEX_INTERVAL'],
+            name='export-index',
+            run_first=True
+        )
+
+    # Load the ADS 2.0 users: from the snapshot left on disk by a previous run
+    # and then revalidate it, before serving anything, in a background thread
+    # of each worker, or when the first ADS 2.0 request needs them
+    load_mode = app.config['ADS_TWO_POINT_OH_USERS_LOAD']
+    if load_users_snapshot(app) or load_mode == 'background':
+        tasks.add(
+            lambda: load_s3(app),
+            None,
+            name='users-load',
+            run_first=True
+        ).ensure_running()
+    elif load_mode == 'lazy':
+        app.extensions['twopointoh_users_loader'] = lazy_loader(app)
+    else:
+        load_s3(app)
+
+    # Keep the ADS 2.0 users up to date, and recover if they failed to load
+    tasks.add(
+        lambda: load_s3(app),
+        app.config['ADS_TWO_POINT_OH_USERS_REFRESH_INTERVAL'],
+        name='users-refresh'
+    )
+
+    # Keep the health of the ADS Classic mirrors up to date
+    if app.config['ADS_CLASSIC_PROBE_INTERVAL']:
+        tasks.add(
+            lambda: app.extensions['classic'].probe_all(
+                app.config['ADS_CLASSIC_MIRROR_LIST']
+            ),
+            app.config['ADS_CLASSIC_PROBE_INTERVAL'],
+            name='mirror-probe',
+            run_first=True
+        )
 
     # Add the end resource end points
     api.add_resource(AuthenticateUserClassic, '/auth/classic', methods=['POST'])
@@ -53,11 +137,21 @@ def create_app():
         '/libraries/classic/<int:uid>',
         methods=['GET']
     )
+    api.add_resource(
+        BulkClassicLibraries,
+        '/libraries/classic',
+        methods=['POST']
+    )
     api.add_resource(
         TwoPointOhLibraries,
         '/libraries/twopointoh/<int:uid>',
         methods=['GET']
     )
+    api.add_resource(
+        BulkTwoPointOhLibraries,
+        '/libraries/twopointoh',
+        methods=['POST']
+    )
 
     api.add_resource(
         ExportTwoPointOhLibraries,
@@ -67,33 +161,139 @@ def create_app():
 
     api.add_resource(ClassicUser, '/user', methods=['GET'])
     api.add_resource(AllowedMirrors, '/mirrors', methods=['GET'])
+    api.add_resource(Readiness, '/ready', methods=['GET'])
+    api.add_resource(Metrics, '/metrics', methods=['GET'])
 
     return app
 
 
 def load_s3(app):
     """
-    Loads relevant data from S3 that is needed
+    Loads relevant data from S3 that is needed. If ADS_TWO_POINT_OH_USERS_INDEX
+    is set, the users are kept in a memory-mapped index at that path that is
+    shared by all of the processes on the host, otherwise in a dictionary.
+
+    This is also called periodically by the users refresher, so users.json is
+    only downloaded when its ETag differs from the one already loaded. The new
+    mapping replaces the old one in a single assignment; requests already
+    holding the old mapping finish with it.
 
     :param app: flask.Flask application instance
+    :return: True if new users were loaded
     """
+    loaded_etag = app.config['ADS_TWO_POINT_OH_USERS_ETAG'] \
+        if app.config['ADS_TWO_POINT_OH_LOADED_USERS'] else None
+
     try:
-        s3_resource = boto3.resource('s3')
-        bucket = s3_resource.Object(
-            app.config['ADS_TWO_POINT_OH_S3_MONGO_BUCKET'],
-            'users.json'
-        )
-        body = bucket.get()['Body']
+        s3 = app.extensions['s3']
+        bucket = app.config['ADS_TWO_POINT_OH_S3_MONGO_BUCKET']
+
+        def fetch(if_none_match=None):
+            kwargs = {'IfNoneMatch': if_none_match} if if_none_match else {}
+            response = s3.get_object(bucket, 'users.json', **kwargs)
+
+            # Build the mapping pair by pair straight off the S3 body, rather
+            # than holding the raw bytes, a string copy and the dict at once
+            return response['ETag'], iter_json_object(
+                response['Body'],
+                chunk_size=app.config['ADS_TWO_POINT_OH_USERS_CHUNK_SIZE']
+            )
 
-        user_data = StringIO()
-        for chunk in iter(lambda: body.read(1024), b''):
-            user_data.write(chunk)
+        index_path = app.config.get('ADS_TWO_POINT_OH_USERS_INDEX')
+        if index_path:
+            etag = s3.head_object(bucket, 'users.json')['ETag']
+            users = app.config['ADS_TWO_POINT_OH_USERS']
+            if etag == loaded_etag and isinstance(users, UsersIndex):
+                return False
+
+            users = get_users_index(index_path, etag, fetch)
+            etag = users.etag
+        else:
+            try:
+                etag, items = fetch(if_none_match=loaded_etag)
+            except ClientError as error:
+                if not_modified(error):
+                    return False
+                raise
+            users = dict(items)
 
-        users = json.loads(user_data.getvalue())
         app.config['ADS_TWO_POINT_OH_USERS'] = users
+        app.config['ADS_TWO_POINT_OH_USERS_ETAG'] = etag
         app.config['ADS_TWO_POINT_OH_LOADED_USERS'] = True
+
+        app.logger.info('Loaded users database: {}'.format(etag))
+        return True
     except Exception as error:
         app.logger.warning('Could not load users database: {}'.format(error))
+        return False
+
+
+def load_export_index(app):
+    """
+    Rebuilds the index of the ADS 2.0 exports from a listing of the bucket
+
+    :param app: flask.Flask application instance
+    :return: True if the index was rebuilt
+    """
+    try:
+        index = app.extensions['export_index']
+        index.build(app.extensions['s3'].iter_keys(
+            app.config['ADS_TWO_POINT_OH_S3_MONGO_BUCKET']
+        ))
+
+        app.logger.info('Indexed ADS 2.0 exports: {}'.format(len(index)))
+        return True
+    except Exception as error:
+        app.logger.warning('Could not index ADS 2.0 exports: {}'
+                           .format(error))
+        return False
+
+
+def load_users_snapshot(app):
+    """
+    Loads the ADS 2.0 users from the index left on disk by a previous run, if
+    there is one, without contacting S3. The index is tagged with the ETag it
+    was built from, so the next load_s3 only rebuilds it if S3 has changed.
+
+    :param app: flask.Flask application instance
+    :return: True if the users were loaded
+    """
+    index_path = app.config.get('ADS_TWO_POINT_OH_USERS_INDEX')
+    if not index_path:
+        return False
+
+    index = open_users_index(index_path)
+    if index is None:
+        return False
+
+    app.config['ADS_TWO_POINT_OH_USERS'] = index
+    app.config['ADS_TWO_POINT_OH_USERS_ETAG'] = index.etag
+    app.config['ADS_TWO_POINT_OH_LOADED_USERS'] = True
+
+    app.logger.info('Loaded users database from snapshot: {}'
+                    .format(index.etag))
+    return True
+
+
+def lazy_loader(app):
+    """
+    Loader for the ADS 2.0 users that are loaded on first use. Only the first
+    call in a process loads them, concurrent callers wait for it to finish,
+    and later calls do nothing; the users refresher then takes over.
+
+    :param app: flask.Flask application instance
+    :return: callable that takes no arguments
+    """
+    lock = threading.Lock()
+    state = {'attempted': False}
+
+    def load():
+        with lock:
+            if not state['attempted']:
+                state['attempted'] = True
+                load_s3(app)
+
+    return load
 
 
 def load_config(app):
@@ -0,0 +1,196 @@
+"""
+Periodic background tasks, and pools of threads shared by the requests, that
+run inside each worker process.
+
+Threads do not survive a fork, so tasks are not started when they are
+registered (which may happen in a pre-forking master), but lazily on the first
+request handled by each process. Pools are likewise created on first use.
+"""
+import os
+import atexit
+import logging
+import threading
+
+from multiprocessing.pool import ThreadPool
+
+logger = logging.getLogger(__name__)
+
+
+class PeriodicTask(object):
+    """
+    Calls a function every interval seconds from a daemon thread
+    """
+    def __init__(self, function, interval, name=None, run_first=False):
+        """
+        Constructor
+        :param function: callable that takes no arguments
+        :param interval: seconds to wait between calls, no interval calls the
+        function only once (with run_first)
+        :param name: name of the thread
+        :param run_first: call the function as soon as the thread starts
+        """
+        self.function = function
+        self.interval = interval
+        self.run_first = run_first
+        self.name = name or getattr(function, '__name__', 'task')
+
+        self._pid = None
+        self._thread = None
+        self._stopped = threading.Event()
+        self._lock = threading.Lock()
+
+    def ensure_running(self):
+        """
+        Start the thread if it is not already running in this process
+        """
+        if self._pid == os.getpid():
+            return
+
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+
+            self._stopped = threading.Event()
+            thread = threading.Thread(
+                target=self._run,
+                args=(self._stopped,),
+                name=self.name
+            )
+            thread.daemon = True
+            thread.start()
+            self._thread = thread
+            self._pid = os.getpid()
+
+    def stop(self, timeout=None):
+        """
+        Stop the thread after the current call, if any, has finished
+        :param timeout: seconds to wait for the thread to finish, if any
+        """
+        self._stopped.set()
+        self._pid = None
+
+        thread = self._thread
+        if timeout and thread is not None and thread.is_alive() and \
+                thread is not threading.current_thread():
+            thread.join(timeout)
+
+    def _call(self):
+        try:
+            self.function()
+        except Exception:
+            logger.exception('Background task "{0}" failed'.format(self.name))
+
+    def _run(self, stopped):
+        if self.run_first:
+            self._call()
+
+        while self.interval and not stopped.wait(self.interval):
+            self._call()
+
+
+class BackgroundTasks(object):
+    """
+    Flask extension that keeps the periodic tasks of the application running
+    in every process that serves requests
+    """
+    def __init__(self, app=None):
+        """
+        Constructor
+        :param app: flask.Flask application instance
+        """
+        self.tasks = []
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """
+        Register the extension with the application
+        :param app: flask.Flask application instance
+        """
+        app.extensions['background_tasks'] = self
+        app.before_request(self.ensure_running)
+
+        # Let the threads finish before the interpreter tears itself down
+        atexit.register(self.stop, timeout=1)
+
+    def add(self, function, interval, name=None, run_first=False):
+        """
+        Register a function to be called every interval seconds
+        :param function: callable that takes no arguments
+        :param interval: seconds between calls
+        :param name: name of the task
+        :param run_first: call the function as soon as the task starts, tasks
+        with neither this nor an interval are not registered
+
+        :return: PeriodicTask or None
+        """
+        if not interval and not run_first:
+            return None
+
+        task = PeriodicTask(
+            function,
+            interval,
+            name=name,
+            run_first=run_first
+        )
+        self.tasks.append(task)
+        return task
+
+    def ensure_running(self):
+        """
+        Start any tasks not yet running in this process
+        """
+        for task in self.tasks:
+            task.ensure_running()
+
+    def stop(self, timeout=None):
+        """
+        Stop all of the tasks
+        :param timeout: seconds to wait for each task to finish, if any
+        """
+        for task in self.tasks:
+            task.stop(timeout=timeout)
+
+
+class WorkerPools(object):
+    """
+    Flask extension that keeps pools of threads, by name, that the requests of
+    a process share, rather than each starting threads of its own
+    """
+    def __init__(self, app=None):
+        """
+        Constructor
+        :param app: flask.Flask application instance
+        """
+        self._pid = None
+        self._pools = {}
+        self._lock = threading.Lock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """
+        Register the extension with the application
+        :param app: flask.Flask application instance
+        """
+        app.extensions['worker_pools'] = self
+
+    def get(self, name, workers):
+        """
+        The pool of a name in this process, started on first use
+        :param name: name of the pool, eg., 'classic-bulk'
+        :param workers: threads of the pool, if it has to be started
+
+        :return: multiprocessing.pool.ThreadPool
+        """
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pools = {}
+                self._pid = os.getpid()
+
+            pool = self._pools.get(name)
+            if pool is None:
+                pool = self._pools[name] = ThreadPool(max(workers, 1))
+
+        return pool
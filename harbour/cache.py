@@ -0,0 +1,298 @@
+"""
+Caches shared by the threads of a worker, or by the workers of a host
+"""
+import os
+import json
+import time
+import hashlib
+import tempfile
+import threading
+
+from collections import OrderedDict
+
+
+class CacheEntry(object):
+    """
+    A value in the cache, along with what is needed to expire and revalidate
+    it
+    """
+    __slots__ = ['value', 'size', 'etag', 'expires']
+
+    def __init__(self, value, size, etag, expires):
+        self.value = value
+        self.size = size
+        self.etag = etag
+        self.expires = expires
+
+
+class LRUCache(object):
+    """
+    Thread-safe least recently used cache, bounded by the total size of its
+    values rather than their number. Entries expire after a time to live, but
+    are kept (until evicted) so that they can be revalidated with their ETag
+    instead of being fetched again.
+    """
+    def __init__(self, max_bytes, ttl):
+        """
+        Constructor
+        :param max_bytes: maximum total size of the values, 0 disables the
+        cache
+        :param ttl: seconds an entry is fresh for
+        """
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._refreshing = set()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.revalidations = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """
+        Return the value if it is cached and fresh
+        :param key: key of the entry
+
+        :return: value or None
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry.expires <= time.time():
+                self.misses += 1
+                return None
+
+            # Move to the most recently used end
+            del self._entries[key]
+            self._entries[key] = entry
+            self.hits += 1
+            return entry.value
+
+    def get_stale(self, key):
+        """
+        Return the entry, whether or not it has expired, so that it can be
+        revalidated
+        :param key: key of the entry
+
+        :return: CacheEntry or None
+        """
+        with self._lock:
+            return self._entries.get(key)
+
+    def revalidated(self, key):
+        """
+        Mark an expired entry as fresh again, eg., after a 304 from S3
+        :param key: key of the entry
+
+        :return: value or None, if the entry has since been evicted
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+
+            entry.expires = time.time() + self.ttl
+            self.revalidations += 1
+            return entry.value
+
+    def set(self, key, value, size, etag=None, ttl=None):
+        """
+        Cache a value, evicting the least recently used entries to make room
+        :param key: key of the entry
+        :param value: value to cache
+        :param size: size of the value in bytes
+        :param etag: ETag of the value, used to revalidate it
+        :param ttl: seconds this entry is fresh for, if not the cache's
+        """
+        if size > self.max_bytes:
+            return
+
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old.size
+
+            while self._entries and self._bytes + size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= evicted.size
+                self.evictions += 1
+
+            self._entries[key] = CacheEntry(
+                value, size, etag, time.time() + (
+                    self.ttl if ttl is None else ttl
+                )
+            )
+            self._bytes += size
+
+    def delete(self, key):
+        """
+        Drop an entry, eg., when what it was built from has changed
+        :param key: key of the entry
+        """
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old.size
+
+    def start_refresh(self, key, limit=None):
+        """
+        Claim the refresh of an entry, so that only one thread refreshes it
+        at a time
+        :param key: key of the entry
+        :param limit: most entries refreshed at once, if any
+
+        :return: True if the caller should refresh the entry, and then call
+        end_refresh
+        """
+        with self._lock:
+            if key in self._refreshing:
+                return False
+            if limit is not None and len(self._refreshing) >= limit:
+                return False
+            self._refreshing.add(key)
+            return True
+
+    def end_refresh(self, key):
+        with self._lock:
+            self._refreshing.discard(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        """
+        Counters of the cache
+        :return: dict
+        """
+        return {
+            'entries': len(self._entries),
+            'bytes': self._bytes,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'revalidations': self.revalidations
+        }
+
+
+class MemoryBackend(object):
+    """
+    Presigned URL storage local to the process
+    """
+    def __init__(self):
+        self._urls = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            return self._urls.get(key)
+
+    def set(self, key, url, expires):
+        with self._lock:
+            self._urls[key] = (url, expires)
+
+
+class FileBackend(object):
+    """
+    Presigned URL storage shared by all of the processes on a host, as one
+    small file per URL in a directory
+    """
+    def __init__(self, directory):
+        """
+        Constructor
+        :param directory: directory to keep the URLs in, created if needed
+        """
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _path(self, key):
+        return os.path.join(
+            self.directory,
+            hashlib.sha1('/'.join(key).encode('utf-8')).hexdigest()
+        )
+
+    def get(self, key):
+        try:
+            with open(self._path(key), 'rb') as url_file:
+                stored = json.load(url_file)
+            return stored['url'], stored['expires']
+        except (IOError, OSError, ValueError, KeyError):
+            return None
+
+    def set(self, key, url, expires):
+        # Written to a temporary file and renamed, so readers in other
+        # processes never see a partial file
+        handle, tmp_path = tempfile.mkstemp(dir=self.directory, prefix='.')
+        try:
+            with os.fdopen(handle, 'wb') as url_file:
+                json.dump({'url': url, 'expires': expires}, url_file)
+            os.rename(tmp_path, self._path(key))
+        except Exception:
+            os.remove(tmp_path)
+            raise
+
+
+class PresignedUrlCache(object):
+    """
+    Presigned URLs by bucket and key. A URL is handed out again for as long
+    as it remains valid for at least min_validity seconds, and is only signed
+    again once it gets closer to expiring than that.
+    """
+    def __init__(self, expires_in, min_validity, backend=None):
+        """
+        Constructor
+        :param expires_in: seconds a new URL is valid for
+        :param min_validity: seconds a URL must still be valid for to be
+        handed out
+        :param backend: MemoryBackend (default) or FileBackend
+        """
+        self.expires_in = expires_in
+        self.min_validity = min_validity
+        self.backend = backend or MemoryBackend()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, bucket, key, generate):
+        """
+        Return a presigned URL for the object
+        :param bucket: name of the bucket
+        :param key: key of the object
+        :param generate: callable(bucket, key, expires_in) that signs a URL
+
+        :return: URL, seconds it remains valid for
+        """
+        now = time.time()
+        cached = self.backend.get((bucket, key))
+        if cached is not None and cached[1] - now >= self.min_validity:
+            with self._lock:
+                self.hits += 1
+            return cached[0], int(cached[1] - now)
+
+        with self._lock:
+            self.misses += 1
+        url = generate(bucket, key, self.expires_in)
+        self.backend.set((bucket, key), url, now + self.expires_in)
+        return url, self.expires_in
+
+    def stats(self):
+        """
+        Counters of the cache
+        :return: dict
+        """
+        with self._lock:
+            return {
+                'backend': type(self.backend).__name__,
+                'hits': self.hits,
+                'misses': self.misses
+            }
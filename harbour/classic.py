@@ -0,0 +1,646 @@
+"""
+Access to the ADS Classic mirrors
+
+Every mirror gets its own session, with a pool of keep-alive connections, so
+that requests to a far-away mirror reuse an open connection rather than
+paying for a new TCP handshake each time. The sessions are created on first
+use in each process, as connections cannot be shared with a parent process.
+
+Every mirror also gets its own circuit breaker and cap on concurrent
+requests, so that a mirror that hangs or fails makes requests to it fail
+fast, rather than tying up the threads that serve every other mirror. A
+request waits a short while for the cap to let it through before failing, so
+that a burst, eg., of bulk requests, queues rather than being rejected.
+
+Read timeouts follow how fast each mirror usually answers each operation: a
+percentile of its recent latencies, with some headroom, bounded by a minimum
+and a maximum.
+
+A streamed request keeps its place under the cap until its response is
+closed, and its latency and outcome are only recorded then, so that reading
+the body counts: a mirror that sends the headers and then hangs fails like
+one that never answers.
+
+The mirrors are also probed in the background, so that their health is known
+before a user's request is spent on them.
+"""
+import os
+import time
+import requests
+import threading
+
+from client import Client
+from urlparse import urlsplit
+from collections import deque
+from requests.packages.urllib3.exceptions import ReadTimeoutError
+
+
+class MirrorUnavailable(requests.exceptions.Timeout):
+    """
+    Raised without contacting a mirror, when its circuit breaker is open or
+    it kept as many requests in flight as it is allowed for as long as a
+    request may wait. It is a Timeout, as the mirror could not have answered
+    in time.
+    """
+
+
+class Bulkhead(object):
+    """
+    Cap on the requests in flight, that a request waits on for a bounded time
+    """
+    def __init__(self, size):
+        """
+        Constructor
+        :param size: most requests in flight
+        """
+        self.size = size
+        self.free = size
+        self.waiting = 0
+        self._condition = threading.Condition(threading.Lock())
+
+    def acquire(self, timeout=None):
+        """
+        Take a place, waiting for one to be free
+        :param timeout: most seconds to wait, None to wait for as long as it
+        takes, 0 not to wait
+
+        :return: True if a place was taken
+        """
+        deadline = remaining = None
+        with self._condition:
+            while not self.free:
+                if timeout is not None:
+                    if deadline is None:
+                        deadline = time.time() + timeout
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+
+                self.waiting += 1
+                try:
+                    self._condition.wait(remaining)
+                finally:
+                    self.waiting -= 1
+
+            self.free -= 1
+            return True
+
+    def release(self):
+        """
+        Give a place back, to the next request waiting if any
+        """
+        with self._condition:
+            if self.free >= self.size:
+                raise ValueError('Bulkhead released too many times')
+            self.free += 1
+            self._condition.notify()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+def is_read_timeout(exception):
+    """
+    Whether a request failed because the mirror took longer than its read
+    timeout. requests raises ReadTimeout while waiting for the headers, but a
+    ConnectionError around urllib3's ReadTimeoutError while reading the body.
+    :param exception: exception raised by requests
+
+    :return: bool
+    """
+    if isinstance(exception, requests.exceptions.ReadTimeout):
+        return True
+    return isinstance(exception, requests.exceptions.ConnectionError) and \
+        bool(exception.args) and \
+        isinstance(exception.args[0], ReadTimeoutError)
+
+
+class CircuitBreaker(object):
+    """
+    Opens after a number of consecutive failures, and then lets a single
+    trial request through every reset_timeout seconds. A successful trial
+    closes it again.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, max_failures, reset_timeout):
+        """
+        Constructor
+        :param max_failures: consecutive failures that open the breaker
+        :param reset_timeout: seconds before a trial request is let through
+        """
+        self.max_failures = max_failures
+        self.reset_timeout = reset_timeout
+
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened = None
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """
+        Whether a request may be made
+        :return: bool
+        """
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+
+            # One trial at a time, and another one if a trial never reports
+            if time.time() - self.opened >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                self.opened = time.time()
+                return True
+
+            return False
+
+    def success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or \
+                    self.failures >= self.max_failures:
+                self.state = self.OPEN
+                self.opened = time.time()
+
+
+class LatencyWindow(object):
+    """
+    The most recent latencies of an operation
+    """
+    def __init__(self, size):
+        """
+        Constructor
+        :param size: number of latencies to keep
+        """
+        self._latencies = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._latencies)
+
+    def add(self, seconds):
+        with self._lock:
+            self._latencies.append(seconds)
+
+    def percentile(self, percent):
+        """
+        Nearest-rank percentile of the latencies
+        :param percent: eg., 99
+
+        :return: seconds, or None if there are no latencies
+        """
+        with self._lock:
+            latencies = sorted(self._latencies)
+
+        if not latencies:
+            return None
+
+        rank = int(round(percent / 100.0 * len(latencies)))
+        return latencies[min(max(rank, 1), len(latencies)) - 1]
+
+
+class Mirror(object):
+    """
+    Session, circuit breaker and concurrency cap of a mirror
+    """
+    def __init__(self, name, config):
+        """
+        Constructor
+        :param name: host name of the mirror
+        :param config: application configuration
+        """
+        self.name = name
+
+        # The API token is for ADS services, not the mirrors
+        client = Client(config, authorize=False)
+        for scheme in ('http://', 'https://'):
+            client.mount(
+                '{0}{1}'.format(scheme, name),
+                1,
+                config['ADS_CLASSIC_POOL_MAXSIZE'],
+                pool_block=config['ADS_CLASSIC_POOL_BLOCK']
+            )
+        self.session = client.session
+
+        self.breaker = CircuitBreaker(
+            config['ADS_CLASSIC_BREAKER_FAILURES'],
+            config['ADS_CLASSIC_BREAKER_RESET']
+        )
+        self.max_concurrency = config['ADS_CLASSIC_MAX_CONCURRENCY']
+        self.bulkhead = Bulkhead(self.max_concurrency)
+        # Requests of the bulk end point take a place in this one too, so that
+        # they leave places free for the other requests
+        self.bulk_bulkhead = Bulkhead(
+            config['ADS_CLASSIC_BULK_MIRROR_CONCURRENCY']
+        )
+
+        self.window = config['ADS_CLASSIC_TIMEOUT_WINDOW']
+        self.latencies = {}
+
+        # Result of the last probe: None until probed
+        self.alive = None
+        self.probe_latency = None
+        self.probed = None
+
+        self.in_flight = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+
+    @property
+    def healthy(self):
+        """
+        Whether the mirror answered its last probe and its circuit breaker is
+        closed, or None if it has not been probed yet
+        """
+        if self.breaker.state == CircuitBreaker.OPEN:
+            return False
+        return self.alive
+
+    def latency(self, operation):
+        """
+        The latencies of an operation on this mirror
+        :param operation: eg., 'elogin'
+
+        :return: LatencyWindow
+        """
+        window = self.latencies.get(operation)
+        if window is None:
+            with self._lock:
+                window = self.latencies.setdefault(
+                    operation,
+                    LatencyWindow(self.window)
+                )
+        return window
+
+    def count(self, counter, increment=1):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + increment)
+
+    def stats(self):
+        return {
+            'state': self.breaker.state,
+            'failures': self.breaker.failures,
+            'in_flight': self.in_flight,
+            'max_concurrency': self.max_concurrency,
+            'waiting': self.bulkhead.waiting,
+            'bulk_in_flight':
+                self.bulk_bulkhead.size - self.bulk_bulkhead.free,
+            'bulk_waiting': self.bulk_bulkhead.waiting,
+            'rejected': self.rejected,
+            'alive': self.alive,
+            'probe_latency': self.probe_latency,
+            'probed': self.probed
+        }
+
+
+class MirrorCall(object):
+    """
+    A request in flight to a mirror. It holds a place under the cap of the
+    mirror until it has finished, and then records its latency and outcome.
+    """
+    def __init__(self, mirror, operation, read_timeout):
+        """
+        Constructor
+        :param mirror: Mirror, whose bulkhead the caller has acquired
+        :param operation: name the latency is kept under
+        :param read_timeout: read timeout of the request
+        """
+        self.mirror = mirror
+        self.latency = mirror.latency(operation)
+        self.read_timeout = read_timeout
+        self.start = time.time()
+
+        self._finished = False
+        self._lock = threading.Lock()
+        mirror.count('in_flight')
+
+    def _finish(self):
+        with self._lock:
+            if self._finished:
+                return False
+            self._finished = True
+
+        self.mirror.count('in_flight', -1)
+        self.mirror.bulkhead.release()
+        return True
+
+    def failed(self, exception):
+        """
+        Record that the request failed, unless it has already finished
+        :param exception: exception raised by requests
+        """
+        if not self._finish():
+            return
+
+        if is_read_timeout(exception):
+            # The mirror took at least this long, counting it keeps the
+            # timeout from only ever shrinking
+            self.latency.add(self.read_timeout)
+        self.mirror.breaker.failure()
+
+    def succeeded(self, status_code, end=None):
+        """
+        Record that the mirror answered, unless the request has already
+        finished. 5xx responses count as failures of the mirror.
+        :param status_code: HTTP status of the response
+        :param end: time the last of the response was received, now by
+        default
+        """
+        if not self._finish():
+            return
+
+        self.latency.add((end or time.time()) - self.start)
+        if status_code >= 500:
+            self.mirror.breaker.failure()
+        else:
+            self.mirror.breaker.success()
+
+
+class StreamedResponse(object):
+    """
+    Response of a streamed request to a mirror, whose body is read through
+    iter_content. The request finishes when the response is closed, or when
+    reading the body fails.
+    """
+    def __init__(self, response, call):
+        """
+        Constructor
+        :param response: requests.Response, with the body still to be read
+        :param call: MirrorCall of the request
+        """
+        self.response = response
+        self.call = call
+        self._last_read = None
+
+    def __getattr__(self, name):
+        return getattr(self.response, name)
+
+    def iter_content(self, chunk_size=1, decode_unicode=False):
+        try:
+            for chunk in self.response.iter_content(chunk_size,
+                                                    decode_unicode):
+                self._last_read = time.time()
+                yield chunk
+        except Exception as exception:
+            self.call.failed(exception)
+            raise
+
+    def close(self):
+        try:
+            self.response.close()
+        finally:
+            self.call.succeeded(self.response.status_code, self._last_read)
+
+    def __del__(self):
+        # A response dropped without being closed must not keep its place
+        # under the cap of the mirror forever
+        self.close()
+
+
+class ClassicClient(object):
+    """
+    Flask extension that holds the session, circuit breaker and concurrency
+    cap of each ADS Classic mirror
+    """
+    def __init__(self, app=None):
+        """
+        Constructor
+        :param app: flask.Flask application instance
+        """
+        self.config = {}
+
+        self._pid = None
+        self._mirrors = {}
+        self._lock = threading.Lock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """
+        Register the extension with the application
+        :param app: flask.Flask application instance
+        """
+        self.config = app.config
+        app.extensions['classic'] = self
+
+    def get_mirror(self, name):
+        """
+        The state of a mirror in this process
+        :param name: host name of the mirror, eg., 'adsabs.harvard.edu'
+
+        :return: Mirror
+        """
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._mirrors = {}
+                    self._pid = os.getpid()
+
+        mirror = self._mirrors.get(name)
+        if mirror is None:
+            with self._lock:
+                mirror = self._mirrors.get(name)
+                if mirror is None:
+                    mirror = self._mirrors[name] = Mirror(name, self.config)
+
+        return mirror
+
+    def session(self, name):
+        """
+        The session of a mirror in this process
+        :param name: host name of the mirror
+
+        :return: requests.Session
+        """
+        return self.get_mirror(name).session
+
+    @staticmethod
+    def mirror(url):
+        """
+        Host name of the mirror a URL points to
+        :param url: URL on an ADS Classic mirror
+
+        :return: host name
+        """
+        return urlsplit(url).netloc
+
+    def read_timeout(self, mirror, operation):
+        """
+        Read timeout of an operation on a mirror: a percentile of its recent
+        latencies times some headroom, within the configured bounds. Until
+        enough latencies are known, the maximum.
+        :param mirror: Mirror
+        :param operation: eg., 'elogin'
+
+        :return: seconds
+        """
+        maximum = self.config['ADS_CLASSIC_READ_TIMEOUT']
+        window = mirror.latency(operation)
+        if len(window) < self.config['ADS_CLASSIC_TIMEOUT_MIN_SAMPLES']:
+            return maximum
+
+        timeout = window.percentile(
+            self.config['ADS_CLASSIC_TIMEOUT_PERCENTILE']
+        ) * self.config['ADS_CLASSIC_TIMEOUT_HEADROOM']
+        return min(
+            max(timeout, self.config['ADS_CLASSIC_MIN_READ_TIMEOUT']),
+            maximum
+        )
+
+    def request(self, method, url, operation=None, **kwargs):
+        """
+        Make a request to a mirror, unless it is failing, or busy for longer
+        than ADS_CLASSIC_QUEUE_TIMEOUT. Timeouts, connection errors and 5xx
+        responses count as failures of the mirror.
+        :param method: HTTP method
+        :param url: URL on an ADS Classic mirror
+        :param operation: name the latencies of the request are kept under,
+        the method by default
+        :param kwargs: arguments of requests.Session.request. With stream,
+        the request lasts until the response is closed, which the caller
+        must do.
+
+        :return: requests.Response, or StreamedResponse with stream
+        """
+        operation = operation or method.lower()
+        mirror = self.get_mirror(self.mirror(url))
+
+        timeout = self.config['ADS_CLASSIC_QUEUE_TIMEOUT']
+        if not mirror.bulkhead.acquire(timeout):
+            mirror.count('rejected')
+            raise MirrorUnavailable(
+                'Too many requests in flight to {0} for {1}s'.format(
+                    mirror.name, timeout
+                )
+            )
+
+        try:
+            if not mirror.breaker.allow():
+                mirror.count('rejected')
+                raise MirrorUnavailable(
+                    'Circuit breaker of {0} is open'.format(mirror.name)
+                )
+
+            read_timeout = self.read_timeout(mirror, operation)
+            kwargs.setdefault('timeout', (
+                self.config['ADS_CLASSIC_CONNECT_TIMEOUT'],
+                read_timeout
+            ))
+            call = MirrorCall(mirror, operation, read_timeout)
+        except Exception:
+            mirror.bulkhead.release()
+            raise
+
+        try:
+            response = mirror.session.request(method, url, **kwargs)
+        except Exception as exception:
+            call.failed(exception)
+            raise
+
+        if kwargs.get('stream'):
+            return StreamedResponse(response, call)
+
+        call.succeeded(response.status_code)
+        return response
+
+    def probe(self, name):
+        """
+        Check that a mirror answers its home page, and how fast. This is made
+        whatever the state of the circuit breaker, which it then updates.
+        :param name: host name of the mirror
+
+        :return: Mirror
+        """
+        mirror = self.get_mirror(name)
+        url = self.config['ADS_CLASSIC_URL'].format(mirror=name)
+
+        start = time.time()
+        try:
+            response = mirror.session.get(
+                url,
+                timeout=(
+                    self.config['ADS_CLASSIC_CONNECT_TIMEOUT'],
+                    self.config['ADS_CLASSIC_PROBE_TIMEOUT']
+                ),
+                stream=True
+            )
+            response.close()
+            alive = response.status_code < 500
+        except requests.exceptions.RequestException:
+            alive = False
+
+        mirror.probe_latency = time.time() - start
+        mirror.probed = time.time()
+        mirror.alive = alive
+
+        if alive:
+            mirror.breaker.success()
+        else:
+            mirror.breaker.failure()
+
+        return mirror
+
+    def probe_all(self, names):
+        """
+        Probe mirrors all at once, so that slow ones do not hold up the others
+        :param names: host names of the mirrors
+        """
+        threads = [
+            threading.Thread(target=self.probe, args=(name,)) for name in names
+        ]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def ranked(self, names):
+        """
+        Mirrors from the healthiest to the least: those that answered their
+        last probe, fastest first, then those not probed yet, then those that
+        are down. Otherwise in the given order.
+        :param names: host names of the mirrors
+
+        :return: list of host names
+        """
+        def rank(position):
+            mirror = self.get_mirror(names[position])
+            if mirror.healthy:
+                return 0, mirror.probe_latency, position
+            if mirror.healthy is None:
+                return 1, 0, position
+            return 2, 0, position
+
+        return [names[i] for i in sorted(range(len(names)), key=rank)]
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def stats(self):
+        """
+        State of the mirrors used by this process
+        :return: dict
+        """
+        stats = {}
+        for name, mirror in self._mirrors.items():
+            stats[name] = mirror.stats()
+            stats[name]['read_timeouts'] = {
+                operation: self.read_timeout(mirror, operation)
+                for operation in mirror.latencies
+            }
+        return stats
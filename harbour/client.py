@@ -10,16 +10,35 @@ class Client:
     place to set application specific parameters, such as the oauth2
     authorization header
     """
-    def __init__(self, config):
+    def __init__(self, config, authorize=True):
         """
         Constructor
         :param config: configuration dictionary of the client
         :type config: dict
+        :param authorize: send the API token, which should only go to ADS
+        services
+        :type authorize: bool
         """
 
         self.session = requests.Session()
-        self.token = config.get('HARBOUR_SERVICE_ADSWS_API_TOKEN')
+        self.token = config.get('HARBOUR_SERVICE_ADSWS_API_TOKEN') \
+            if authorize else None
         if self.token:
             self.session.headers.update(
                 {'Authorization': 'Bearer {token}'.format(token=self.token)}
             )
+
+    def mount(self, prefix, pool_connections, pool_maxsize, pool_block=False):
+        """
+        Keep a pool of keep-alive connections for the URLs with this prefix
+        :param prefix: URL prefix, eg., 'http://adsabs.harvard.edu'
+        :param pool_connections: number of hosts to keep pools for
+        :param pool_maxsize: connections kept open per host
+        :param pool_block: wait for a free connection, rather than opening one
+        that will not be kept, when the pool is exhausted
+        """
+        self.session.mount(prefix, requests.adapters.HTTPAdapter(
+            pool_connections=pool_connections,
+            pool_maxsize=pool_maxsize,
+            pool_block=pool_block
+        ))
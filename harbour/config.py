@@ -2,6 +2,62 @@
 import os
 ADS_CLASSIC_URL = 'http://{mirror}'
 ADS_CLASSIC_LIBRARIES_URL = 'http://{mirror}/cookie={cookie}'
+# Keep-alive connections kept open to each mirror by each process, and
+# whether to wait for one to be free rather than open an extra connection
+ADS_CLASSIC_POOL_MAXSIZE = 10
+ADS_CLASSIC_POOL_BLOCK = False
+# Requests to a mirror time out after these many seconds to connect and, at
+# most, to read. After ADS_CLASSIC_BREAKER_FAILURES timeouts or 5xx in a row,
+# requests to it fail straight away, bar one trial every
+# ADS_CLASSIC_BREAKER_RESET seconds. Each process has at most
+# ADS_CLASSIC_MAX_CONCURRENCY requests in flight to any one mirror, and any
+# more wait up to ADS_CLASSIC_QUEUE_TIMEOUT seconds for one of them to finish.
+ADS_CLASSIC_CONNECT_TIMEOUT = 5
+ADS_CLASSIC_READ_TIMEOUT = 30
+ADS_CLASSIC_BREAKER_FAILURES = 5
+ADS_CLASSIC_BREAKER_RESET = 30
+ADS_CLASSIC_MAX_CONCURRENCY = 4
+ADS_CLASSIC_QUEUE_TIMEOUT = 2
+# The read timeout of each mirror and operation is the
+# ADS_CLASSIC_TIMEOUT_PERCENTILE of its last ADS_CLASSIC_TIMEOUT_WINDOW
+# latencies, times ADS_CLASSIC_TIMEOUT_HEADROOM, between
+# ADS_CLASSIC_MIN_READ_TIMEOUT and ADS_CLASSIC_READ_TIMEOUT. It is the maximum
+# until there are ADS_CLASSIC_TIMEOUT_MIN_SAMPLES latencies.
+ADS_CLASSIC_TIMEOUT_PERCENTILE = 99
+ADS_CLASSIC_TIMEOUT_HEADROOM = 3
+ADS_CLASSIC_TIMEOUT_WINDOW = 200
+ADS_CLASSIC_TIMEOUT_MIN_SAMPLES = 20
+ADS_CLASSIC_MIN_READ_TIMEOUT = 2
+# Seconds between probes of the mirrors, 0 not to probe them, and how long a
+# mirror has to answer a probe
+ADS_CLASSIC_PROBE_INTERVAL = 60
+ADS_CLASSIC_PROBE_TIMEOUT = 5
+# Libraries of a user are cached by each process for
+# ADS_CLASSIC_LIBRARIES_CACHE_TTL seconds, and then returned for up to
+# ADS_CLASSIC_LIBRARIES_CACHE_STALE seconds more while they are fetched again
+# by a pool of ADS_CLASSIC_LIBRARIES_REFRESH_WORKERS threads. Refreshes beyond
+# those are dropped, and tried again by a later request.
+ADS_CLASSIC_LIBRARIES_CACHE_BYTES = 32 * 1024 * 1024
+ADS_CLASSIC_LIBRARIES_CACHE_TTL = 300
+ADS_CLASSIC_LIBRARIES_CACHE_STALE = 3600
+ADS_CLASSIC_LIBRARIES_REFRESH_WORKERS = 4
+# ADS Classic responses are read into memory until more than this many bytes
+# have been read (or are announced by Content-Length), and the rest is then
+# streamed through to the client a library at a time, in chunks of about
+# ADS_CLASSIC_LIBRARIES_CHUNK_SIZE, rather than being held and cached. A
+# failure upstream while streaming cuts the response short.
+ADS_CLASSIC_LIBRARIES_STREAM_BYTES = 1024 * 1024
+ADS_CLASSIC_LIBRARIES_CHUNK_SIZE = 64 * 1024
+# The bulk libraries end point takes up to ADS_CLASSIC_BULK_MAX_UIDS users, and
+# fetches their libraries with a pool of ADS_CLASSIC_BULK_WORKERS threads
+# shared by the requests of a process, at most
+# ADS_CLASSIC_BULK_MIRROR_CONCURRENCY at a time per mirror. Keep this below
+# ADS_CLASSIC_MAX_CONCURRENCY, to leave room for the other requests. A user
+# whose mirror stays busy for ADS_CLASSIC_BULK_QUEUE_TIMEOUT seconds fails.
+ADS_CLASSIC_BULK_MAX_UIDS = 1000
+ADS_CLASSIC_BULK_WORKERS = 8
+ADS_CLASSIC_BULK_MIRROR_CONCURRENCY = 2
+ADS_CLASSIC_BULK_QUEUE_TIMEOUT = 60
 ADS_CLASSIC_MIRROR_LIST = [
     'astrobib.u-strasbg.fr',
     'ads.nao.ac.jp',
@@ -21,13 +77,80 @@ ADS_CLASSIC_MIRROR_LIST = [
 ADS_TWO_POINT_OH_S3_MONGO_BUCKET = 'adsabs-mongogut'
 ADS_TWO_POINT_OH_LOADED_USERS = False
 ADS_TWO_POINT_OH_USERS = {}
+ADS_TWO_POINT_OH_USERS_ETAG = ''
+# When to load the users: 'startup' (before serving anything), 'background'
+# (in a thread of each worker) or 'lazy' (on the first ADS 2.0 request)
+ADS_TWO_POINT_OH_USERS_LOAD = 'startup'
+# Seconds between checks for a new users.json, 0 disables the refresher
+ADS_TWO_POINT_OH_USERS_REFRESH_INTERVAL = 300
+ADS_TWO_POINT_OH_USERS_CHUNK_SIZE = 64 * 1024
+# Path of the memory-mapped users index shared by the workers on a host, eg.,
+# '/tmp/harbour.users.idx'. It is kept between restarts, and is served at
+# start-up while S3 is revalidated. Leave empty for a dictionary per process.
+ADS_TWO_POINT_OH_USERS_INDEX = ''
 ADS_TWO_POINT_OH_MIRROR = 'adsabs.harvard.edu'
+# Per-process cache of library files, bounded by the bytes of their JSON,
+# which is what is kept in memory (they are decoded on each hit)
+ADS_TWO_POINT_OH_LIBRARY_CACHE_BYTES = 64 * 1024 * 1024
+ADS_TWO_POINT_OH_LIBRARY_CACHE_TTL = 60 * 60
+# Stream library files from S3 to the client as is, rather than decoding and
+# re-encoding them (bypasses the cache)
+ADS_TWO_POINT_OH_LIBRARY_PASSTHROUGH = False
+ADS_TWO_POINT_OH_LIBRARY_CHUNK_SIZE = 64 * 1024
+# The bulk libraries end point takes up to ADS_TWO_POINT_OH_BULK_MAX_UIDS
+# users, and fetches their library files with a pool of
+# ADS_TWO_POINT_OH_BULK_WORKERS threads shared by the requests of a process.
+# Keep this at most HARBOUR_S3_MAX_POOL_CONNECTIONS.
+ADS_TWO_POINT_OH_BULK_MAX_UIDS = 1000
+ADS_TWO_POINT_OH_BULK_WORKERS = 8
 
 SQLALCHEMY_BINDS = {'harbour': ''}
+# Connection pool of each process to the database: SQLALCHEMY_POOL_SIZE
+# connections kept open, and up to SQLALCHEMY_MAX_OVERFLOW more under load.
+# Connections are replaced after SQLALCHEMY_POOL_RECYCLE seconds, and tested as
+# they are checked out if HARBOUR_DB_POOL_PRE_PING, so that none is used after
+# a failover of the database. A request that waits more than
+# SQLALCHEMY_POOL_TIMEOUT seconds for a connection fails.
+SQLALCHEMY_POOL_SIZE = 5
+SQLALCHEMY_MAX_OVERFLOW = 10
+SQLALCHEMY_POOL_RECYCLE = 1800
+SQLALCHEMY_POOL_TIMEOUT = 10
+HARBOUR_DB_POOL_PRE_PING = True
+
+# Per-process cache of the users rows, by absolute_uid. An entry is dropped by
+# the process that handles a successful /auth/*, and otherwise expires after
+# HARBOUR_USERS_CACHE_TTL seconds (HARBOUR_USERS_CACHE_MISSING_TTL for uids
+# without a row), which bounds how long other processes may serve an old row
+HARBOUR_USERS_CACHE_BYTES = 4 * 1024 * 1024
+HARBOUR_USERS_CACHE_TTL = 60
+HARBOUR_USERS_CACHE_MISSING_TTL = 10
+
+# S3 client of each process
+HARBOUR_S3_MAX_POOL_CONNECTIONS = 10
+HARBOUR_S3_CONNECT_TIMEOUT = 5
+HARBOUR_S3_READ_TIMEOUT = 30
+HARBOUR_S3_MAX_ATTEMPTS = 5
+HARBOUR_S3_RETRY_MODE = 'adaptive'
 
 HARBOUR_SERVICE_ADSWS_API_TOKEN = ''
 HARBOUR_EXPORT_SERVICE_URL = 'http://fakeapi.adsabs.harvard.edu/v1/export'
 HARBOUR_EXPORT_TYPES = ['zotero', 'mendeley']
+# Presigned export URLs are reused while they are valid for at least
+# HARBOUR_EXPORT_URL_MIN_VALIDITY seconds. They are shared by the workers of
+# a host if HARBOUR_EXPORT_URL_CACHE_DIR is set, eg., '/tmp/harbour.urls'
+HARBOUR_EXPORT_URL_EXPIRES_IN = 1800
+HARBOUR_EXPORT_URL_MIN_VALIDITY = 300
+HARBOUR_EXPORT_URL_CACHE_DIR = ''
+# Seconds between listings of the bucket to find which exports exist, 0 to
+# hand out URLs without checking
+HARBOUR_EXPORT_INDEX_INTERVAL = 600
+# Concurrent fetches of the same ADS Classic libraries or S3 file are shared
+# within each process, and also by the processes of a host if this is set to
+# a directory for their lock and result files, eg., '/tmp/harbour.flights'.
+# The results hold user data, and are removed after HARBOUR_SINGLE_FLIGHT_TTL
+# seconds, as are the lock files not in use.
+HARBOUR_SINGLE_FLIGHT_DIR = ''
+HARBOUR_SINGLE_FLIGHT_TTL = 10
 
 ENVIRONMENT = os.getenv('ENVIRONMENT', 'staging').lower()
 HARBOUR_LOGGING = {
@@ -0,0 +1,245 @@
+"""
+Connection pool of the harbour database
+
+Each process keeps a pool of connections to the database: SQLALCHEMY_POOL_SIZE
+connections kept open, up to SQLALCHEMY_MAX_OVERFLOW more under load, each
+replaced after SQLALCHEMY_POOL_RECYCLE seconds, and requests wait at most
+SQLALCHEMY_POOL_TIMEOUT seconds for one. The pool times how long requests wait
+for a connection to be free, and counts those that time out. Opening a
+connection, and testing it, are timed separately, so that a slow database
+shows apart from a pool too small for the load. Connections invalidated are
+counted too.
+
+With HARBOUR_DB_POOL_PRE_PING, each connection is tested as it is checked out,
+so that one left stale by a failover of the database is replaced rather than
+failing the request that gets it. SQLAlchemy 1.0 has no pool_pre_ping, this is
+its recipe for pessimistic disconnect handling.
+"""
+import time
+import bisect
+import threading
+
+from flask.ext.sqlalchemy import SQLAlchemy
+from sqlalchemy import event, exc
+from sqlalchemy.pool import QueuePool
+
+# Upper bounds, in seconds, of the buckets of the wait time histogram
+WAIT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+# Options of create_engine that only a queue of connections takes
+QUEUE_OPTIONS = ('pool_size', 'max_overflow', 'pool_timeout')
+
+
+class PoolStats(object):
+    """
+    Counters of a connection pool, kept when the pool is recreated
+    """
+    def __init__(self):
+        self.waits = [0] * (len(WAIT_BUCKETS) + 1)
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self.timeouts = 0
+        self.connects = 0
+        self.connect_seconds = 0.0
+        self.max_connect_seconds = 0.0
+        self.invalidations = 0
+        self.pings = 0
+        self.ping_seconds = 0.0
+        self.max_ping_seconds = 0.0
+        self.ping_failures = 0
+
+        self._lock = threading.Lock()
+
+    def waited(self, seconds, timed_out=False):
+        """
+        Record the time waited for a connection of the pool to be free
+        :param seconds: time waited, not counting the time taken to open a
+        connection
+        :param timed_out: True if no connection was free in time
+        """
+        with self._lock:
+            self.waits[bisect.bisect_left(WAIT_BUCKETS, seconds)] += 1
+            self.wait_seconds += seconds
+            self.max_wait_seconds = max(self.max_wait_seconds, seconds)
+            self.timeouts += int(timed_out)
+
+    def connected(self, seconds):
+        """
+        Record a connection opened to the database
+        :param seconds: time taken to open it
+        """
+        with self._lock:
+            self.connects += 1
+            self.connect_seconds += seconds
+            self.max_connect_seconds = max(self.max_connect_seconds, seconds)
+
+    def invalidated(self, *args):
+        with self._lock:
+            self.invalidations += 1
+
+    def ping(self, dbapi_connection, connection_record, connection_proxy):
+        """
+        Test a connection as it is checked out. The pool invalidates it, and
+        opens a new one in its place, if the test fails.
+        """
+        start = time.time()
+        try:
+            cursor = dbapi_connection.cursor()
+            cursor.execute('SELECT 1')
+            cursor.close()
+        except Exception:
+            with self._lock:
+                self.ping_failures += 1
+            raise exc.DisconnectionError()
+
+        seconds = time.time() - start
+        with self._lock:
+            self.pings += 1
+            self.ping_seconds += seconds
+            self.max_ping_seconds = max(self.max_ping_seconds, seconds)
+
+    def stats(self):
+        """
+        Counters of the pool. The wait times are counted in buckets by their
+        upper bound, in seconds. The time taken to open and test connections
+        is totalled, to be divided by their count.
+        :return: dict
+        """
+        with self._lock:
+            return {
+                'waits': dict(zip(
+                    [str(bound) for bound in WAIT_BUCKETS] + ['+Inf'],
+                    self.waits
+                )),
+                'wait_seconds': self.wait_seconds,
+                'max_wait_seconds': self.max_wait_seconds,
+                'timeouts': self.timeouts,
+                'connects': self.connects,
+                'connect_seconds': self.connect_seconds,
+                'max_connect_seconds': self.max_connect_seconds,
+                'invalidations': self.invalidations,
+                'pings': self.pings,
+                'ping_seconds': self.ping_seconds,
+                'max_ping_seconds': self.max_ping_seconds,
+                'ping_failures': self.ping_failures
+            }
+
+
+class InstrumentedQueuePool(QueuePool):
+    """
+    QueuePool that times the waits for a free connection and the opening of
+    connections, counts the connections invalidated, and optionally tests
+    each connection as it is checked out
+    """
+    def __init__(self, creator, pre_ping=False, stats=None, **kw):
+        """
+        Constructor
+        :param creator: callable that opens a DBAPI connection
+        :param pre_ping: test connections as they are checked out
+        :param stats: PoolStats of the pool this one replaces, if any
+        :param kw: options of QueuePool
+        """
+        super(InstrumentedQueuePool, self).__init__(creator, **kw)
+        self.pre_ping = pre_ping
+
+        # A recreated pool is given the listeners of the one it replaces
+        if stats is None:
+            stats = PoolStats()
+            event.listen(self, 'invalidate', stats.invalidated)
+            if pre_ping:
+                event.listen(self, 'checkout', stats.ping)
+        self.stats = stats
+
+        # Every connection is opened through this, including those opened
+        # again after being invalidated
+        self._untimed_creator = self._invoke_creator
+        self._invoke_creator = self._timed_creator
+        self._waits = threading.local()
+
+    def _timed_creator(self, connection_record):
+        start = time.time()
+        try:
+            connection = self._untimed_creator(connection_record)
+        finally:
+            seconds = time.time() - start
+            if getattr(self._waits, 'start', None) is not None:
+                self._waits.connecting += seconds
+
+        self.stats.connected(seconds)
+        return connection
+
+    def _do_get(self):
+        waits = self._waits
+        if getattr(waits, 'start', None) is not None:
+            # QueuePool tries again when another thread took the connection
+            # or the overflow it was after, which is the same wait
+            return super(InstrumentedQueuePool, self)._do_get()
+
+        waits.start = time.time()
+        waits.connecting = 0.0
+        timed_out = False
+        try:
+            return super(InstrumentedQueuePool, self)._do_get()
+        except exc.TimeoutError:
+            timed_out = True
+            raise
+        finally:
+            self.stats.waited(
+                time.time() - waits.start - waits.connecting,
+                timed_out=timed_out
+            )
+            waits.start = None
+
+    def recreate(self):
+        self.logger.info('Pool recreating')
+        return self.__class__(
+            self._creator,
+            pool_size=self._pool.maxsize,
+            max_overflow=self._max_overflow,
+            timeout=self._timeout,
+            recycle=self._recycle,
+            echo=self.echo,
+            logging_name=self._orig_logging_name,
+            use_threadlocal=self._use_threadlocal,
+            reset_on_return=self._reset_on_return,
+            pre_ping=self.pre_ping,
+            stats=self.stats,
+            _dispatch=self.dispatch,
+            _dialect=self._dialect
+        )
+
+
+class PooledSQLAlchemy(SQLAlchemy):
+    """
+    Flask-SQLAlchemy, with instrumented connection pools
+    """
+    def apply_driver_hacks(self, app, info, options):
+        if info.drivername == 'sqlite':
+            # Flask-SQLAlchemy does not pool SQLite connections, unless given
+            # a pool size, which the pools it uses instead do not take
+            for option in QUEUE_OPTIONS:
+                options.pop(option, None)
+        else:
+            options.setdefault('poolclass', InstrumentedQueuePool)
+            options['pre_ping'] = app.config['HARBOUR_DB_POOL_PRE_PING']
+
+        super(PooledSQLAlchemy, self).apply_driver_hacks(app, info, options)
+
+
+def pool_stats(pool):
+    """
+    State and counters of a connection pool
+    :param pool: sqlalchemy.pool.Pool
+    :return: dict
+    """
+    stats = {'class': pool.__class__.__name__}
+    if isinstance(pool, QueuePool):
+        stats.update({
+            'size': pool.size(),
+            'checked_in': pool.checkedin(),
+            'checked_out': pool.checkedout(),
+            'overflow': max(pool.overflow(), 0)
+        })
+    if isinstance(pool, InstrumentedQueuePool):
+        stats.update(pool.stats.stats())
+    return stats
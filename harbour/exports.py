@@ -0,0 +1,91 @@
+"""
+Index of the ADS 2.0 export files that exist in S3.
+
+Exports are zip files next to the library files, named
+"<library>.<export type>.zip". Knowing which of them exist means users can be
+told straight away when there is nothing to download, rather than being
+handed a URL that S3 will answer with a 404.
+"""
+import time
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class ExportIndex(object):
+    """
+    Library file names that have an export, by export type. The index is
+    rebuilt as a whole and swapped in, so lookups never see a partial index.
+    """
+    def __init__(self, export_types):
+        """
+        Constructor
+        :param export_types: export types to index, eg., ['zotero']
+        """
+        self.export_types = export_types
+        self.built = None
+
+        self._exports = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        exports = self._exports or {}
+        return sum(len(names) for names in exports.values())
+
+    def build(self, keys):
+        """
+        Replace the index with the exports found in a listing of the bucket
+        :param keys: iterable of all the keys in the bucket
+        """
+        exports = {export: set() for export in self.export_types}
+        for key in keys:
+            parts = key.rsplit('.', 2)
+            if len(parts) == 3 and parts[2] == 'zip' and parts[1] in exports:
+                exports[parts[1]].add(self._name(parts[0]))
+
+        exports = {
+            export: frozenset(names) for export, names in exports.items()
+        }
+        with self._lock:
+            self._exports = exports
+            self.built = time.time()
+
+    @staticmethod
+    def _name(name):
+        # Interned, as the same library names occur for every type. Only
+        # byte strings can be, names that are not ASCII are kept as they are.
+        try:
+            return intern(str(name))
+        except UnicodeEncodeError:
+            logger.warning('Export of a library with a non-ASCII name: {0!r}'
+                           .format(name))
+            return name
+
+    def available(self, library_file_name, export):
+        """
+        Whether an export exists for a library
+        :param library_file_name: name of the library file, eg., 'a.json'
+        :param export: export type
+
+        :return: True or False, or None if the index has not been built yet
+        """
+        exports = self._exports
+        if exports is None:
+            return None
+
+        name = library_file_name.rsplit('.json', 1)[0]
+        return name in exports.get(export, ())
+
+    def stats(self):
+        """
+        Size and age of the index
+        :return: dict
+        """
+        exports = self._exports or {}
+        return {
+            'built': self.built,
+            'exports': {
+                export: len(names) for export, names in exports.items()
+            }
+        }
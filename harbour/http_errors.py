@@ -30,7 +30,7 @@ CLASSIC_UNKNOWN_ERROR = dict(
 )
 
 CLASSIC_TIMEOUT = dict(
-    message='Classic ADS end point timed out before it could respond (> 30s)',
+    message='Classic ADS end point timed out before it could respond',
     code=504
 )
 
@@ -54,6 +54,26 @@ TWOPOINTOH_AWS_PROBLEM = dict(
     code=500
 )
 
+TWOPOINTOH_USERS_NOT_READY = dict(
+    message='The ADS 2.0 users have not been loaded yet',
+    code=503
+)
+
+TWOPOINTOH_EXPORT_NOT_AVAILABLE = dict(
+    message='This export is not available for this user',
+    code=404
+)
+
+BULK_DATA_MALFORMED = dict(
+    message='A non-empty list of integer uids is required',
+    code=400
+)
+
+BULK_TOO_MANY_UIDS = dict(
+    message='Too many uids were requested at once',
+    code=400
+)
+
 EXPORT_SERVICE_FAIL = dict(
     message='Unknown failure from export-service',
     code=500
@@ -7,9 +7,9 @@ PROJECT_HOME = os.path.abspath(
     os.path.join(os.path.dirname(__file__), '..'))
 sys.path.append(PROJECT_HOME)
 
-from flask.ext.script import Manager, Command
+from flask.ext.script import Manager, Command, Option
 from flask.ext.migrate import Migrate, MigrateCommand
-from models import db
+from models import db, select_users_by_email
 from harbour.app import create_app
 
 # Load the app with the factory
@@ -31,6 +31,35 @@ class CreateDatabase(Command):
             db.session.commit()
 
 
+class FindUsers(Command):
+    """
+    Finds the users with an ADS Classic or ADS 2.0 e-mail, regardless of case
+    """
+    option_list = (
+        Option('email', help='e-mail to look for'),
+        Option('--twopointoh', action='store_true', default=False,
+               help='look for an ADS 2.0 rather than ADS Classic e-mail')
+    )
+
+    @staticmethod
+    def run(email, twopointoh=False, app=app):
+        """
+        Prints the users found, without their cookies
+        :return: list of UserRecord
+        """
+        with app.app_context():
+            users = select_users_by_email(
+                email,
+                'twopointoh_email' if twopointoh else 'classic_email'
+            )
+
+        for user in users:
+            print(user._replace(
+                classic_cookie='*' * len(user.classic_cookie or '')
+            ))
+        return users
+
+
 # Set up the alembic migration
 migrate = Migrate(app, db, compare_type=True)
 
@@ -38,6 +67,7 @@ migrate = Migrate(app, db, compare_type=True)
 manager = Manager(app)
 manager.add_command('db', MigrateCommand)
 manager.add_command('createdb', CreateDatabase())
+manager.add_command('findusers', FindUsers())
 
 if __name__ == '__main__':
     manager.run()
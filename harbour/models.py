@@ -4,9 +4,21 @@ The database is not initiated here, but a pointer is created named db. This is
 to be passed to the app creator within the Flask blueprint.
 """
 
-from flask.ext.sqlalchemy import SQLAlchemy
+from collections import namedtuple
+from sqlalchemy import text, select, bindparam, func
+from dbpool import PooledSQLAlchemy
 
-db = SQLAlchemy()
+db = PooledSQLAlchemy()
+
+# The fields of a Users row, detached from the session so that it can be
+# cached and shared between requests
+UserRecord = namedtuple('UserRecord', [
+    'absolute_uid',
+    'classic_email',
+    'classic_mirror',
+    'classic_cookie',
+    'twopointoh_email'
+])
 
 
 class Users(db.Model):
@@ -24,6 +36,62 @@ class Users(db.Model):
     classic_cookie = db.Column(db.String, default='')
     twopointoh_email = db.Column(db.String, default='')
 
+    def record(self):
+        """
+        The fields of this row
+        :return: UserRecord
+        """
+        return UserRecord(
+            self.absolute_uid,
+            self.classic_email,
+            self.classic_mirror,
+            self.classic_cookie,
+            self.twopointoh_email
+        )
+
+    @classmethod
+    def upsert(cls, absolute_uid, **fields):
+        """
+        Create the row of a user, or update the given fields of the row they
+        already have, in a single statement. Concurrent first logins of the
+        same user cannot then both try to insert it. Needs PostgreSQL 9.5+
+        (or SQLite 3.35+). The caller commits.
+        :param absolute_uid: user ID for the API
+        :param fields: values of the columns to set, eg., classic_email
+        :return: UserRecord of the row as stored
+        """
+        # Columns are named in the statement, so only known ones are allowed
+        unknown = set(fields) - set(UserRecord._fields[1:])
+        if unknown:
+            raise ValueError(
+                'Unknown columns: {0}'.format(', '.join(sorted(unknown)))
+            )
+
+        # New rows get the same defaults as through the ORM
+        values = {column: '' for column in UserRecord._fields[1:]}
+        values.update(fields, absolute_uid=absolute_uid)
+
+        statement = text(
+            'INSERT INTO {table} ({columns}) VALUES ({values}) '
+            'ON CONFLICT (absolute_uid) DO UPDATE SET {updates} '
+            'RETURNING {columns}'.format(
+                table=cls.__tablename__,
+                columns=', '.join(UserRecord._fields),
+                values=', '.join(
+                    ':{0}'.format(column) for column in UserRecord._fields
+                ),
+                updates=', '.join(
+                    '{0} = excluded.{0}'.format(column)
+                    for column in sorted(fields)
+                )
+            )
+        )
+
+        row = db.session.execute(
+            statement, values, mapper=cls.__mapper__
+        ).fetchone()
+        return UserRecord(*row)
+
     def __repr__(self):
         return '<' \
                'User: id {0}, ' \
@@ -39,3 +107,80 @@ class Users(db.Model):
                     self.classic_email,
                     self.classic_mirror,
                     self.twopointoh_email)
+
+
+# E-mails are looked up regardless of case, so the indexes are on their lower
+# case (see select_users_by_email)
+db.Index('ix_users_lower_classic_email', func.lower(Users.classic_email))
+db.Index('ix_users_lower_twopointoh_email', func.lower(Users.twopointoh_email))
+
+# Compiled SELECTs of the users rows, by dialect and number of user IDs
+_compiled_selects = {}
+
+
+def select_users(absolute_uids):
+    """
+    Read-only lookup of the users rows of many users. This is a Core SELECT,
+    compiled once per number of user IDs and then reused, rather than an ORM
+    query, which would build a Query, compile it, and track the instances it
+    returns on every call. The user IDs are padded to the next power of two,
+    so that only a handful of statements are ever compiled.
+    :param absolute_uids: user IDs for the API
+    :return: list of UserRecord, for the user IDs that have a row
+    """
+    if not absolute_uids:
+        return []
+
+    size = 1
+    while size < len(absolute_uids):
+        size *= 2
+    padded = list(absolute_uids) + \
+        [absolute_uids[-1]] * (size - len(absolute_uids))
+
+    connection = db.session.connection(mapper=Users.__mapper__)
+    key = (connection.dialect.name, size)
+    compiled = _compiled_selects.get(key)
+    if compiled is None:
+        table = Users.__table__
+        statement = select(
+            [table.c[column] for column in UserRecord._fields]
+        ).where(table.c.absolute_uid.in_(
+            [bindparam('uid{0}'.format(i)) for i in range(size)]
+        ))
+        compiled = _compiled_selects[key] = \
+            statement.compile(dialect=connection.dialect)
+
+    rows = connection.execute(compiled, {
+        'uid{0}'.format(i): absolute_uid
+        for i, absolute_uid in enumerate(padded)
+    })
+    return [UserRecord(*row) for row in rows]
+
+
+def select_users_by_email(email, column='classic_email'):
+    """
+    Read-only lookup of the users rows with an e-mail, regardless of case, eg.,
+    for support or to find the users of a library file. This uses the index
+    on the lower case of the column, rather than scanning the table.
+    :param email: e-mail to look for
+    :param column: 'classic_email' or 'twopointoh_email'
+    :return: list of UserRecord
+    """
+    if column not in ('classic_email', 'twopointoh_email'):
+        raise ValueError('Users are not looked up by {0}'.format(column))
+
+    connection = db.session.connection(mapper=Users.__mapper__)
+    key = (connection.dialect.name, column)
+    compiled = _compiled_selects.get(key)
+    if compiled is None:
+        table = Users.__table__
+        statement = select(
+            [table.c[name] for name in UserRecord._fields]
+        ).where(
+            func.lower(table.c[column]) == func.lower(bindparam('email'))
+        )
+        compiled = _compiled_selects[key] = \
+            statement.compile(dialect=connection.dialect)
+
+    rows = connection.execute(compiled, {'email': email})
+    return [UserRecord(*row) for row in rows]
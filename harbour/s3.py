@@ -0,0 +1,181 @@
+"""
+Access to S3
+
+All S3 calls go through one client per process. It is created on first use
+after any fork (clients and their connection pools cannot be shared with a
+parent process), and then reused by every thread, so that credentials are
+resolved and TLS connections opened once rather than on every request.
+"""
+import os
+import time
+import boto3
+import logging
+import threading
+
+from botocore.client import Config
+from botocore.exceptions import BotoCoreError
+
+logger = logging.getLogger(__name__)
+
+
+class S3(object):
+    """
+    Flask extension that holds the S3 client of the process, and times every
+    call made with it
+    """
+    def __init__(self, app=None):
+        """
+        Constructor
+        :param app: flask.Flask application instance
+        """
+        self.options = {}
+        self.timings = {}
+
+        self._pid = None
+        self._client = None
+        self._lock = threading.Lock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """
+        Register the extension with the application
+        :param app: flask.Flask application instance
+        """
+        self.options = dict(
+            max_pool_connections=app.config['HARBOUR_S3_MAX_POOL_CONNECTIONS'],
+            connect_timeout=app.config['HARBOUR_S3_CONNECT_TIMEOUT'],
+            read_timeout=app.config['HARBOUR_S3_READ_TIMEOUT'],
+            retries={
+                'max_attempts': app.config['HARBOUR_S3_MAX_ATTEMPTS'],
+                'mode': app.config['HARBOUR_S3_RETRY_MODE']
+            }
+        )
+        app.extensions['s3'] = self
+
+    def _client_config(self):
+        """
+        Client configuration. The connection pool, timeouts and retry modes
+        need botocore 1.15 or later (see requirements.txt); an older botocore
+        ignores all of the HARBOUR_S3_* options.
+        """
+        try:
+            return Config(**self.options)
+        except (TypeError, BotoCoreError):
+            logger.exception(
+                'This botocore does not support the S3 client options, the '
+                'HARBOUR_S3_* settings are IGNORED and its defaults used: '
+                '{0}'.format(self.options)
+            )
+            return None
+
+    @property
+    def client(self):
+        """
+        The S3 client of this process
+        """
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    session = boto3.session.Session()
+                    self._client = session.client(
+                        's3',
+                        config=self._client_config()
+                    )
+                    self._pid = os.getpid()
+
+        return self._client
+
+    def _record(self, operation, start, failed):
+        elapsed = time.time() - start
+        with self._lock:
+            timing = self.timings.setdefault(
+                operation,
+                {'calls': 0, 'errors': 0, 'total_seconds': 0.0,
+                 'max_seconds': 0.0}
+            )
+            timing['calls'] += 1
+            timing['errors'] += int(failed)
+            timing['total_seconds'] += elapsed
+            timing['max_seconds'] = max(timing['max_seconds'], elapsed)
+
+        logger.debug('S3 {0} took {1:.1f} ms{2}'.format(
+            operation, elapsed * 1000, ' and failed' if failed else ''
+        ))
+
+    def call(self, operation, **kwargs):
+        """
+        Call an operation of the S3 client, and time it. For GETs this is the
+        time to the first byte, reading the body is up to the caller.
+        :param operation: name of the client method, eg., 'get_object'
+        :param kwargs: arguments of the operation
+
+        :return: response of the operation
+        """
+        start, failed = time.time(), True
+        try:
+            response = getattr(self.client, operation)(**kwargs)
+            failed = False
+            return response
+        finally:
+            self._record(operation, start, failed)
+
+    def get_object(self, bucket, key, **kwargs):
+        return self.call('get_object', Bucket=bucket, Key=key, **kwargs)
+
+    def head_object(self, bucket, key, **kwargs):
+        return self.call('head_object', Bucket=bucket, Key=key, **kwargs)
+
+    def iter_keys(self, bucket, prefix='', page_size=1000):
+        """
+        Keys of all of the objects in a bucket, fetched a page at a time
+        :param bucket: name of the bucket
+        :param prefix: only keys that start with this
+        :param page_size: number of keys per ListObjects call
+
+        :return: iterator of keys
+        """
+        marker = ''
+        while True:
+            response = self.call(
+                'list_objects',
+                Bucket=bucket,
+                Prefix=prefix,
+                Marker=marker,
+                MaxKeys=page_size
+            )
+            contents = response.get('Contents', [])
+            for content in contents:
+                yield content['Key']
+
+            if not response.get('IsTruncated') or not contents:
+                return
+            marker = response.get('NextMarker') or contents[-1]['Key']
+
+    def generate_presigned_url(self, bucket, key, expires_in):
+        """
+        Temporary URL to download an object
+        :param bucket: name of the bucket
+        :param key: key of the object
+        :param expires_in: seconds the URL is valid for
+
+        :return: URL
+        """
+        return self.call(
+            'generate_presigned_url',
+            ClientMethod='get_object',
+            Params={'Bucket': bucket, 'Key': key},
+            ExpiresIn=expires_in
+        )
+
+    def stats(self):
+        """
+        Timings of the S3 calls made by this process, by operation
+        :return: dict
+        """
+        with self._lock:
+            return {
+                operation: dict(timing)
+                for operation, timing in self.timings.items()
+            }
@@ -0,0 +1,90 @@
+"""
+Serving modes
+
+threaded (the default): every request holds a thread for as long as it is
+served, including all of the time it spends waiting on an ADS Classic mirror
+or on S3.
+
+gevent: the same application, end points and responses, with the standard
+library patched so that a request waiting on a socket yields to the others.
+A process can then keep hundreds of upstream calls in flight, each costing a
+greenlet rather than a thread. The caps on concurrent requests per mirror
+(ADS_CLASSIC_MAX_CONCURRENCY) and the connection pools (ADS_CLASSIC_POOL_*,
+HARBOUR_S3_MAX_POOL_CONNECTIONS) still apply, and are worth raising in this
+mode.
+
+The mode is chosen with the HARBOUR_SERVING_MODE environment variable rather
+than the configuration, as gevent has to patch the standard library before
+the application, or anything it uses, is imported. gevent, and psycogreen to
+make the database queries cooperative too, are only needed in gevent mode:
+
+    pip install -r gevent-requirements.txt
+    HARBOUR_SERVING_MODE=gevent python wsgi.py
+
+Under gunicorn, use its gevent worker class instead, and serve wsgi:application.
+"""
+import os
+import warnings
+
+THREADED = 'threaded'
+GEVENT = 'gevent'
+MODES = (THREADED, GEVENT)
+
+
+def serving_mode():
+    """
+    The serving mode chosen for this process
+    :return: one of MODES
+    """
+    mode = os.environ.get('HARBOUR_SERVING_MODE', THREADED)
+    if mode not in MODES:
+        raise ValueError(
+            'HARBOUR_SERVING_MODE should be one of {0}, not "{1}"'
+            .format(', '.join(MODES), mode)
+        )
+    return mode
+
+
+def patch(mode):
+    """
+    Prepare the process for a serving mode. This must be called before the
+    application is imported.
+    :param mode: one of MODES
+    """
+    if mode != GEVENT:
+        return
+
+    from gevent import monkey
+    monkey.patch_all()
+
+    try:
+        from psycogreen.gevent import patch_psycopg
+    except ImportError:
+        warnings.warn(
+            'psycogreen is not installed: database queries will block the '
+            'other requests of the process while they run'
+        )
+    else:
+        patch_psycopg()
+
+
+def serve(application, host, port, connections=None):
+    """
+    Serve the application on gevent's WSGI server
+    :param application: WSGI application
+    :param host: address to listen on
+    :param port: port to listen on
+    :param connections: most requests served at once, by default
+    HARBOUR_SERVING_CONNECTIONS from the environment
+    """
+    from gevent.pool import Pool
+    from gevent.pywsgi import WSGIServer
+
+    if connections is None:
+        connections = int(os.environ.get('HARBOUR_SERVING_CONNECTIONS', 1000))
+
+    WSGIServer(
+        (host, port),
+        application,
+        spawn=Pool(connections)
+    ).serve_forever()
@@ -0,0 +1,179 @@
+"""
+Coalescing of identical upstream fetches.
+
+Callers that ask for the same thing at the same time share a single call:
+the first one makes it, and the others wait for its result. Within a process
+this is done with threads. Across the processes of a host, if a directory is
+given, the call is made under a lock file, and its result left next to the
+lock for the processes that were waiting on it. The results hold user data,
+eg., their ADS Classic libraries, so they are swept away once the waiting
+processes have had the time to read them, along with the lock files.
+"""
+import os
+import json
+import time
+import hashlib
+import logging
+import tempfile
+import threading
+
+from users_index import host_lock, remove_host_lock
+
+logger = logging.getLogger(__name__)
+
+
+class Flight(object):
+    """
+    A call in progress, and then its outcome
+    """
+    __slots__ = ['done', 'value', 'error']
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """
+    Makes at most one call at a time per key, sharing its result with the
+    callers that asked for the same key in the meantime
+    """
+    def __init__(self, directory=None, ttl=10):
+        """
+        Constructor
+        :param directory: directory for the lock and result files shared with
+        the other processes of the host, None to only coalesce within the
+        process
+        :param ttl: seconds after which results are removed by sweep
+        """
+        self.directory = directory
+        self.ttl = ttl
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self._flights = {}
+        self._lock = threading.Lock()
+
+        self.calls = 0
+        self.coalesced = 0
+        self.shared = 0
+        self.swept = 0
+
+    def do(self, key, function):
+        """
+        Call function, or wait for the call already in progress for this key
+        :param key: tuple identifying what function fetches, eg., the S3
+        bucket and key
+        :param function: callable that takes no arguments, its result must be
+        JSON serialisable to be shared with other processes
+
+        :return: result of the call
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = Flight()
+                self.calls += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        try:
+            flight.value = self._call(key, function)
+            return flight.value
+        except Exception as error:
+            flight.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+    def _call(self, key, function):
+        if not self.directory:
+            return function()
+
+        path = os.path.join(
+            self.directory,
+            hashlib.sha1(json.dumps(key)).hexdigest()
+        )
+        result_path = '{0}.json'.format(path)
+
+        start = time.time()
+        with host_lock(path):
+            # Another process may have made the call while this one waited
+            result = self._read(result_path)
+            if result is not None and result['time'] >= start:
+                self.shared += 1
+                return result['value']
+
+            value = function()
+            self._write(result_path, value)
+            return value
+
+    @staticmethod
+    def _read(path):
+        try:
+            with open(path, 'rb') as result_file:
+                return json.load(result_file)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def _write(self, path, value):
+        # Written to a temporary file and renamed, so readers never see a
+        # partial result
+        handle, tmp_path = tempfile.mkstemp(dir=self.directory, prefix='.')
+        try:
+            with os.fdopen(handle, 'wb') as result_file:
+                json.dump({'time': time.time(), 'value': value}, result_file)
+            os.rename(tmp_path, path)
+        except (TypeError, ValueError, IOError, OSError) as error:
+            os.remove(tmp_path)
+            logger.warning('Could not share the result of {0}: {1}'
+                           .format(os.path.basename(path), error))
+
+    def sweep(self):
+        """
+        Remove the results older than ttl, and the lock files that no process
+        holds, from the directory
+
+        :return: number of files removed
+        """
+        if not self.directory:
+            return 0
+
+        removed = 0
+        expired = time.time() - self.ttl
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                if name.endswith('.lock'):
+                    removed += remove_host_lock(path[:-len('.lock')])
+                elif os.path.getmtime(path) < expired:
+                    os.remove(path)
+                    removed += 1
+            except (IOError, OSError):
+                # Removed by another process in the meantime
+                pass
+
+        self.swept += removed
+        return removed
+
+    def stats(self):
+        """
+        Counters of the calls
+        :return: dict
+        """
+        return {
+            'calls': self.calls,
+            'coalesced': self.coalesced,
+            'shared': self.shared,
+            'swept': self.swept
+        }
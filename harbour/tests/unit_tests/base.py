@@ -1,10 +1,12 @@
 """
 Base properties for all of the unit tests that are shared between each file
 """
+import mock
 import testing.postgresql
 
 from flask.ext.testing import TestCase
 from harbour import app
+from harbour.app import load_config
 
 from harbour.models import db
 
@@ -13,11 +15,30 @@ class TestBase(TestCase):
     """
     Base class, bear minimal
     """
+    # Configuration applied over config.py before the application registers
+    # its background tasks: those that reach out to S3 or ADS Classic are off,
+    # and the tests that need them run them explicitly
+    config = {
+        'ADS_CLASSIC_PROBE_INTERVAL': 0,
+        'HARBOUR_EXPORT_INDEX_INTERVAL': 0
+    }
+
+    def helper_create_app(self):
+        """
+        Create the application with the test configuration
+        """
+        def test_config(app_):
+            load_config(app_)
+            app_.config.update(self.config)
+
+        with mock.patch('harbour.app.load_config', test_config):
+            return app.create_app()
+
     def create_app(self):
         """
         Create the wsgi application
         """
-        app_ = app.create_app()
+        app_ = self.helper_create_app()
         app_.config['CLASSIC_LOGGING'] = {}
         app_.config['SQLALCHEMY_BINDS'] = {}
         app_.config['ADS_CLASSIC_MIRROR_LIST'] = [
@@ -3,6 +3,8 @@
 Mock responses to be used with HTTMock
 """
 
+import json
+
 from httmock import urlmatch
 from stub_data import stub_classic_success, stub_classic_unknown_user, \
     stub_classic_wrong_password, stub_classic_no_cookie, \
@@ -26,6 +28,16 @@ def ads_classic_libraries_200(url, request):
     }
 
 
+@urlmatch(netloc=r'(.*\.)?mirror\.com')
+def ads_classic_libraries_200_with_length(url, request):
+    content = json.dumps(stub_classic_libraries_success)
+    return {
+        'status_code': 200,
+        'content': content,
+        'headers': {'Content-Length': str(len(content))}
+    }
+
+
 @urlmatch(netloc=r'(.*\.)?mirror\.com')
 def ads_classic_unknown_user(url, request):
     return {
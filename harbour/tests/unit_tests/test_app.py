@@ -2,13 +2,19 @@
 Test webservices
 """
 
+import os
 import mock
 import json
 import boto3
+import shutil
+import tempfile
+import threading
 
 from unittest import TestCase
 from moto import mock_s3
-from harbour.app import create_app
+from botocore.exceptions import ClientError
+from harbour.app import create_app, load_s3, load_config, lazy_loader
+from harbour.users_index import UsersIndex, write_users_index
 
 
 class TestApp(TestCase):
@@ -44,15 +50,169 @@ class TestApp(TestCase):
             stub_mongogut_users
         )
 
-    @mock.patch('harbour.app.boto3.resource')
-    def test_load_s3_create_app_mongo_load_success(self, mock_resource):
+    @mock.patch('harbour.s3.S3.get_object')
+    def test_load_s3_create_app_mongo_load_success(self, mock_get):
         """
         Test that when the application is created, that the mongo user data
         is loaded from s3, if available.
         """
-        mock_resource.side_effect = Exception
+        mock_get.side_effect = Exception
 
         app = create_app()
 
         self.assertFalse(app.config['ADS_TWO_POINT_OH_LOADED_USERS'])
         self.assertEqual(app.config['ADS_TWO_POINT_OH_USERS'], {})
+
+    @mock_s3
+    def test_load_s3_into_shared_users_index(self):
+        """
+        Test that when a users index path is configured, the mongo user data
+        is loaded into the memory-mapped index rather than a dictionary
+        """
+        stub_mongogut_users = {
+            'user@ads.com': 'cb16a523-cdba-406b-bfff-edfd428248be.json'
+        }
+
+        s3_resource = boto3.resource('s3')
+        s3_resource.create_bucket(Bucket='adsabs-mongogut')
+        bucket = s3_resource.Bucket('adsabs-mongogut')
+        bucket.put_object(
+            Key='users.json',
+            Body=json.dumps(stub_mongogut_users)
+        )
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+
+        app = create_app()
+        app.config['ADS_TWO_POINT_OH_USERS_INDEX'] = \
+            os.path.join(directory, 'users.idx')
+        load_s3(app)
+
+        users = app.config['ADS_TWO_POINT_OH_USERS']
+        self.assertTrue(app.config['ADS_TWO_POINT_OH_LOADED_USERS'])
+        self.assertIsInstance(users, UsersIndex)
+        self.assertEqual(dict(users.items()), stub_mongogut_users)
+
+    @mock.patch('harbour.s3.S3.get_object')
+    def test_load_s3_does_not_reload_unchanged_users(self, mock_get):
+        """
+        Test that the users refresher asks S3 for users.json only if it has
+        changed, and keeps the users it has when it has not.
+        """
+        mock_get.side_effect = Exception
+        app = create_app()
+
+        stub_mongogut_users = {'user@ads.com': 'library.json'}
+        app.config['ADS_TWO_POINT_OH_USERS'] = stub_mongogut_users
+        app.config['ADS_TWO_POINT_OH_USERS_ETAG'] = '"etag"'
+        app.config['ADS_TWO_POINT_OH_LOADED_USERS'] = True
+
+        mock_get.reset_mock()
+        mock_get.side_effect = ClientError(
+            {'Error': {'Code': '304', 'Message': 'Not Modified'}},
+            'GetObject'
+        )
+
+        self.assertFalse(load_s3(app))
+        mock_get.assert_called_once_with(
+            'adsabs-mongogut',
+            'users.json',
+            IfNoneMatch='"etag"'
+        )
+        self.assertTrue(app.config['ADS_TWO_POINT_OH_LOADED_USERS'])
+        self.assertIs(
+            app.config['ADS_TWO_POINT_OH_USERS'],
+            stub_mongogut_users
+        )
+
+    @mock_s3
+    def test_load_s3_recovers_after_failing_on_start_up(self):
+        """
+        Test that if the users could not be loaded when the application was
+        created, the next refresh loads them.
+        """
+        with mock.patch('harbour.s3.S3.get_object') as mock_get:
+            mock_get.side_effect = Exception
+            app = create_app()
+        self.assertFalse(app.config['ADS_TWO_POINT_OH_LOADED_USERS'])
+
+        stub_mongogut_users = {
+            'user@ads.com': 'cb16a523-cdba-406b-bfff-edfd428248be.json'
+        }
+        s3_resource = boto3.resource('s3')
+        s3_resource.create_bucket(Bucket='adsabs-mongogut')
+        s3_resource.Bucket('adsabs-mongogut').put_object(
+            Key='users.json',
+            Body=json.dumps(stub_mongogut_users)
+        )
+
+        self.assertTrue(load_s3(app))
+        self.assertTrue(app.config['ADS_TWO_POINT_OH_LOADED_USERS'])
+        self.assertEqual(
+            app.config['ADS_TWO_POINT_OH_USERS'],
+            stub_mongogut_users
+        )
+
+    @mock.patch('harbour.app.load_s3')
+    def test_users_can_be_loaded_in_the_background(self, mock_load_s3):
+        """
+        Test that in background mode the application is created without
+        waiting for the ADS 2.0 users, which are loaded by a thread instead
+        """
+        loaded = threading.Event()
+        mock_load_s3.side_effect = lambda app: loaded.set()
+
+        def background_config(app):
+            load_config(app)
+            app.config['ADS_TWO_POINT_OH_USERS_LOAD'] = 'background'
+
+        with mock.patch('harbour.app.load_config', background_config):
+            app = create_app()
+
+        self.assertTrue(loaded.wait(5))
+        self.assertEqual(mock_load_s3.call_count, 1)
+        self.assertIsNotNone(
+            app.extensions['background_tasks'].tasks[0]
+        )
+
+    @mock.patch('harbour.app.load_s3')
+    def test_lazy_loader_loads_the_users_once(self, mock_load_s3):
+        """
+        Test that lazily loaded users are loaded on the first call only, later
+        attempts are left to the users refresher
+        """
+        app = mock.Mock()
+        load = lazy_loader(app)
+        self.assertFalse(mock_load_s3.called)
+
+        load()
+        load()
+        mock_load_s3.assert_called_once_with(app)
+
+    @mock.patch('harbour.s3.S3.call')
+    def test_users_are_served_from_the_snapshot_on_start_up(self, mock_call):
+        """
+        Test that the users index left on disk by a previous run is loaded
+        when the application is created, even if S3 cannot be reached
+        """
+        mock_call.side_effect = Exception('S3 is unreachable')
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        index_path = os.path.join(directory, 'users.idx')
+
+        stub_mongogut_users = {'user@ads.com': 'library.json'}
+        write_users_index(index_path, stub_mongogut_users.items(), '"etag"')
+
+        def snapshot_config(app):
+            load_config(app)
+            app.config['ADS_TWO_POINT_OH_USERS_INDEX'] = index_path
+
+        with mock.patch('harbour.app.load_config', snapshot_config):
+            app = create_app()
+
+        users = app.config['ADS_TWO_POINT_OH_USERS']
+        self.assertTrue(app.config['ADS_TWO_POINT_OH_LOADED_USERS'])
+        self.assertEqual(app.config['ADS_TWO_POINT_OH_USERS_ETAG'], '"etag"')
+        self.assertEqual(dict(users.items()), stub_mongogut_users)
@@ -0,0 +1,54 @@
+"""
+Test the periodic background tasks
+"""
+
+import mock
+import threading
+
+from unittest import TestCase
+from harbour.background import PeriodicTask
+
+
+class TestPeriodicTask(TestCase):
+    """
+    Test the periodic tasks that run in each worker
+    """
+
+    def test_task_calls_the_function_periodically(self):
+        """
+        Test that the function is called repeatedly once the task is running,
+        and that failures do not stop the task
+        """
+        called = threading.Event()
+        calls = []
+
+        def function():
+            calls.append(1)
+            if len(calls) == 1:
+                raise Exception('First call fails')
+            called.set()
+
+        task = PeriodicTask(function, 0.01)
+        task.ensure_running()
+        self.addCleanup(task.stop)
+
+        self.assertTrue(called.wait(5))
+        self.assertGreaterEqual(len(calls), 2)
+
+    @mock.patch('harbour.background.threading.Thread')
+    @mock.patch('harbour.background.os.getpid')
+    def test_task_is_started_once_per_process(self, mock_getpid, mock_thread):
+        """
+        Test that the thread is started only once in each process, and again
+        in a forked child where the parent's thread does not exist
+        """
+        mock_getpid.return_value = 1
+        task = PeriodicTask(lambda: None, 60)
+
+        task.ensure_running()
+        task.ensure_running()
+        self.assertEqual(mock_thread.return_value.start.call_count, 1)
+
+        mock_getpid.return_value = 2
+        task.ensure_running()
+        self.assertEqual(mock_thread.return_value.start.call_count, 2)
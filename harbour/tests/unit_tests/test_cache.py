@@ -0,0 +1,223 @@
+"""
+Test the caches
+"""
+
+import sys
+import mock
+import shutil
+import tempfile
+import threading
+
+from unittest import TestCase
+from harbour.cache import LRUCache, PresignedUrlCache, FileBackend
+
+
+class TestLRUCache(TestCase):
+    """
+    Test the size bounded least recently used cache
+    """
+
+    def test_least_recently_used_entries_are_evicted_by_size(self):
+        """
+        Test that entries are evicted, least recently used first, once the
+        total size of the values would go over the limit
+        """
+        cache = LRUCache(max_bytes=10, ttl=60)
+        cache.set('a', 'value a', size=4)
+        cache.set('b', 'value b', size=4)
+
+        # Use a, so that b is the least recently used
+        self.assertEqual(cache.get('a'), 'value a')
+        cache.set('c', 'value c', size=4)
+
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 'value a')
+        self.assertEqual(cache.get('c'), 'value c')
+
+        stats = cache.stats()
+        self.assertEqual(stats['entries'], 2)
+        self.assertEqual(stats['bytes'], 8)
+        self.assertEqual(stats['evictions'], 1)
+        self.assertEqual(stats['hits'], 3)
+        self.assertEqual(stats['misses'], 1)
+
+    def test_values_larger_than_the_cache_are_not_cached(self):
+        """
+        Test that a value larger than the whole cache does not evict anything
+        """
+        cache = LRUCache(max_bytes=10, ttl=60)
+        cache.set('a', 'value a', size=4)
+        cache.set('b', 'value b', size=11)
+
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 'value a')
+
+    @mock.patch('harbour.cache.time.time')
+    def test_expired_entries_can_be_revalidated(self, mock_time):
+        """
+        Test that an expired entry is a miss, but is kept with its ETag so
+        that it can be revalidated and served again
+        """
+        mock_time.return_value = 1000
+        cache = LRUCache(max_bytes=10, ttl=60)
+        cache.set('a', 'value a', size=4, etag='"etag"')
+
+        mock_time.return_value = 1061
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.get_stale('a').etag, '"etag"')
+
+        self.assertEqual(cache.revalidated('a'), 'value a')
+        self.assertEqual(cache.get('a'), 'value a')
+        self.assertEqual(cache.stats()['revalidations'], 1)
+
+    @mock.patch('harbour.cache.time.time')
+    def test_entries_can_have_their_own_ttl(self, mock_time):
+        """
+        Test that an entry set with its own time to live expires after it,
+        rather than after that of the cache
+        """
+        mock_time.return_value = 1000
+        cache = LRUCache(max_bytes=10, ttl=60)
+        cache.set('a', 'value a', size=4, ttl=10)
+        cache.set('b', 'value b', size=4)
+
+        mock_time.return_value = 1011
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.get('b'), 'value b')
+
+    def test_entries_can_be_deleted(self):
+        """
+        Test that a deleted entry is gone, and no longer counts towards the
+        size of the cache
+        """
+        cache = LRUCache(max_bytes=10, ttl=60)
+        cache.set('a', 'value a', size=4)
+        cache.delete('a')
+        cache.delete('b')
+
+        self.assertIsNone(cache.get_stale('a'))
+        self.assertEqual(cache.stats()['bytes'], 0)
+
+    def test_only_one_refresh_at_a_time(self):
+        """
+        Test that the refresh of an entry can only be claimed once until it
+        has finished
+        """
+        cache = LRUCache(max_bytes=10, ttl=60)
+        self.assertTrue(cache.start_refresh('a'))
+        self.assertFalse(cache.start_refresh('a'))
+        self.assertTrue(cache.start_refresh('b'))
+
+        cache.end_refresh('a')
+        self.assertTrue(cache.start_refresh('a'))
+
+    def test_refreshes_at_once_can_be_limited(self):
+        """
+        Test that no more refreshes are claimed than the limit allows, until
+        one has finished
+        """
+        cache = LRUCache(max_bytes=10, ttl=60)
+        self.assertTrue(cache.start_refresh('a', limit=2))
+        self.assertTrue(cache.start_refresh('b', limit=2))
+        self.assertFalse(cache.start_refresh('c', limit=2))
+
+        cache.end_refresh('a')
+        self.assertTrue(cache.start_refresh('c', limit=2))
+
+
+class TestPresignedUrlCache(TestCase):
+    """
+    Test the cache of presigned URLs
+    """
+
+    def setUp(self):
+        self.generate = mock.Mock(
+            side_effect=lambda bucket, key, expires_in: 'https://{0}/{1}?{2}'
+            .format(bucket, key, self.generate.call_count)
+        )
+
+    @mock.patch('harbour.cache.time.time')
+    def test_url_is_reused_until_it_is_close_to_expiring(self, mock_time):
+        """
+        Test that the same URL is handed out while it is valid for at least
+        the minimum validity, and a new one is signed after that
+        """
+        cache = PresignedUrlCache(expires_in=1800, min_validity=300)
+
+        mock_time.return_value = 1000
+        url, expires_in = cache.get('bucket', 'key.zip', self.generate)
+        self.assertEqual(url, 'https://bucket/key.zip?1')
+        self.assertEqual(expires_in, 1800)
+        self.generate.assert_called_once_with('bucket', 'key.zip', 1800)
+
+        mock_time.return_value = 1000 + 1500
+        url, expires_in = cache.get('bucket', 'key.zip', self.generate)
+        self.assertEqual(url, 'https://bucket/key.zip?1')
+        self.assertEqual(expires_in, 300)
+
+        mock_time.return_value = 1000 + 1501
+        url, expires_in = cache.get('bucket', 'key.zip', self.generate)
+        self.assertEqual(url, 'https://bucket/key.zip?2')
+        self.assertEqual(expires_in, 1800)
+
+        self.assertEqual(cache.stats()['hits'], 1)
+        self.assertEqual(cache.stats()['misses'], 2)
+
+    def test_urls_are_cached_by_bucket_and_key(self):
+        """
+        Test that different objects get different URLs
+        """
+        cache = PresignedUrlCache(expires_in=1800, min_validity=300)
+
+        cache.get('bucket', 'a.zip', self.generate)
+        cache.get('bucket', 'b.zip', self.generate)
+        cache.get('other', 'a.zip', self.generate)
+        self.assertEqual(self.generate.call_count, 3)
+
+        url, _ = cache.get('bucket', 'b.zip', self.generate)
+        self.assertEqual(url, 'https://bucket/b.zip?2')
+
+    def test_concurrent_gets_are_all_counted(self):
+        """
+        Test that the hits and misses of threads getting URLs at the same time
+        add up to the URLs handed out
+        """
+        cache = PresignedUrlCache(expires_in=1800, min_validity=300)
+
+        def get_urls():
+            for _ in range(1000):
+                cache.get('bucket', 'key.zip', self.generate)
+
+        # Switch threads as often as possible, to make a lost update likely
+        interval = sys.getcheckinterval()
+        sys.setcheckinterval(1)
+        try:
+            threads = [threading.Thread(target=get_urls) for _ in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            sys.setcheckinterval(interval)
+
+        stats = cache.stats()
+        self.assertEqual(stats['hits'] + stats['misses'], 8000)
+
+    def test_file_backend_is_shared_between_caches(self):
+        """
+        Test that a URL signed by one process is reused by another that uses
+        the same directory
+        """
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+
+        first = PresignedUrlCache(1800, 300, backend=FileBackend(directory))
+        second = PresignedUrlCache(1800, 300, backend=FileBackend(directory))
+
+        url, _ = first.get('bucket', 'key.zip', self.generate)
+        self.assertEqual(
+            second.get('bucket', 'key.zip', self.generate)[0],
+            url
+        )
+        self.assertEqual(self.generate.call_count, 1)
+        self.assertEqual(second.stats()['backend'], 'FileBackend')
@@ -0,0 +1,439 @@
+"""
+Test the ADS Classic client
+"""
+
+import mock
+import time
+import requests
+import threading
+
+from flask import Flask
+from unittest import TestCase
+from harbour.classic import ClassicClient, CircuitBreaker, \
+    MirrorUnavailable, LatencyWindow, Bulkhead
+from requests.packages.urllib3.exceptions import ReadTimeoutError
+
+
+class TestCircuitBreaker(TestCase):
+    """
+    Test the circuit breaker of a mirror
+    """
+
+    @mock.patch('harbour.classic.time.time')
+    def test_breaker_opens_and_lets_one_trial_through(self, mock_time):
+        """
+        Test that the breaker opens after consecutive failures, lets a single
+        trial through after the reset timeout, and closes if it succeeds
+        """
+        mock_time.return_value = 1000
+        breaker = CircuitBreaker(max_failures=2, reset_timeout=30)
+
+        breaker.failure()
+        breaker.success()
+        breaker.failure()
+        self.assertTrue(breaker.allow())
+
+        breaker.failure()
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        self.assertFalse(breaker.allow())
+
+        mock_time.return_value = 1030
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+
+        breaker.success()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+        self.assertTrue(breaker.allow())
+
+    @mock.patch('harbour.classic.time.time')
+    def test_failed_trial_opens_the_breaker_again(self, mock_time):
+        """
+        Test that a failed trial request opens the breaker straight away
+        """
+        mock_time.return_value = 1000
+        breaker = CircuitBreaker(max_failures=1, reset_timeout=30)
+        breaker.failure()
+
+        mock_time.return_value = 1030
+        self.assertTrue(breaker.allow())
+        breaker.failure()
+
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        mock_time.return_value = 1059
+        self.assertFalse(breaker.allow())
+
+
+class TestLatencyWindow(TestCase):
+    """
+    Test the rolling window of latencies
+    """
+
+    def test_percentile_of_the_most_recent_latencies(self):
+        """
+        Test that the percentile is taken over the last latencies only
+        """
+        window = LatencyWindow(size=10)
+        self.assertIsNone(window.percentile(99))
+
+        for latency in [100] + range(1, 11):
+            window.add(latency)
+
+        self.assertEqual(len(window), 10)
+        self.assertEqual(window.percentile(50), 5)
+        self.assertEqual(window.percentile(90), 9)
+        self.assertEqual(window.percentile(100), 10)
+        self.assertEqual(window.percentile(0), 1)
+
+
+class TestBulkhead(TestCase):
+    """
+    Test the cap on the requests in flight to a mirror
+    """
+
+    def test_waits_for_a_place_for_a_bounded_time(self):
+        """
+        Test that a request waits for a place to be given back, and gives up
+        once its timeout has passed
+        """
+        bulkhead = Bulkhead(1)
+        self.assertTrue(bulkhead.acquire(0))
+        self.assertFalse(bulkhead.acquire(0))
+
+        start = time.time()
+        self.assertFalse(bulkhead.acquire(0.1))
+        self.assertGreaterEqual(time.time() - start, 0.1)
+
+        timer = threading.Timer(0.05, bulkhead.release)
+        timer.start()
+        self.assertTrue(bulkhead.acquire(5))
+        self.assertEqual(bulkhead.waiting, 0)
+        timer.join()
+
+        bulkhead.release()
+        with self.assertRaises(ValueError):
+            bulkhead.release()
+
+
+class TestClassicClient(TestCase):
+    """
+    Test the per-mirror sessions to ADS Classic
+    """
+
+    def setUp(self):
+        app = Flask(__name__)
+        app.config.update(
+            HARBOUR_SERVICE_ADSWS_API_TOKEN='secret',
+            ADS_CLASSIC_POOL_MAXSIZE=4,
+            ADS_CLASSIC_POOL_BLOCK=False,
+            ADS_CLASSIC_CONNECT_TIMEOUT=5,
+            ADS_CLASSIC_READ_TIMEOUT=30,
+            ADS_CLASSIC_BREAKER_FAILURES=2,
+            ADS_CLASSIC_BREAKER_RESET=30,
+            ADS_CLASSIC_MAX_CONCURRENCY=1,
+            ADS_CLASSIC_QUEUE_TIMEOUT=0,
+            ADS_CLASSIC_BULK_MIRROR_CONCURRENCY=1,
+            ADS_CLASSIC_TIMEOUT_PERCENTILE=90,
+            ADS_CLASSIC_TIMEOUT_HEADROOM=2,
+            ADS_CLASSIC_TIMEOUT_WINDOW=10,
+            ADS_CLASSIC_TIMEOUT_MIN_SAMPLES=5,
+            ADS_CLASSIC_MIN_READ_TIMEOUT=1,
+            ADS_CLASSIC_URL='http://{mirror}',
+            ADS_CLASSIC_PROBE_TIMEOUT=5
+        )
+        self.classic = ClassicClient(app)
+
+    @mock.patch('harbour.classic.os.getpid')
+    def test_one_session_per_mirror_and_process(self, mock_getpid):
+        """
+        Test that each mirror has its own session, which is reused within a
+        process and created again in a forked child
+        """
+        mock_getpid.return_value = 1
+        session = self.classic.session('mirror.com')
+        self.assertIs(self.classic.session('mirror.com'), session)
+        self.assertIsNot(self.classic.session('other.mirror.com'), session)
+
+        mock_getpid.return_value = 2
+        self.assertIsNot(self.classic.session('mirror.com'), session)
+
+    def test_session_pools_connections_to_the_mirror(self):
+        """
+        Test that the session keeps a pool of the configured size for the
+        mirror, and does not send the API token to it
+        """
+        session = self.classic.session('mirror.com')
+        adapter = session.get_adapter('http://mirror.com/cookie=1')
+
+        self.assertEqual(adapter._pool_maxsize, 4)
+        self.assertNotIn('Authorization', session.headers)
+
+    def test_requests_go_through_the_session_of_their_mirror(self):
+        """
+        Test that a URL is sent through the session of its host, with the
+        configured timeouts
+        """
+        session = self.classic.session('mirror.com')
+        with mock.patch.object(session, 'request') as mock_request:
+            mock_request.return_value.status_code = 200
+            self.classic.post('http://mirror.com', params={'a': 1})
+
+        mock_request.assert_called_once_with(
+            'POST',
+            'http://mirror.com',
+            params={'a': 1},
+            timeout=(5, 30)
+        )
+
+    def test_read_timeout_follows_the_latencies_of_each_operation(self):
+        """
+        Test that the read timeout is the maximum until enough latencies are
+        known, and then a percentile of them with headroom, within bounds
+        """
+        mirror = self.classic.get_mirror('mirror.com')
+        self.assertEqual(self.classic.read_timeout(mirror, 'elogin'), 30)
+
+        for _ in range(5):
+            mirror.latency('elogin').add(0.2)
+            mirror.latency('libraries').add(4)
+        mirror.latency('slow').add(20)
+
+        self.assertEqual(self.classic.read_timeout(mirror, 'elogin'), 1)
+        self.assertEqual(self.classic.read_timeout(mirror, 'libraries'), 8)
+        self.assertEqual(self.classic.read_timeout(mirror, 'slow'), 30)
+
+        for _ in range(5):
+            mirror.latency('slow').add(20)
+        self.assertEqual(self.classic.read_timeout(mirror, 'slow'), 30)
+
+    @mock.patch('harbour.classic.time.time')
+    def test_latencies_are_recorded_by_operation(self, mock_time):
+        """
+        Test that the latency of each request is kept under its operation,
+        and that a read timeout counts as taking the whole timeout
+        """
+        mock_time.side_effect = [1000, 1000.5]
+        session = self.classic.session('mirror.com')
+        with mock.patch.object(session, 'request') as mock_request:
+            mock_request.return_value.status_code = 200
+            self.classic.get('http://mirror.com', operation='libraries')
+
+            mock_time.side_effect = None
+            mock_request.side_effect = requests.exceptions.ReadTimeout
+            with self.assertRaises(requests.exceptions.Timeout):
+                self.classic.post('http://mirror.com')
+
+        mirror = self.classic.get_mirror('mirror.com')
+        self.assertEqual(mirror.latency('libraries').percentile(100), 0.5)
+        self.assertEqual(mirror.latency('post').percentile(100), 30)
+
+    def test_read_timeout_of_the_body_counts_as_taking_the_timeout(self):
+        """
+        Test that a read timeout while the body is read, which requests raises
+        as a ConnectionError, counts as taking the whole timeout, as one while
+        waiting for the headers does, and that other connection errors do not
+        """
+        session = self.classic.session('mirror.com')
+        with mock.patch.object(session, 'request') as mock_request:
+            mock_request.side_effect = requests.exceptions.ConnectionError(
+                ReadTimeoutError(None, 'http://mirror.com', 'Read timed out')
+            )
+            with self.assertRaises(requests.exceptions.ConnectionError):
+                self.classic.get('http://mirror.com', operation='libraries')
+
+            mock_request.side_effect = requests.exceptions.ConnectionError(
+                'Connection refused'
+            )
+            with self.assertRaises(requests.exceptions.ConnectionError):
+                self.classic.get('http://mirror.com', operation='elogin')
+
+        mirror = self.classic.get_mirror('mirror.com')
+        self.assertEqual(len(mirror.latency('libraries')), 1)
+        self.assertEqual(mirror.latency('libraries').percentile(100), 30)
+        self.assertEqual(len(mirror.latency('elogin')), 0)
+        self.assertEqual(mirror.breaker.failures, 2)
+
+    def test_failing_mirror_fails_fast(self):
+        """
+        Test that once a mirror has timed out or returned a 5xx enough times,
+        it is no longer contacted, while other mirrors still are
+        """
+        session = self.classic.session('mirror.com')
+        with mock.patch.object(session, 'request') as mock_request:
+            mock_request.side_effect = requests.exceptions.Timeout
+            with self.assertRaises(requests.exceptions.Timeout):
+                self.classic.get('http://mirror.com')
+
+            mock_request.side_effect = None
+            mock_request.return_value.status_code = 502
+            self.classic.get('http://mirror.com')
+
+            with self.assertRaises(MirrorUnavailable):
+                self.classic.get('http://mirror.com')
+            self.assertEqual(mock_request.call_count, 2)
+
+        other = self.classic.session('other.mirror.com')
+        with mock.patch.object(other, 'request') as mock_request:
+            mock_request.return_value.status_code = 200
+            self.classic.get('http://other.mirror.com')
+
+        stats = self.classic.stats()
+        self.assertEqual(stats['mirror.com']['state'], CircuitBreaker.OPEN)
+        self.assertEqual(stats['mirror.com']['rejected'], 1)
+        self.assertEqual(
+            stats['other.mirror.com']['state'],
+            CircuitBreaker.CLOSED
+        )
+
+    def test_streamed_request_lasts_until_its_body_is_read(self):
+        """
+        Test that a streamed request keeps its place under the cap of the
+        mirror until its response is closed, and that its latency counts the
+        reading of the body
+        """
+        mirror = self.classic.get_mirror('mirror.com')
+
+        def iter_content(chunk_size, decode_unicode):
+            time.sleep(0.1)
+            yield b'{}'
+
+        with mock.patch.object(mirror.session, 'request') as mock_request:
+            mock_request.return_value.status_code = 200
+            mock_request.return_value.iter_content.side_effect = iter_content
+            response = self.classic.get('http://mirror.com', stream=True,
+                                        operation='libraries')
+
+            self.assertEqual(mirror.in_flight, 1)
+            with self.assertRaises(MirrorUnavailable):
+                self.classic.get('http://mirror.com')
+
+            self.assertEqual(list(response.iter_content(1024)), [b'{}'])
+            response.close()
+            response.close()
+
+        self.assertEqual(mirror.in_flight, 0)
+        self.assertEqual(mirror.bulkhead.free, 1)
+        self.assertGreaterEqual(
+            mirror.latency('libraries').percentile(100),
+            0.1
+        )
+
+    def test_stalled_body_is_a_failure_of_the_mirror(self):
+        """
+        Test that a read timeout while the body of a streamed response is
+        read counts as a failure of the mirror that took the whole timeout,
+        and gives back its place under the cap
+        """
+        mirror = self.classic.get_mirror('mirror.com')
+
+        def iter_content(chunk_size, decode_unicode):
+            yield b'{"libraries": ['
+            raise requests.exceptions.ConnectionError(
+                ReadTimeoutError(None, 'http://mirror.com', 'Read timed out')
+            )
+
+        with mock.patch.object(mirror.session, 'request') as mock_request:
+            mock_request.return_value.status_code = 200
+            mock_request.return_value.iter_content.side_effect = iter_content
+            response = self.classic.get('http://mirror.com', stream=True,
+                                        operation='libraries')
+
+            with self.assertRaises(requests.exceptions.ConnectionError):
+                list(response.iter_content(1024))
+            self.assertEqual(mirror.bulkhead.free, 1)
+            response.close()
+
+        self.assertEqual(mirror.breaker.failures, 1)
+        self.assertEqual(mirror.latency('libraries').percentile(100), 30)
+        self.assertEqual(len(mirror.latency('libraries')), 1)
+
+    def test_busy_mirror_rejects_extra_requests(self):
+        """
+        Test that a mirror with as many requests in flight as allowed, for
+        longer than a request may wait, rejects any more, without counting it
+        as a failure of the mirror
+        """
+        mirror = self.classic.get_mirror('mirror.com')
+        mirror.bulkhead.acquire()
+        try:
+            with self.assertRaises(MirrorUnavailable):
+                self.classic.get('http://mirror.com')
+        finally:
+            mirror.bulkhead.release()
+
+        self.assertEqual(mirror.rejected, 1)
+        self.assertEqual(mirror.breaker.failures, 0)
+
+    def test_busy_mirror_queues_extra_requests(self):
+        """
+        Test that a request to a mirror with as many requests in flight as
+        allowed waits for one of them to finish
+        """
+        self.classic.config['ADS_CLASSIC_QUEUE_TIMEOUT'] = 5
+        mirror = self.classic.get_mirror('mirror.com')
+        mirror.bulkhead.acquire()
+
+        timer = threading.Timer(0.05, mirror.bulkhead.release)
+        timer.start()
+        with mock.patch.object(mirror.session, 'request') as mock_request:
+            mock_request.return_value.status_code = 200
+            self.classic.get('http://mirror.com')
+        timer.join()
+
+        self.assertEqual(mock_request.call_count, 1)
+        self.assertEqual(mirror.rejected, 0)
+        self.assertEqual(mirror.stats()['waiting'], 0)
+
+    def test_probes_update_the_health_of_the_mirrors(self):
+        """
+        Test that probing records whether each mirror answered and how fast,
+        and that failed probes count towards opening its circuit breaker
+        """
+        def get(url, **kwargs):
+            if url == 'http://down.mirror.com':
+                raise requests.exceptions.ConnectionError
+            return mock.Mock(status_code=200)
+
+        names = ['down.mirror.com', 'mirror.com']
+        for name in names:
+            session = self.classic.session(name)
+            session.get = mock.Mock(side_effect=get)
+
+        self.classic.probe_all(names)
+        self.classic.probe_all(names)
+
+        down = self.classic.get_mirror('down.mirror.com')
+        self.assertFalse(down.alive)
+        self.assertEqual(down.breaker.state, CircuitBreaker.OPEN)
+
+        up = self.classic.get_mirror('mirror.com')
+        self.assertTrue(up.alive)
+        self.assertIsNotNone(up.probe_latency)
+        up.session.get.assert_called_with(
+            'http://mirror.com',
+            timeout=(5, 5),
+            stream=True
+        )
+
+    def test_mirrors_are_ranked_by_health_and_latency(self):
+        """
+        Test that healthy mirrors come first, fastest first, then those not
+        yet probed, then those that are down or have an open breaker
+        """
+        def set_health(name, alive, latency=None):
+            mirror = self.classic.get_mirror(name)
+            mirror.alive, mirror.probe_latency = alive, latency
+            return mirror
+
+        set_health('slow.com', True, 2.0)
+        set_health('fast.com', True, 0.1)
+        set_health('down.com', False)
+        broken = set_health('broken.com', True, 0.01)
+        for _ in range(2):
+            broken.breaker.failure()
+
+        self.assertEqual(
+            self.classic.ranked(
+                ['down.com', 'slow.com', 'new.com', 'broken.com', 'fast.com']
+            ),
+            ['fast.com', 'slow.com', 'new.com', 'down.com', 'broken.com']
+        )
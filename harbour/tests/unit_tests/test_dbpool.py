@@ -0,0 +1,229 @@
+"""
+Test the connection pool of the harbour database
+"""
+
+import os
+import time
+import sqlite3
+import tempfile
+
+from unittest import TestCase
+from sqlalchemy import create_engine, exc
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import QueuePool, NullPool
+from harbour.dbpool import InstrumentedQueuePool, PooledSQLAlchemy, \
+    pool_stats
+
+
+class StaleConnection(object):
+    """
+    SQLite connection that stops working once it is made stale, as the
+    connections to a database that failed over
+    """
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path)
+        self.stale = False
+
+    def cursor(self):
+        if self.stale:
+            raise sqlite3.OperationalError('server closed the connection')
+        return self.connection.cursor()
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+
+class TestInstrumentedQueuePool(TestCase):
+    """
+    Test the counters of the pool, and the test of connections on checkout
+    """
+
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def helper_engine(self, **kwargs):
+        """
+        Engine on a SQLite database with an instrumented pool of one
+        connection
+        """
+        options = dict(
+            creator=lambda: StaleConnection(self.path),
+            poolclass=InstrumentedQueuePool,
+            pool_size=1,
+            max_overflow=0,
+            pool_timeout=0.1
+        )
+        options.update(kwargs)
+        return create_engine('sqlite:///' + self.path, **options)
+
+    def test_checkouts_are_counted_and_timed(self):
+        """
+        Test that the connections checked out, and the time waited for them,
+        are counted
+        """
+        engine = self.helper_engine()
+        connection = engine.connect()
+
+        stats = pool_stats(engine.pool)
+        self.assertEqual(stats['class'], 'InstrumentedQueuePool')
+        self.assertEqual(stats['size'], 1)
+        self.assertEqual(stats['checked_out'], 1)
+        self.assertEqual(stats['overflow'], 0)
+        self.assertEqual(stats['connects'], 1)
+        self.assertEqual(sum(stats['waits'].values()), 1)
+
+        connection.close()
+        stats = pool_stats(engine.pool)
+        self.assertEqual(stats['checked_out'], 0)
+        self.assertEqual(stats['checked_in'], 1)
+
+    def test_connecting_and_pinging_are_not_counted_as_waits(self):
+        """
+        Test that the time taken to open a connection, and to test it, is
+        reported apart from the time waited for a free connection
+        """
+        def slow_connection():
+            time.sleep(0.2)
+            return StaleConnection(self.path)
+
+        engine = self.helper_engine(creator=slow_connection, pre_ping=True)
+        engine.connect().close()
+
+        stats = pool_stats(engine.pool)
+        self.assertEqual(stats['connects'], 1)
+        self.assertGreaterEqual(stats['connect_seconds'], 0.2)
+        self.assertGreaterEqual(stats['max_connect_seconds'], 0.2)
+        self.assertEqual(stats['pings'], 1)
+        self.assertLess(stats['max_wait_seconds'], 0.1)
+        self.assertEqual(sum(stats['waits'].values()), 1)
+
+    def test_timeouts_are_counted(self):
+        """
+        Test that a checkout that finds no free connection in time is counted
+        as a timeout, and in the wait time histogram
+        """
+        engine = self.helper_engine()
+        connection = engine.connect()
+
+        with self.assertRaises(exc.TimeoutError):
+            engine.connect()
+
+        stats = pool_stats(engine.pool)
+        self.assertEqual(stats['timeouts'], 1)
+        self.assertEqual(sum(stats['waits'].values()), 2)
+        self.assertGreaterEqual(stats['max_wait_seconds'], 0.1)
+        self.assertEqual(stats['waits']['0.5'], 1)
+        connection.close()
+
+    def test_overflow_in_use(self):
+        """
+        Test that the connections opened beyond the size of the pool are
+        reported
+        """
+        engine = self.helper_engine(max_overflow=1)
+        connections = [engine.connect(), engine.connect()]
+
+        self.assertEqual(pool_stats(engine.pool)['overflow'], 1)
+        for connection in connections:
+            connection.close()
+
+    def test_stale_connections_are_replaced_on_checkout(self):
+        """
+        Test that with pre_ping, a connection that no longer works is
+        invalidated and replaced as it is checked out, rather than handed out
+        """
+        engine = self.helper_engine(pre_ping=True)
+        connection = engine.connect()
+        connection.connection.connection.stale = True
+        connection.close()
+
+        connection = engine.connect()
+        self.assertEqual(connection.scalar('SELECT 1'), 1)
+        connection.close()
+
+        stats = pool_stats(engine.pool)
+        self.assertEqual(stats['ping_failures'], 1)
+        self.assertEqual(stats['invalidations'], 1)
+        self.assertEqual(stats['connects'], 2)
+
+    def test_recreated_pool_keeps_its_counters(self):
+        """
+        Test that the counters, and the test on checkout, survive the pool
+        being recreated, eg., by Engine.dispose
+        """
+        engine = self.helper_engine(pre_ping=True)
+        engine.connect().close()
+        engine.dispose()
+
+        connection = engine.connect()
+        connection.connection.connection.stale = True
+        connection.close()
+        engine.connect().close()
+
+        stats = pool_stats(engine.pool)
+        self.assertTrue(engine.pool.pre_ping)
+        self.assertEqual(stats['connects'], 3)
+        self.assertEqual(stats['ping_failures'], 1)
+        self.assertEqual(sum(stats['waits'].values()), 3)
+
+
+class TestPooledSQLAlchemy(TestCase):
+    """
+    Test the engine options set for each database
+    """
+
+    def helper_options(self, url, pre_ping=True):
+        """
+        Options of create_engine, with those of the pool from the
+        configuration
+        """
+        class App(object):
+            root_path = '/tmp'
+            config = {
+                'HARBOUR_DB_POOL_PRE_PING': pre_ping,
+                'SQLALCHEMY_NATIVE_UNICODE': None
+            }
+
+        options = {'pool_size': 5, 'max_overflow': 10, 'pool_timeout': 10,
+                   'pool_recycle': 1800}
+        PooledSQLAlchemy().apply_driver_hacks(App, make_url(url), options)
+        return options
+
+    def test_postgresql_pool_is_instrumented(self):
+        """
+        Test that the pool of a PostgreSQL database is instrumented, and sized
+        from the configuration
+        """
+        options = self.helper_options('postgresql://user@localhost/harbour',
+                                      pre_ping=False)
+
+        self.assertIs(options['poolclass'], InstrumentedQueuePool)
+        self.assertFalse(options['pre_ping'])
+        self.assertEqual(options['pool_size'], 5)
+        self.assertEqual(options['max_overflow'], 10)
+
+    def test_sqlite_is_not_pooled(self):
+        """
+        Test that the options of a queue of connections are not given to the
+        pools used for SQLite
+        """
+        options = self.helper_options('sqlite:////tmp/harbour.db')
+
+        self.assertIs(options['poolclass'], NullPool)
+        self.assertNotIn('pool_size', options)
+        self.assertNotIn('pre_ping', options)
+
+    def test_other_pools_are_reported(self):
+        """
+        Test that the state of a pool that is not instrumented is reported
+        """
+        pool = QueuePool(lambda: None, pool_size=3)
+
+        stats = pool_stats(pool)
+        self.assertEqual(stats['class'], 'QueuePool')
+        self.assertEqual(stats['size'], 3)
+        self.assertNotIn('timeouts', stats)
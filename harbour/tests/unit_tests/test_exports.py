@@ -0,0 +1,75 @@
+"""
+Test the index of the ADS 2.0 exports
+"""
+
+from unittest import TestCase
+from harbour.exports import ExportIndex
+
+
+class TestExportIndex(TestCase):
+    """
+    Test the index of which exports exist
+    """
+
+    def test_exports_are_indexed_by_type(self):
+        """
+        Test that only the zip files of known export types are indexed, and
+        that they are looked up by library file name
+        """
+        index = ExportIndex(['zotero', 'mendeley'])
+        index.build([
+            'users.json',
+            'a.json',
+            'a.zotero.zip',
+            'b.json',
+            'b.mendeley.zip',
+            'b.papers.zip'
+        ])
+
+        self.assertTrue(index.available('a.json', 'zotero'))
+        self.assertFalse(index.available('a.json', 'mendeley'))
+        self.assertTrue(index.available('b.json', 'mendeley'))
+        self.assertFalse(index.available('b.json', 'papers'))
+        self.assertFalse(index.available('c.json', 'zotero'))
+        self.assertEqual(len(index), 2)
+        self.assertEqual(
+            index.stats()['exports'],
+            {'zotero': 1, 'mendeley': 1}
+        )
+
+    def test_nothing_is_known_before_the_index_is_built(self):
+        """
+        Test that the index does not claim an export is missing before it has
+        listed the bucket
+        """
+        index = ExportIndex(['zotero'])
+        self.assertIsNone(index.available('a.json', 'zotero'))
+
+    def test_failed_listing_keeps_the_previous_index(self):
+        """
+        Test that the index is only replaced once the whole listing has been
+        read
+        """
+        def failing_listing():
+            yield 'b.zotero.zip'
+            raise IOError('Connection reset')
+
+        index = ExportIndex(['zotero'])
+        index.build(['a.zotero.zip'])
+
+        with self.assertRaises(IOError):
+            index.build(failing_listing())
+
+        self.assertTrue(index.available('a.json', 'zotero'))
+        self.assertFalse(index.available('b.json', 'zotero'))
+
+    def test_non_ascii_names_do_not_stop_the_build(self):
+        """
+        Test that a key that is not ASCII is indexed as it is, along with the
+        rest of the listing
+        """
+        index = ExportIndex(['zotero'])
+        index.build([u'b\xe9.zotero.zip', u'a.zotero.zip'])
+
+        self.assertTrue(index.available(u'b\xe9.json', 'zotero'))
+        self.assertTrue(index.available('a.json', 'zotero'))
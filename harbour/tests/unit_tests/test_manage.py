@@ -3,7 +3,7 @@ Tests the methods within the flask-script file manage.py
 """
 
 from base import TestBaseDatabase
-from harbour.manage import CreateDatabase
+from harbour.manage import CreateDatabase, FindUsers
 from harbour.models import db, Users
 from sqlalchemy import create_engine
 
@@ -30,3 +30,19 @@ class TestManagePy(TestBaseDatabase):
 
         # Clean up the tables
         db.metadata.drop_all(bind=engine)
+
+    def test_find_users(self):
+        """
+        Tests the FindUsers action. This should find the users with an e-mail
+        regardless of its case.
+        """
+        db.session.add(Users(absolute_uid=10, classic_email='User@ADS.com',
+                             classic_cookie='cookie'))
+        db.session.add(Users(absolute_uid=11, twopointoh_email='user@ads.com'))
+        db.session.commit()
+
+        users = FindUsers.run('user@ads.com', app=self.app)
+        self.assertEqual([user.absolute_uid for user in users], [10])
+
+        users = FindUsers.run('USER@ads.com', twopointoh=True, app=self.app)
+        self.assertEqual([user.absolute_uid for user in users], [11])
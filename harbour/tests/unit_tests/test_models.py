@@ -0,0 +1,124 @@
+"""
+Test the database models
+"""
+
+from base import TestBaseDatabase
+from harbour import models
+from harbour.models import db, Users, UserRecord, select_users, \
+    select_users_by_email
+from sqlalchemy import inspect
+
+
+class TestUsersUpsert(TestBaseDatabase):
+    """
+    Test creating and updating users rows in a single statement
+    """
+
+    def test_upsert_creates_then_updates_the_row(self):
+        """
+        Test that the first upsert of a user creates their row with the ORM
+        defaults, and that the next ones only update the columns given
+        """
+        user = Users.upsert(
+            10,
+            classic_email='user@ads.com',
+            classic_mirror='mirror.com',
+            classic_cookie='cookie'
+        )
+        db.session.commit()
+        self.assertEqual(
+            user,
+            UserRecord(10, 'user@ads.com', 'mirror.com', 'cookie', '')
+        )
+
+        user = Users.upsert(10, twopointoh_email='user@ads.com')
+        db.session.commit()
+        self.assertEqual(
+            user,
+            UserRecord(10, 'user@ads.com', 'mirror.com', 'cookie',
+                       'user@ads.com')
+        )
+
+        self.assertEqual(Users.query.count(), 1)
+        self.assertEqual(Users.query.one().record(), user)
+
+    def test_upsert_refuses_unknown_columns(self):
+        """
+        Test that only the columns of the users table can be set
+        """
+        with self.assertRaises(ValueError):
+            Users.upsert(10, id=1)
+
+
+class TestSelectUsers(TestBaseDatabase):
+    """
+    Test the read-only lookup of users rows
+    """
+
+    def setUp(self):
+        super(TestSelectUsers, self).setUp()
+        for uid in range(10, 15):
+            db.session.add(Users(
+                absolute_uid=uid,
+                classic_email='user{}@ads.com'.format(uid)
+            ))
+        db.session.commit()
+
+    def test_rows_are_the_same_as_through_the_orm(self):
+        """
+        Test that the records returned are those of the rows that exist, once
+        each, whatever the padding of the user IDs
+        """
+        for uids in [[10], [12, 99], [14, 13, 12, 11, 10], [99]]:
+            users = select_users(uids)
+            self.assertEqual(
+                sorted(users),
+                sorted(user.record() for user in Users.query.filter(
+                    Users.absolute_uid.in_(uids)
+                ))
+            )
+            self.assertTrue(all(isinstance(u, UserRecord) for u in users))
+
+        self.assertEqual(select_users([]), [])
+
+    def test_statements_are_compiled_once_per_size(self):
+        """
+        Test that lookups of a similar number of users reuse the same
+        compiled statement
+        """
+        models._compiled_selects.clear()
+        select_users([10, 11, 12])
+        compiled = dict(models._compiled_selects)
+        select_users([13, 14, 99, 10])
+
+        self.assertEqual(len(compiled), 1)
+        self.assertEqual(models._compiled_selects, compiled)
+
+    def test_users_are_found_by_email_regardless_of_case(self):
+        """
+        Test that users are found by either of their e-mails, whatever its
+        case, and that the e-mails are indexed for it
+        """
+        db.session.add(Users(absolute_uid=20, twopointoh_email='Two@ADS.com'))
+        db.session.commit()
+
+        self.assertEqual(
+            [user.absolute_uid for user in
+             select_users_by_email('USER12@ads.COM')],
+            [12]
+        )
+        self.assertEqual(
+            [user.absolute_uid for user in
+             select_users_by_email('two@ads.com', 'twopointoh_email')],
+            [20]
+        )
+        self.assertEqual(select_users_by_email('two@ads.com'), [])
+
+        with self.assertRaises(ValueError):
+            select_users_by_email('cookie', 'classic_cookie')
+
+        indexes = inspect(db.get_engine(self.app, bind='harbour'))\
+            .get_indexes(Users.__tablename__)
+        self.assertTrue({
+            'ix_users_lower_classic_email', 'ix_users_lower_twopointoh_email'
+        } <= {index['name'] for index in indexes})
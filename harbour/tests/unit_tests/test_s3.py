@@ -0,0 +1,115 @@
+"""
+Test the S3 access layer
+"""
+
+import mock
+
+from unittest import TestCase
+from harbour.s3 import S3
+
+
+class TestS3(TestCase):
+    """
+    Test the per-process S3 client
+    """
+
+    def setUp(self):
+        self.s3 = S3()
+
+    @mock.patch('harbour.s3.boto3.session.Session')
+    @mock.patch('harbour.s3.os.getpid')
+    def test_client_is_created_once_per_process(self, mock_getpid,
+                                                mock_session):
+        """
+        Test that the client is reused within a process, and created again in
+        a forked child
+        """
+        mock_getpid.return_value = 1
+        client = self.s3.client
+        self.assertIs(self.s3.client, client)
+        self.assertEqual(mock_session.return_value.client.call_count, 1)
+
+        mock_getpid.return_value = 2
+        self.s3.client
+        self.assertEqual(mock_session.return_value.client.call_count, 2)
+
+    @mock.patch('harbour.s3.boto3.session.Session')
+    def test_calls_are_timed(self, mock_session):
+        """
+        Test that successful and failed calls are counted and timed by
+        operation
+        """
+        mock_client = mock_session.return_value.client.return_value
+        mock_client.get_object.return_value = {'Body': 'body'}
+
+        self.assertEqual(
+            self.s3.get_object('bucket', 'key'),
+            {'Body': 'body'}
+        )
+        mock_client.get_object.assert_called_once_with(
+            Bucket='bucket',
+            Key='key'
+        )
+
+        mock_client.get_object.side_effect = Exception('Failed')
+        with self.assertRaises(Exception):
+            self.s3.get_object('bucket', 'key')
+
+        timing = self.s3.stats()['get_object']
+        self.assertEqual(timing['calls'], 2)
+        self.assertEqual(timing['errors'], 1)
+        self.assertGreaterEqual(timing['max_seconds'], 0)
+
+    @mock.patch('harbour.s3.boto3.session.Session')
+    def test_keys_are_listed_a_page_at_a_time(self, mock_session):
+        """
+        Test that all the keys of a bucket are returned, over as many
+        ListObjects calls as it takes
+        """
+        mock_client = mock_session.return_value.client.return_value
+        mock_client.list_objects.side_effect = [
+            {'IsTruncated': True, 'Contents': [{'Key': 'a'}, {'Key': 'b'}]},
+            {'IsTruncated': True, 'Contents': [{'Key': 'c'}, {'Key': 'd'}]},
+            {'IsTruncated': False, 'Contents': [{'Key': 'e'}]}
+        ]
+
+        self.assertEqual(
+            list(self.s3.iter_keys('bucket', page_size=2)),
+            ['a', 'b', 'c', 'd', 'e']
+        )
+        self.assertEqual(
+            [call[1]['Marker']
+             for call in mock_client.list_objects.call_args_list],
+            ['', 'b', 'd']
+        )
+        self.assertEqual(self.s3.stats()['list_objects']['calls'], 3)
+
+    def test_client_options_are_applied(self):
+        """
+        Test that the pool size, timeouts and retries configured are those of
+        the client
+        """
+        self.s3.options = dict(
+            max_pool_connections=3,
+            connect_timeout=2,
+            read_timeout=7,
+            retries={'max_attempts': 4, 'mode': 'standard'}
+        )
+        config = self.s3._client_config()
+
+        self.assertEqual(config.max_pool_connections, 3)
+        self.assertEqual(config.connect_timeout, 2)
+        self.assertEqual(config.read_timeout, 7)
+        self.assertEqual(config.retries['max_attempts'], 4)
+
+    @mock.patch('harbour.s3.Config')
+    @mock.patch('harbour.s3.logger')
+    def test_unsupported_options_are_logged(self, mock_logger, mock_config):
+        """
+        Test that a botocore that does not take the options is reported as an
+        error, rather than quietly ignoring them
+        """
+        mock_config.side_effect = TypeError('unexpected keyword argument')
+
+        self.assertIsNone(self.s3._client_config())
+        self.assertEqual(mock_logger.exception.call_count, 1)
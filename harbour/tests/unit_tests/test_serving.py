@@ -0,0 +1,46 @@
+"""
+Test the choice of serving mode
+"""
+
+import os
+import sys
+import mock
+import socket
+
+from unittest import TestCase
+from harbour.serving import serving_mode, patch, THREADED, GEVENT
+
+
+class TestServingMode(TestCase):
+    """
+    Test the serving mode read from the environment
+    """
+
+    def test_threaded_by_default(self):
+        """
+        Test that the threaded mode is used unless another one is chosen
+        """
+        with mock.patch.dict(os.environ, clear=True):
+            self.assertEqual(serving_mode(), THREADED)
+
+        with mock.patch.dict(os.environ, {'HARBOUR_SERVING_MODE': 'gevent'}):
+            self.assertEqual(serving_mode(), GEVENT)
+
+    def test_unknown_mode(self):
+        """
+        Test that an unknown mode is refused rather than ignored
+        """
+        with mock.patch.dict(os.environ, {'HARBOUR_SERVING_MODE': 'asyncio'}):
+            with self.assertRaises(ValueError):
+                serving_mode()
+
+    def test_threaded_mode_patches_nothing(self):
+        """
+        Test that the threaded mode leaves the standard library as it is
+        """
+        original_socket = socket.socket
+        with mock.patch.dict('sys.modules', {'gevent': None}):
+            patch(THREADED)
+
+            self.assertNotIn('gevent.monkey', sys.modules)
+            self.assertIs(socket.socket, original_socket)
@@ -0,0 +1,177 @@
+"""
+Test the coalescing of identical upstream fetches
+"""
+
+import os
+import time
+import fcntl
+import shutil
+import tempfile
+import threading
+
+from unittest import TestCase
+from harbour.singleflight import SingleFlight
+from harbour.users_index import host_lock
+
+
+class TestSingleFlight(TestCase):
+    """
+    Test that concurrent calls for the same key share a single call
+    """
+
+    def helper_concurrent_calls(self, flight, key, function, number):
+        """
+        Make calls from several threads while the first one is in progress
+        """
+        results = []
+
+        def call():
+            try:
+                results.append(flight.do(key, function))
+            except Exception as error:
+                results.append(error)
+
+        threads = [threading.Thread(target=call) for _ in range(number)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+        return results
+
+    def test_concurrent_calls_share_one_call(self):
+        """
+        Test that threads asking for the same key while a call is in progress
+        wait for it and get its result
+        """
+        calls = []
+        release = threading.Event()
+
+        def fetch():
+            calls.append(1)
+            release.wait(5)
+            return 'value'
+
+        flight = SingleFlight()
+        threading.Timer(0.2, release.set).start()
+        results = self.helper_concurrent_calls(flight, ('s3', 'key'), fetch, 5)
+
+        self.assertEqual(results, ['value'] * 5)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(flight.stats()['calls'], 1)
+        self.assertEqual(flight.stats()['coalesced'], 4)
+
+        # Later calls are made again
+        self.assertEqual(flight.do(('s3', 'key'), lambda: 'new value'),
+                         'new value')
+
+    def test_waiting_calls_get_the_error(self):
+        """
+        Test that a failed call raises its error in every caller that waited
+        on it
+        """
+        release = threading.Event()
+
+        def fetch():
+            release.wait(5)
+            raise IOError('Timed out')
+
+        flight = SingleFlight()
+        threading.Timer(0.2, release.set).start()
+        results = self.helper_concurrent_calls(flight, ('s3', 'key'), fetch, 3)
+
+        self.assertEqual(len(results), 3)
+        for result in results:
+            self.assertIsInstance(result, IOError)
+
+    def test_processes_share_results_through_the_directory(self):
+        """
+        Test that a process that waited on the lock of another uses its
+        result rather than making the call again
+        """
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+
+        first = SingleFlight(directory)
+        second = SingleFlight(directory)
+        results = []
+
+        def fetch():
+            # The other process asks for the same key while this call is in
+            # progress, and blocks on the lock file
+            thread = threading.Thread(
+                target=lambda: results.append(
+                    second.do(('classic', 'mirror', 'cookie'), lambda: 'own')
+                )
+            )
+            thread.start()
+            time.sleep(0.2)
+            fetch.thread = thread
+            return ['libraries', 10]
+
+        self.assertEqual(
+            first.do(('classic', 'mirror', 'cookie'), fetch),
+            ['libraries', 10]
+        )
+        fetch.thread.join(5)
+
+        self.assertEqual(results, [['libraries', 10]])
+        self.assertEqual(second.stats()['shared'], 1)
+
+        # A later call does not reuse an old result
+        self.assertEqual(
+            second.do(('classic', 'mirror', 'cookie'), lambda: 'own'),
+            'own'
+        )
+
+    def test_sweep_removes_old_results_and_unused_locks(self):
+        """
+        Test that the results are removed once they are older than the ttl,
+        and the lock files once no process holds them, but not a lock in use
+        """
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+
+        flight = SingleFlight(directory, ttl=60)
+        flight.do(('classic', 'mirror', 'cookie'), lambda: ['libraries'])
+        self.assertEqual(len(os.listdir(directory)), 2)
+
+        # The result is recent, and kept for the processes that waited on it
+        self.assertEqual(flight.sweep(), 1)
+        self.assertEqual(len(os.listdir(directory)), 1)
+
+        flight.ttl = 0
+        self.assertEqual(flight.sweep(), 1)
+        self.assertEqual(os.listdir(directory), [])
+        self.assertEqual(flight.stats()['swept'], 2)
+
+        path = os.path.join(directory, 'key')
+        with host_lock(path):
+            self.assertEqual(flight.sweep(), 0)
+            self.assertEqual(os.listdir(directory), ['key.lock'])
+
+    def test_lock_removed_while_waiting_is_taken_again(self):
+        """
+        Test that a process waiting on a lock file that is swept away takes
+        the lock on the new file, rather than holding it alongside another
+        process
+        """
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'key')
+        locked_files = []
+
+        def take_lock():
+            with host_lock(path):
+                locked_files.append(os.path.exists('{0}.lock'.format(path)))
+
+        with open('{0}.lock'.format(path), 'a') as held:
+            fcntl.flock(held.fileno(), fcntl.LOCK_EX)
+            thread = threading.Thread(target=take_lock)
+            thread.start()
+            time.sleep(0.1)
+            # Swept as another process would, once it held the lock
+            os.remove('{0}.lock'.format(path))
+            fcntl.flock(held.fileno(), fcntl.LOCK_UN)
+
+        thread.join(5)
+        self.assertEqual(locked_files, [True])
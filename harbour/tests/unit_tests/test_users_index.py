@@ -0,0 +1,119 @@
+"""
+Test the memory-mapped ADS 2.0 users index
+"""
+
+import os
+import mock
+import fcntl
+import shutil
+import tempfile
+import threading
+
+from unittest import TestCase
+from harbour.users_index import UsersIndex, write_users_index, \
+    open_users_index, get_users_index, host_lock
+
+
+class TestUsersIndex(TestCase):
+    """
+    Test building and looking up the users index
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'users.idx')
+        self.stub_users = {
+            u'user{}@ads.com'.format(i): u'{}.json'.format(i)
+            for i in range(100)
+        }
+        self.stub_users[u'\xfcser@ads.com'] = u'unicode.json'
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_index_looks_up_the_same_as_a_dictionary(self):
+        """
+        Test that every e-mail can be found, and unknown ones cannot
+        """
+        write_users_index(self.path, self.stub_users.items(), etag='"etag"')
+        index = UsersIndex(self.path)
+
+        self.assertEqual(len(index), len(self.stub_users))
+        self.assertEqual(index.etag, '"etag"')
+        self.assertEqual(dict(index.items()), self.stub_users)
+        for email, file_name in self.stub_users.items():
+            self.assertEqual(index.get(email), file_name)
+
+        self.assertIsNone(index.get('unknown@ads.com'))
+        self.assertEqual(index.get('unknown@ads.com', 'default'), 'default')
+        self.assertNotIn('unknown@ads.com', index)
+
+    def test_empty_index(self):
+        """
+        Test that an index with no users can be written and opened
+        """
+        write_users_index(self.path, [])
+        index = UsersIndex(self.path)
+
+        self.assertEqual(len(index), 0)
+        self.assertIsNone(index.get('user@ads.com'))
+
+    def test_open_missing_or_invalid_index(self):
+        """
+        Test that a missing or corrupt file is not opened as an index
+        """
+        self.assertIsNone(open_users_index(self.path))
+
+        with open(self.path, 'wb') as index_file:
+            index_file.write('not an index at all')
+        self.assertIsNone(open_users_index(self.path))
+
+    def test_index_is_only_built_when_the_etag_changes(self):
+        """
+        Test that an index already built for the current version of users.json
+        is reused without fetching it again
+        """
+        fetch = mock.Mock(return_value=('"1"', self.stub_users.items()))
+
+        index = get_users_index(self.path, '"1"', fetch)
+        self.assertEqual(fetch.call_count, 1)
+        self.assertEqual(dict(index.items()), self.stub_users)
+
+        get_users_index(self.path, '"1"', fetch)
+        self.assertEqual(fetch.call_count, 1)
+
+        fetch.return_value = ('"2"', [('user@ads.com', 'new.json')])
+        index = get_users_index(self.path, '"2"', fetch)
+        self.assertEqual(fetch.call_count, 2)
+        self.assertEqual(index.items(), [('user@ads.com', 'new.json')])
+
+    def test_host_lock_is_polled_on_an_event_loop(self):
+        """
+        Test that under gevent the lock is polled rather than waited on, and
+        is taken once it is released
+        """
+        acquired = threading.Event()
+
+        def take_lock():
+            with host_lock(self.path):
+                acquired.set()
+
+        with open('{0}.lock'.format(self.path), 'a') as held:
+            fcntl.flock(held.fileno(), fcntl.LOCK_EX)
+
+            with mock.patch('harbour.users_index._cooperative',
+                            return_value=True), \
+                    mock.patch('harbour.users_index.fcntl.flock',
+                               side_effect=fcntl.flock) as flock:
+                thread = threading.Thread(target=take_lock)
+                thread.start()
+                self.assertFalse(acquired.wait(0.2))
+
+                fcntl.flock(held.fileno(), fcntl.LOCK_UN)
+                self.assertTrue(acquired.wait(5))
+                thread.join()
+
+        self.assertTrue(all(
+            call[0][1] & fcntl.LOCK_NB for call in flock.call_args_list
+            if call[0][1] != fcntl.LOCK_UN
+        ))
@@ -0,0 +1,150 @@
+"""
+Test utilities
+"""
+
+import json
+import time
+
+from unittest import TestCase
+from StringIO import StringIO
+from harbour.utils import iter_json_object, iter_json_array, ChunkReader
+
+
+class TestIterJsonObject(TestCase):
+    """
+    Test the incremental parsing of flat JSON objects
+    """
+
+    def test_pairs_are_the_same_as_a_full_parse(self):
+        """
+        Test that the pairs yielded rebuild the same dictionary as json.loads,
+        regardless of how the chunks split the document
+        """
+        stub_users = {
+            u'user{}@ads.com'.format(i): u'{}.json'.format(i)
+            for i in range(100)
+        }
+        stub_users[u'\xfcser@ads.com'] = 12345
+        raw = json.dumps(stub_users, indent=2, ensure_ascii=False)\
+            .encode('utf-8')
+
+        for chunk_size in [1, 3, 1024]:
+            self.assertEqual(
+                dict(iter_json_object(StringIO(raw), chunk_size=chunk_size)),
+                stub_users
+            )
+
+    def test_empty_object(self):
+        """
+        Test that an empty object yields nothing
+        """
+        self.assertEqual(list(iter_json_object(StringIO(' {} '))), [])
+
+    def test_malformed_documents_raise_value_error(self):
+        """
+        Test that truncated or malformed documents raise a ValueError
+        """
+        for malformed in ['', '[1, 2]', '{"a" 1}', '{"a": 1', '{"a": 12']:
+            with self.assertRaises(ValueError):
+                list(iter_json_object(StringIO(malformed), chunk_size=2))
+
+
+class TestIterJsonArray(TestCase):
+    """
+    Test the incremental parsing of an array within a JSON object
+    """
+
+    def test_elements_are_the_same_as_a_full_parse(self):
+        """
+        Test that the elements yielded are those of the array under the key,
+        regardless of how the chunks split the document
+        """
+        stub_document = {
+            u'before': {u'libraries': [1, u'[', {u'}': u']'}]},
+            u'libraries': [
+                {u'name': u'N\xe4me {}'.format(i), u'entries': [
+                    {u'bibcode': u'2015MNRAS.446.4239E'}
+                ], u'desc': u'"quoted", [bracketed]'}
+                for i in range(20)
+            ] + [[], u'', 0, None],
+            u'after': True
+        }
+        raw = json.dumps(stub_document, indent=1, ensure_ascii=False)\
+            .encode('utf-8')
+
+        for chunk_size in [1, 3, 1024]:
+            self.assertEqual(
+                list(iter_json_array(
+                    StringIO(raw), 'libraries', chunk_size=chunk_size
+                )),
+                stub_document['libraries']
+            )
+
+    def test_large_elements_are_parsed_in_linear_time(self):
+        """
+        Test that an element spread over many chunks is not parsed again for
+        every chunk read: a 1 MB library in 1 KB chunks took hundreds of times
+        as long as a full parse when it was
+        """
+        stub_document = {u'libraries': [{u'entries': [
+            {u'bibcode': u'2015MNRAS.446.4239E', u'note': u'x' * 100}
+            for _ in range(8000)
+        ]}]}
+        raw = json.dumps(stub_document)
+
+        def timed(function):
+            start = time.time()
+            function()
+            return time.time() - start
+
+        full = min(timed(lambda: json.loads(raw)) for _ in range(3))
+        incremental = min(
+            timed(lambda: list(iter_json_array(
+                StringIO(raw), 'libraries', chunk_size=1024
+            )))
+            for _ in range(3)
+        )
+
+        self.assertLess(incremental, 20 * full)
+
+    def test_empty_and_missing_arrays(self):
+        """
+        Test that an empty array, or a missing key, yields nothing
+        """
+        self.assertEqual(
+            list(iter_json_array(StringIO('{"libraries": []}'), 'libraries')),
+            []
+        )
+        self.assertEqual(
+            list(iter_json_array(StringIO('{"other": [1]}'), 'libraries')),
+            []
+        )
+
+    def test_malformed_documents_raise_value_error(self):
+        """
+        Test that truncated or malformed documents raise a ValueError
+        """
+        for malformed in ['', '[1, 2]', '{"libraries": 1}',
+                          '{"libraries": [1, 2', '{"libraries": [1 2]}']:
+            with self.assertRaises(ValueError):
+                list(iter_json_array(
+                    StringIO(malformed), 'libraries', chunk_size=2
+                ))
+
+
+class TestChunkReader(TestCase):
+    """
+    Test the file-like reading of an iterator of chunks
+    """
+
+    def test_chunks_are_read_in_turn(self):
+        """
+        Test that each read returns the next chunk, then an empty string, and
+        that the bytes read are counted
+        """
+        reader = ChunkReader(iter(['ab', 'cde']))
+        self.assertEqual(
+            [reader.read(1024), reader.read(1024), reader.read(1024)],
+            ['ab', 'cde', '']
+        )
+        self.assertEqual(reader.bytes_read, 5)
@@ -5,26 +5,35 @@ Test webservices
 
 import mock
 import json
+import socket
+import time
 import boto3
+import requests
 import unittest
+import threading
 
 from moto import mock_s3
-from base import TestBaseDatabase
+from sqlalchemy import event
+from base import TestBase, TestBaseDatabase
 from flask import url_for
-from harbour.app import create_app
+from harbour.app import load_export_index
 from harbour.models import db, Users
+from harbour.views import ClassicLibraries
 from harbour.http_errors import CLASSIC_AUTH_FAILED, CLASSIC_DATA_MALFORMED, \
     CLASSIC_TIMEOUT, CLASSIC_BAD_MIRROR, CLASSIC_NO_COOKIE, \
     CLASSIC_UNKNOWN_ERROR, NO_CLASSIC_ACCOUNT, NO_TWOPOINTOH_LIBRARIES, \
     NO_TWOPOINTOH_ACCOUNT, TWOPOINTOH_AWS_PROBLEM, EXPORT_SERVICE_FAIL, \
-    TWOPOINTOH_WRONG_EXPORT_TYPE
+    TWOPOINTOH_WRONG_EXPORT_TYPE, TWOPOINTOH_USERS_NOT_READY, \
+    TWOPOINTOH_EXPORT_NOT_AVAILABLE, BULK_DATA_MALFORMED, BULK_TOO_MANY_UIDS
 from stub_response import ads_classic_200, ads_classic_unknown_user, \
     ads_classic_wrong_password, ads_classic_no_cookie, ads_classic_fail, \
-    ads_classic_libraries_200, export_success, export_success_no_keyword
+    ads_classic_libraries_200, ads_classic_libraries_200_with_length, \
+    export_success, export_success_no_keyword
 from httmock import HTTMock
 from zipfile import ZipFile
 from StringIO import StringIO
-from requests.exceptions import Timeout
+from requests.exceptions import Timeout, ConnectionError, \
+    TooManyRedirects
 
 
 USER_ID_KEYWORD = 'X-Adsws-Uid'
@@ -73,6 +82,63 @@ class TestClassicUser(TestBaseDatabase):
         self.assertStatus(r, NO_CLASSIC_ACCOUNT['code'])
         self.assertEqual(r.json['error'], NO_CLASSIC_ACCOUNT['message'])
 
+    def helper_count_queries(self):
+        """
+        Count the statements sent to the database from now on
+        """
+        statements = []
+        event.listen(
+            db.get_engine(self.app, bind='harbour'),
+            'before_cursor_execute',
+            lambda *args: statements.append(args[2])
+        )
+        return statements
+
+    def test_user_is_read_from_the_database_once(self):
+        """
+        Test that repeat requests for a user are served from the users cache
+        of the process, without going to the database
+        """
+        db.session.add(Users(absolute_uid=10, classic_email='user@ads.com'))
+        db.session.commit()
+        statements = self.helper_count_queries()
+
+        url = url_for('classicuser')
+        responses = [
+            self.client.get(url, headers={USER_ID_KEYWORD: 10})
+            for _ in range(3)
+        ]
+
+        self.assertEqual(len(statements), 1)
+        for r in responses:
+            self.assertStatus(r, 200)
+            self.assertEqual(r.json['classic_email'], 'user@ads.com')
+
+    def test_missing_user_is_cached_until_they_authenticate(self):
+        """
+        Test that a user without a row is not looked up again, until they
+        authenticate with this process
+        """
+        statements = self.helper_count_queries()
+
+        url = url_for('classicuser')
+        for _ in range(2):
+            r = self.client.get(url, headers={USER_ID_KEYWORD: 10})
+            self.assertStatus(r, NO_CLASSIC_ACCOUNT['code'])
+        self.assertEqual(len(statements), 1)
+
+        with HTTMock(ads_classic_200):
+            r = self.client.post(
+                url_for('authenticateuserclassic'),
+                data=self.stub_user_data,
+                headers={USER_ID_KEYWORD: 10}
+            )
+        self.assertStatus(r, 200)
+
+        r = self.client.get(url, headers={USER_ID_KEYWORD: 10})
+        self.assertStatus(r, 200)
+        self.assertEqual(r.json['classic_email'], 'user@ads.com')
+
 
 class TestAllowedMirrors(TestBaseDatabase):
     """
@@ -92,6 +158,107 @@ class TestAllowedMirrors(TestBaseDatabase):
         self.assertStatus(r, 200)
         self.assertListEqual(r.json, self.app.config['ADS_CLASSIC_MIRROR_LIST'])
 
+    @mock.patch('harbour.classic.ClassicClient.probe')
+    def test_user_retrieves_mirrors_ranked_by_health(self, mock_probe):
+        """
+        Tests that the mirrors can be ranked from the probes of the background
+        task, with those that answered their last probe first, and those that
+        are down last
+        """
+        self.config = dict(self.config, ADS_CLASSIC_PROBE_INTERVAL=60)
+        app_ = self.create_app()
+        classic = app_.extensions['classic']
+        health = {'mirror.com': (False, None), 'other.mirror.com': (True, 0.2)}
+
+        def probe(name):
+            mirror = classic.get_mirror(name)
+            mirror.alive, mirror.probe_latency = health[name]
+            return mirror
+        mock_probe.side_effect = probe
+
+        tasks = app_.extensions['background_tasks']
+        task = [task for task in tasks.tasks if task.name == 'mirror-probe'][0]
+        task.function()
+        self.assertItemsEqual(
+            [args[0] for args, _ in mock_probe.call_args_list],
+            ['mirror.com', 'other.mirror.com']
+        )
+
+        try:
+            r = app_.test_client().get('/mirrors?ranked=true')
+        finally:
+            tasks.stop(timeout=1)
+
+        self.assertStatus(r, 200)
+        self.assertListEqual(
+            json.loads(r.data),
+            ['other.mirror.com', 'mirror.com']
+        )
+
+
+class TestReadiness(TestBase):
+    """
+    Tests HTTP end point that reports whether the process is ready to serve
+    all of its end points
+    """
+
+    def test_ready_when_the_users_are_loaded(self):
+        """
+        Tests that the process is ready once the ADS 2.0 users are loaded
+        """
+        self.app.config['ADS_TWO_POINT_OH_LOADED_USERS'] = True
+
+        r = self.client.get(url_for('readiness'))
+
+        self.assertStatus(r, 200)
+        self.assertTrue(r.json['ready'])
+
+    def test_not_ready_while_the_users_are_loading(self):
+        """
+        Tests that the process is not ready while the ADS 2.0 users are still
+        being loaded, unless they are only loaded when first needed
+        """
+        self.app.config['ADS_TWO_POINT_OH_LOADED_USERS'] = False
+
+        r = self.client.get(url_for('readiness'))
+
+        self.assertStatus(r, TWOPOINTOH_USERS_NOT_READY['code'])
+        self.assertEqual(r.json['error'], TWOPOINTOH_USERS_NOT_READY['message'])
+        self.assertFalse(r.json['ready'])
+
+        self.app.config['ADS_TWO_POINT_OH_USERS_LOAD'] = 'lazy'
+        r = self.client.get(url_for('readiness'))
+
+        self.assertStatus(r, 200)
+        self.assertTrue(r.json['ready'])
+        self.assertFalse(r.json['twopointoh_users'])
+
+
+class TestMetrics(TestBase):
+    """
+    Tests HTTP end point that returns the internal counters of the process
+    """
+
+    def test_metrics_include_the_library_cache(self):
+        """
+        Tests that the counters of the ADS 2.0 library cache are returned
+        """
+        r = self.client.get(url_for('metrics'))
+
+        self.assertStatus(r, 200)
+        self.assertIn('pid', r.json)
+        for counter in ['hits', 'misses', 'evictions', 'bytes']:
+            self.assertIn(counter, r.json['twopointoh_library_cache'])
+
+    def test_metrics_include_the_database_pool(self):
+        """
+        Tests that the state of the pool of the harbour database is returned
+        """
+        r = self.client.get(url_for('metrics'))
+
+        self.assertStatus(r, 200)
+        self.assertIn('class', r.json['database'])
+
 
 class TestAuthenticateUserClassic(TestBaseDatabase):
     """
@@ -244,7 +411,7 @@ class TestAuthenticateUserClassic(TestBaseDatabase):
         self.assertStatus(r, CLASSIC_AUTH_FAILED['code'])
         self.assertEqual(r.json['error'], CLASSIC_AUTH_FAILED['message'])
 
-    @mock.patch('harbour.views.requests.post')
+    @mock.patch('harbour.classic.ClassicClient.post')
     def test_ads_classic_timeout(self, mocked_post):
         """
         Test that the service catches timeouts and returns a HTTP error response
@@ -257,6 +424,20 @@ class TestAuthenticateUserClassic(TestBaseDatabase):
         self.assertStatus(r, CLASSIC_TIMEOUT['code'])
         self.assertEqual(r.json['error'], CLASSIC_TIMEOUT['message'])
 
+    @mock.patch('harbour.classic.ClassicClient.post')
+    def test_ads_classic_connection_error(self, mocked_post):
+        """
+        Test that a mirror that cannot be reached, or drops the connection, is
+        reported as timing out rather than failing the service
+        """
+        mocked_post.side_effect = ConnectionError('Connection refused')
+
+        url = url_for('authenticateuserclassic')
+        r = self.client.post(url, data=self.stub_user_data)
+
+        self.assertStatus(r, CLASSIC_TIMEOUT['code'])
+        self.assertEqual(r.json['error'], CLASSIC_TIMEOUT['message'])
+
     def test_missing_data_given_fails(self):
         """
         Pass data that is missing content that is needed
@@ -476,7 +657,7 @@ class TestAuthenticateUserTwoPointOh(TestBaseDatabase):
         self.assertStatus(r, CLASSIC_AUTH_FAILED['code'])
         self.assertEqual(r.json['error'], CLASSIC_AUTH_FAILED['message'])
 
-    @mock.patch('harbour.views.requests.post')
+    @mock.patch('harbour.classic.ClassicClient.post')
     def test_ads_classic_timeout(self, mocked_post):
         """
         Test that the service catches timeouts and returns a HTTP error response
@@ -489,6 +670,20 @@ class TestAuthenticateUserTwoPointOh(TestBaseDatabase):
         self.assertStatus(r, CLASSIC_TIMEOUT['code'])
         self.assertEqual(r.json['error'], CLASSIC_TIMEOUT['message'])
 
+    @mock.patch('harbour.classic.ClassicClient.post')
+    def test_ads_classic_connection_error(self, mocked_post):
+        """
+        Test that a mirror that cannot be reached, or drops the connection, is
+        reported as timing out rather than failing the service
+        """
+        mocked_post.side_effect = ConnectionError('Connection refused')
+
+        url = url_for('authenticateusertwopointoh')
+        r = self.client.post(url, data=self.stub_user_data_2p0)
+
+        self.assertStatus(r, CLASSIC_TIMEOUT['code'])
+        self.assertEqual(r.json['error'], CLASSIC_TIMEOUT['message'])
+
     def test_missing_data_given_fails(self):
         """
         Pass data that is missing content that is needed
@@ -557,7 +752,7 @@ class TestADSTwoPointOhLibraries(TestBaseDatabase):
         TestADSTwoPointOhLibraries.helper_s3_mock_setup()
 
         # Setup the app
-        app_ = create_app()
+        app_ = self.helper_create_app()
         app_.config['CLASSIC_LOGGING'] = {}
         app_.config['SQLALCHEMY_BINDS'] = {}
         app_.config['ADS_CLASSIC_MIRROR_LIST'] = [
@@ -642,6 +837,155 @@ class TestADSTwoPointOhLibraries(TestBaseDatabase):
         self.assertStatus(r, 200)
         self.assertEqual(r.json['libraries'], stub_get_libraries['libraries'])
 
+    @mock_s3
+    def test_bulk_libraries_end_point(self):
+        """
+        Test that the libraries of many users are returned in the order of
+        the uids, with an error for those without libraries
+        """
+        TestADSTwoPointOhLibraries.helper_s3_mock_setup()
+
+        db.session.add(Users(absolute_uid=10, twopointoh_email='user@ads.com'))
+        db.session.add(Users(absolute_uid=11, twopointoh_email='new@ads.com'))
+        db.session.add(Users(absolute_uid=12, classic_email='user@ads.com'))
+        db.session.commit()
+
+        r = self.client.post(
+            url_for('bulktwopointohlibraries'),
+            data=json.dumps({'uids': [12, 10, 11, 13]})
+        )
+        self.assertStatus(r, 200)
+
+        single = self.client.get(url_for('twopointohlibraries', uid=10))
+        self.assertEqual(r.json['results'], [
+            {'uid': 12, 'error': NO_TWOPOINTOH_ACCOUNT['message'],
+             'code': NO_TWOPOINTOH_ACCOUNT['code']},
+            {'uid': 10, 'libraries': single.json['libraries']},
+            {'uid': 11, 'error': NO_TWOPOINTOH_LIBRARIES['message'],
+             'code': NO_TWOPOINTOH_LIBRARIES['code']},
+            {'uid': 13, 'error': NO_TWOPOINTOH_ACCOUNT['message'],
+             'code': NO_TWOPOINTOH_ACCOUNT['code']}
+        ])
+
+    @mock_s3
+    def test_bulk_libraries_end_point_fetches_in_parallel(self):
+        """
+        Test that the library files are fetched concurrently, that a failure
+        is reported for its user only, and that results can be streamed
+        """
+        TestADSTwoPointOhLibraries.helper_s3_mock_setup()
+        self.app.config['ADS_TWO_POINT_OH_BULK_WORKERS'] = 4
+
+        twopointoh_users = self.app.config['ADS_TWO_POINT_OH_USERS']
+        for uid in range(10, 18):
+            email = 'user{}@ads.com'.format(uid)
+            twopointoh_users[email] = '{}.json'.format(uid)
+            db.session.add(Users(absolute_uid=uid, twopointoh_email=email))
+        db.session.commit()
+
+        lock = threading.Lock()
+        in_flight = [0, 0]
+
+        def get_s3_library(library_file_name):
+            with lock:
+                in_flight[0] += 1
+                in_flight[1] = max(in_flight)
+            time.sleep(0.05)
+            with lock:
+                in_flight[0] -= 1
+            if library_file_name == '13.json':
+                raise Exception('S3 failed')
+            return [{'name': library_file_name}]
+
+        with mock.patch('harbour.views.TwoPointOhLibraries.get_s3_library',
+                        side_effect=get_s3_library):
+            r = self.client.post(
+                url_for('bulktwopointohlibraries', format='ndjson'),
+                data=json.dumps({'uids': range(10, 18)})
+            )
+            results = [json.loads(line) for line in r.data.splitlines()]
+
+        self.assertStatus(r, 200)
+        self.assertEqual(r.mimetype, 'application/x-ndjson')
+        self.assertEqual(in_flight[1], 4)
+
+        results = {result['uid']: result for result in results}
+        self.assertEqual(sorted(results), range(10, 18))
+        self.assertEqual(results[13]['code'], TWOPOINTOH_AWS_PROBLEM['code'])
+        self.assertEqual(results[14]['libraries'], [{'name': '14.json'}])
+
+    @mock_s3
+    def test_get_libraries_end_point_is_served_from_the_cache(self):
+        """
+        Test that once a library file has been fetched, repeat requests are
+        served from the cache without going to S3
+        """
+        TestADSTwoPointOhLibraries.helper_s3_mock_setup()
+
+        user = Users(
+            absolute_uid=10,
+            twopointoh_email='user@ads.com'
+        )
+        db.session.add(user)
+        db.session.commit()
+
+        url = url_for('twopointohlibraries', uid=10)
+        r = self.client.get(url)
+        self.assertStatus(r, 200)
+
+        with mock.patch('harbour.s3.S3.get_object') as mock_get:
+            mock_get.side_effect = Exception('S3 should not be used')
+            r_cached = self.client.get(url)
+
+        self.assertStatus(r_cached, 200)
+        self.assertEqual(r_cached.json, r.json)
+
+        stats = self.app.extensions['library_cache'].stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 1)
+
+        # The JSON is kept, rather than the larger decoded library
+        cached = self.app.extensions['library_cache'].get(
+            'cb16a523-cdba-406b-bfff-edfd428248be.json'
+        )
+        self.assertIsInstance(cached, basestring)
+        self.assertEqual(stats['bytes'], len(cached))
+
+    @mock_s3
+    def test_get_libraries_end_point_streams_the_library_file(self):
+        """
+        Test that in pass-through mode the library file is streamed from S3
+        in the same envelope, and with the same content, as when it is decoded
+        """
+        TestADSTwoPointOhLibraries.helper_s3_mock_setup()
+        self.app.config['ADS_TWO_POINT_OH_LIBRARY_PASSTHROUGH'] = True
+        self.app.config['ADS_TWO_POINT_OH_LIBRARY_CHUNK_SIZE'] = 8
+
+        user = Users(
+            absolute_uid=10,
+            twopointoh_email='user@ads.com'
+        )
+        db.session.add(user)
+        db.session.commit()
+
+        url = url_for('twopointohlibraries', uid=10)
+        r = self.client.get(url)
+
+        self.assertStatus(r, 200)
+        self.assertEqual(r.headers['Content-Type'], 'application/json')
+        self.assertEqual(
+            int(r.headers['Content-Length']),
+            len(r.get_data())
+        )
+        self.assertEqual(
+            json.loads(r.get_data())['libraries'][0]['name'],
+            'Name'
+        )
+        self.assertEqual(
+            self.app.extensions['library_cache'].stats()['entries'],
+            0
+        )
+
     def test_get_libraries_end_point_when_no_user(self):
         """
         Test when this user does not have any libraries
@@ -694,12 +1038,12 @@ class TestADSTwoPointOhLibraries(TestBaseDatabase):
         self.assertStatus(r, NO_TWOPOINTOH_ACCOUNT['code'])
         self.assertEqual(r.json['error'], NO_TWOPOINTOH_ACCOUNT['message'])
 
-    @mock.patch('harbour.app.boto3.resource')
-    def test_get_libraries_end_point_when_aws_s3_error(self, mock_resource):
+    @mock.patch('harbour.s3.S3.get_object')
+    def test_get_libraries_end_point_when_aws_s3_error(self, mock_get):
         """
         Test when this user has not associated any ADS 2.0 (classic) account
         """
-        mock_resource.side_effect = Exception('Custom Error')
+        mock_get.side_effect = Exception('Custom Error')
 
         user = Users(
             absolute_uid=10,
@@ -794,6 +1138,10 @@ class TestExportADSTwoPointOhLibraries(TestBaseDatabase):
         #     Key='cb16a523-cdba-406b-bfff-edfd428248be.zotero.zip',
         #     Body=zip_io.getvalue()
         # )
+        bucket.put_object(
+            Key='cb16a523-cdba-406b-bfff-edfd428248be.zotero.zip',
+            Body='zip'
+        )
 
     @mock_s3
     def create_app(self):
@@ -804,7 +1152,7 @@ class TestExportADSTwoPointOhLibraries(TestBaseDatabase):
         TestExportADSTwoPointOhLibraries.helper_s3_mock_setup()
 
         # Setup the app
-        app_ = create_app()
+        app_ = self.helper_create_app()
         app_.config['CLASSIC_LOGGING'] = {}
         app_.config['SQLALCHEMY_BINDS'] = {}
 
@@ -913,12 +1261,12 @@ class TestExportADSTwoPointOhLibraries(TestBaseDatabase):
         self.assertNotIn('tag1', zip_content['Name2.bib'],)
         self.assertNotIn('notes =', zip_content['Name2.bib'])
 
-    @mock.patch('harbour.views.boto3.client')
-    def test_get_export_end_point_when_aws_s3_error(self, mock_resource):
+    @mock.patch('harbour.s3.S3.generate_presigned_url')
+    def test_get_export_end_point_when_aws_s3_error(self, mock_presign):
         """
         Test when there is an issue loading/accessing S3 storage
         """
-        mock_resource.side_effect = Exception('Custom Error')
+        mock_presign.side_effect = Exception('Custom Error')
 
         user = Users(
             absolute_uid=10,
@@ -975,6 +1323,7 @@ class TestExportADSTwoPointOhLibraries(TestBaseDatabase):
 
         # Setup S3 storage
         TestExportADSTwoPointOhLibraries.helper_s3_mock_setup()
+        self.assertTrue(load_export_index(self.app))
 
         url = url_for('exporttwopointohlibraries', export='zotero')
         r = self.client.get(url, headers={USER_ID_KEYWORD: 10})
@@ -983,6 +1332,70 @@ class TestExportADSTwoPointOhLibraries(TestBaseDatabase):
             r.json['url'],
         )
 
+    @mock_s3
+    @mock.patch('harbour.s3.S3.generate_presigned_url')
+    def test_export_that_does_not_exist_is_not_available(self, mock_presign):
+        """
+        The user should be told straight away when there is no export of the
+        type they asked for, rather than be given a URL that does not work
+        """
+        user = Users(
+            absolute_uid=10,
+            twopointoh_email='user@ads.com'
+        )
+        db.session.add(user)
+        db.session.commit()
+
+        # Only the zotero export exists
+        TestExportADSTwoPointOhLibraries.helper_s3_mock_setup()
+        self.assertTrue(load_export_index(self.app))
+
+        url = url_for('exporttwopointohlibraries', export='mendeley')
+        r = self.client.get(url, headers={USER_ID_KEYWORD: 10})
+
+        self.assertStatus(r, TWOPOINTOH_EXPORT_NOT_AVAILABLE['code'])
+        self.assertEqual(
+            r.json['error'],
+            TWOPOINTOH_EXPORT_NOT_AVAILABLE['message']
+        )
+        self.assertFalse(mock_presign.called)
+
+    @mock.patch('harbour.s3.S3.generate_presigned_url')
+    def test_temporary_url_is_reused_while_valid(self, mock_presign):
+        """
+        The same temporary url should be handed out again, rather than being
+        signed on every request, and the user told how long to keep it for
+        """
+        mock_presign.return_value = 'https://adsabs-mongogut/export.zip'
+
+        user = Users(
+            absolute_uid=10,
+            twopointoh_email='user@ads.com'
+        )
+        db.session.add(user)
+        db.session.commit()
+
+        url = url_for('exporttwopointohlibraries', export='zotero')
+        responses = [
+            self.client.get(url, headers={USER_ID_KEYWORD: 10})
+            for _ in range(2)
+        ]
+        for r in responses:
+            self.assertStatus(r, 200)
+            self.assertEqual(
+                r.json['url'],
+                'https://adsabs-mongogut/export.zip'
+            )
+
+        self.assertEqual(mock_presign.call_count, 1)
+        self.assertEqual(
+            responses[0].headers['Cache-Control'],
+            'private, max-age={}'.format(
+                self.app.config['HARBOUR_EXPORT_URL_EXPIRES_IN'] -
+                self.app.config['HARBOUR_EXPORT_URL_MIN_VALIDITY']
+            )
+        )
+
 
 class TestClassicLibraries(TestBaseDatabase):
     """
@@ -1059,7 +1472,7 @@ class TestClassicLibraries(TestBaseDatabase):
         self.assertStatus(r, NO_CLASSIC_ACCOUNT['code'])
         self.assertEqual(r.json['error'], NO_CLASSIC_ACCOUNT['message'])
 
-    @mock.patch('harbour.views.requests.get')
+    @mock.patch('harbour.classic.ClassicClient.get')
     def test_get_libraries_when_ads_classic_timesout(self, mocked_get):
         """
         Test that if ADS Classic times out before finishing the request, that
@@ -1083,6 +1496,35 @@ class TestClassicLibraries(TestBaseDatabase):
         self.assertStatus(r, CLASSIC_TIMEOUT['code'])
         self.assertEqual(r.json['error'], CLASSIC_TIMEOUT['message'])
 
+    @mock.patch('harbour.classic.ClassicClient.get')
+    def test_get_libraries_when_ads_classic_connection_fails(self, mocked_get):
+        """
+        Test that a mirror that cannot be reached is reported as timing out,
+        and that any other failure of the request is a known error too
+        """
+        user = Users(
+            absolute_uid=10,
+            classic_cookie='ef9df8ds',
+            classic_mirror='mirror.com',
+            classic_email='user@ads.com'
+        )
+        db.session.add(user)
+        db.session.commit()
+
+        url = url_for('classiclibraries', uid=10)
+
+        mocked_get.side_effect = ConnectionError('Connection reset')
+        r = self.client.get(url)
+
+        self.assertStatus(r, CLASSIC_TIMEOUT['code'])
+        self.assertEqual(r.json['error'], CLASSIC_TIMEOUT['message'])
+
+        mocked_get.side_effect = TooManyRedirects
+        r = self.client.get(url)
+
+        self.assertStatus(r, CLASSIC_UNKNOWN_ERROR['code'])
+        self.assertEqual(r.json['error'], CLASSIC_UNKNOWN_ERROR['message'])
+
     def test_get_libraries_when_ads_classic_returns_non_200(self):
         """
         Tests that the expected response is returned when ADS classic returns a
@@ -1103,3 +1545,457 @@ class TestClassicLibraries(TestBaseDatabase):
 
         self.assertStatus(r, CLASSIC_UNKNOWN_ERROR['code'])
         self.assertEqual(r.json['error'], CLASSIC_UNKNOWN_ERROR['message'])
+
+    def helper_classic_user(self, cookie='ef9df8ds'):
+        """
+        Stub out a user with an ADS Classic account in the database
+        """
+        user = Users(
+            absolute_uid=10,
+            classic_cookie=cookie,
+            classic_mirror='mirror.com',
+            classic_email='user@ads.com'
+        )
+        db.session.add(user)
+        db.session.commit()
+        return user
+
+    def test_get_libraries_from_the_cache(self):
+        """
+        Test that libraries fetched once are returned again without contacting
+        ADS Classic
+        """
+        self.helper_classic_user()
+        url = url_for('classiclibraries', uid=10)
+
+        with HTTMock(ads_classic_libraries_200):
+            first = self.client.get(url)
+
+        with mock.patch('harbour.classic.ClassicClient.get') as mocked_get:
+            mocked_get.side_effect = Timeout
+            second = self.client.get(url)
+
+        self.assertStatus(second, 200)
+        self.assertEqual(second.json, first.json)
+        self.assertFalse(mocked_get.called)
+
+    @mock.patch('harbour.views.ClassicLibraries.refresh_in_background')
+    def test_get_stale_libraries_while_they_are_refreshed(self, mock_refresh):
+        """
+        Test that expired libraries are still returned, and fetched again in
+        the background, rather than the request waiting for ADS Classic
+        """
+        self.helper_classic_user()
+        url = url_for('classiclibraries', uid=10)
+
+        with HTTMock(ads_classic_libraries_200):
+            first = self.client.get(url)
+
+        cache = self.app.extensions['classic_libraries_cache']
+        cache.get_stale(10).expires = time.time() - 1
+
+        with HTTMock(ads_classic_fail):
+            second = self.client.get(url)
+
+        self.assertStatus(second, 200)
+        self.assertEqual(second.json, first.json)
+        mock_refresh.assert_called_once_with(10, ('mirror.com', 'ef9df8ds'))
+
+    def test_refreshes_are_bounded_by_the_pool(self):
+        """
+        Test that the libraries are refreshed on the pool of threads of the
+        process, and that refreshes beyond its workers are dropped rather than
+        given threads of their own
+        """
+        self.app.config['ADS_CLASSIC_LIBRARIES_REFRESH_WORKERS'] = 2
+        cache = self.app.extensions['classic_libraries_cache']
+
+        release = threading.Event()
+        fetched = []
+
+        def fetch_classic_libraries(source):
+            fetched.append(source)
+            release.wait(5)
+            return [], 10, None
+
+        with mock.patch('harbour.views.ClassicLibraries.'
+                        'fetch_classic_libraries',
+                        side_effect=fetch_classic_libraries):
+            for uid in range(10, 20):
+                ClassicLibraries.refresh_in_background(
+                    uid, ('mirror.com', 'cookie{}'.format(uid))
+                )
+            # Two refreshes are running, the others were dropped
+            self.assertFalse(cache.start_refresh(30, limit=2))
+
+            release.set()
+            for _ in range(100):
+                if len(cache) == 2:
+                    break
+                time.sleep(0.01)
+
+        self.assertEqual(len(fetched), 2)
+        self.assertEqual(len(cache), 2)
+        self.assertTrue(cache.start_refresh(30, limit=2))
+
+    def test_get_libraries_again_when_the_cookie_has_changed(self):
+        """
+        Test that cached libraries are not used once the user has a new cookie,
+        eg., after authenticating again with another process
+        """
+        user = self.helper_classic_user()
+        url = url_for('classiclibraries', uid=10)
+
+        with HTTMock(ads_classic_libraries_200):
+            self.client.get(url)
+
+        user.classic_cookie = 'new cookie'
+        db.session.commit()
+
+        # This process sees the new cookie once its copy of the row expires
+        self.app.extensions['users_cache'].clear()
+
+        with HTTMock(ads_classic_fail):
+            r = self.client.get(url)
+
+        self.assertStatus(r, CLASSIC_UNKNOWN_ERROR['code'])
+
+    def test_cached_libraries_are_dropped_when_the_user_authenticates(self):
+        """
+        Test that authenticating again with ADS Classic drops the libraries
+        cached for the user
+        """
+        self.helper_classic_user()
+        url = url_for('classiclibraries', uid=10)
+
+        with HTTMock(ads_classic_libraries_200):
+            self.client.get(url)
+
+        cache = self.app.extensions['classic_libraries_cache']
+        self.assertIsNotNone(cache.get_stale(10))
+
+        with HTTMock(ads_classic_200):
+            r = self.client.post(
+                url_for('authenticateuserclassic'),
+                data=self.stub_user_data,
+                headers={USER_ID_KEYWORD: 10}
+            )
+
+        self.assertStatus(r, 200)
+        self.assertIsNone(cache.get_stale(10))
+
+    def test_large_libraries_are_streamed(self):
+        """
+        Test that libraries larger than the streaming threshold are streamed
+        through, the same as when they are buffered, and are not cached
+        """
+        self.helper_classic_user()
+        url = url_for('classiclibraries', uid=10)
+
+        with HTTMock(ads_classic_libraries_200_with_length):
+            buffered = self.client.get(url)
+
+        cache = self.app.extensions['classic_libraries_cache']
+        cache.clear()
+
+        self.app.config['ADS_CLASSIC_LIBRARIES_STREAM_BYTES'] = 10
+        self.app.config['ADS_CLASSIC_LIBRARIES_CHUNK_SIZE'] = 16
+        with HTTMock(ads_classic_libraries_200_with_length):
+            streamed = self.client.get(url)
+
+        self.assertStatus(streamed, 200)
+        self.assertTrue(streamed.is_streamed)
+        self.assertEqual(json.loads(streamed.data), buffered.json)
+        self.assertIsNone(cache.get_stale(10))
+
+    def test_large_libraries_without_a_length_are_streamed(self):
+        """
+        Test that a response that does not say how large it is is streamed
+        through once more than the streaming threshold has been read, with
+        the libraries read until then sent first
+        """
+        self.helper_classic_user()
+        url = url_for('classiclibraries', uid=10)
+
+        with HTTMock(ads_classic_libraries_200):
+            buffered = self.client.get(url)
+
+        cache = self.app.extensions['classic_libraries_cache']
+        cache.clear()
+
+        self.app.config['ADS_CLASSIC_LIBRARIES_STREAM_BYTES'] = 100
+        self.app.config['ADS_CLASSIC_LIBRARIES_CHUNK_SIZE'] = 16
+        with HTTMock(ads_classic_libraries_200):
+            streamed = self.client.get(url)
+
+        self.assertStatus(streamed, 200)
+        self.assertTrue(streamed.is_streamed)
+        self.assertEqual(json.loads(streamed.data), buffered.json)
+        self.assertIsNone(cache.get_stale(10))
+
+    def test_failure_while_streaming_cuts_the_libraries_short(self):
+        """
+        Test that if ADS Classic fails part way through libraries that are
+        streamed, the error is logged and the document left unfinished,
+        rather than passed off as all of the libraries
+        """
+        self.helper_classic_user()
+        url = url_for('classiclibraries', uid=10)
+
+        def failing_libraries(reader):
+            yield {'name': 'Name', 'description': '', 'documents': []}
+            raise requests.exceptions.ConnectionError('Connection reset')
+
+        self.app.config['ADS_CLASSIC_LIBRARIES_STREAM_BYTES'] = 10
+        with HTTMock(ads_classic_libraries_200_with_length), \
+                mock.patch('harbour.views.ClassicLibraries.'
+                           'iter_classic_libraries',
+                           staticmethod(failing_libraries)), \
+                mock.patch.object(self.app.logger, 'error') as mock_error:
+            r = self.client.get(url)
+            data = r.data
+
+        self.assertStatus(r, 200)
+        self.assertTrue(data.startswith(b'{"libraries": [{"'))
+        with self.assertRaises(ValueError):
+            json.loads(data)
+        self.assertEqual(mock_error.call_count, 1)
+
+    def test_mirror_that_stalls_in_the_body(self):
+        """
+        Test that a mirror that sends the headers and part of the libraries,
+        and then stops, times out, counts as failing and as taking the whole
+        timeout, and gives back its connection and its place under the cap
+        """
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        stop = threading.Event()
+
+        def stalling_mirror():
+            connection, _ = listener.accept()
+            connection.recv(4096)
+            connection.sendall(
+                b'HTTP/1.1 200 OK\r\n'
+                b'Content-Type: application/json\r\n'
+                b'Content-Length: 1000\r\n\r\n'
+                b'{"libraries": [{"name": "Name", "entries": ['
+            )
+            stop.wait(5)
+            connection.close()
+
+        server = threading.Thread(target=stalling_mirror)
+        server.daemon = True
+        server.start()
+        self.addCleanup(listener.close)
+        self.addCleanup(stop.set)
+
+        mirror = '127.0.0.1:{}'.format(listener.getsockname()[1])
+        self.helper_classic_user()
+        Users.query.filter_by(absolute_uid=10).update(
+            {'classic_mirror': mirror}
+        )
+        db.session.commit()
+        self.app.config['ADS_CLASSIC_READ_TIMEOUT'] = 0.5
+
+        r = self.client.get(url_for('classiclibraries', uid=10))
+
+        self.assertStatus(r, CLASSIC_TIMEOUT['code'])
+        state = self.app.extensions['classic'].get_mirror(mirror)
+        self.assertEqual(state.breaker.failures, 1)
+        self.assertEqual(state.latency('libraries').percentile(100), 0.5)
+        self.assertEqual(state.in_flight, 0)
+        self.assertEqual(state.bulkhead.free, state.bulkhead.size)
+
+
+class TestBulkClassicLibraries(TestBaseDatabase):
+    """
+    Tests the bulk libraries end point that returns the libraries from ADS
+    classic of many users at once
+    """
+    def helper_classic_users(self, uids, mirror='mirror.com'):
+        """
+        Stub out users with an ADS Classic account in the database
+        """
+        for uid in uids:
+            db.session.add(Users(
+                absolute_uid=uid,
+                classic_cookie='cookie{}'.format(uid),
+                classic_mirror=mirror,
+                classic_email='user{}@ads.com'.format(uid)
+            ))
+        db.session.commit()
+
+    def test_results_and_errors_are_returned_together(self):
+        """
+        Test that the results of all of the users are returned in the order
+        of the uids, with an error for those without libraries
+        """
+        self.helper_classic_users([10, 11])
+        db.session.add(Users(absolute_uid=12, twopointoh_email='u@ads.com'))
+        db.session.commit()
+
+        with HTTMock(ads_classic_libraries_200):
+            r = self.client.post(
+                url_for('bulkclassiclibraries'),
+                data=json.dumps({'uids': [11, 12, 13, 10, 11]})
+            )
+
+        self.assertStatus(r, 200)
+        results = r.json['results']
+        self.assertEqual([result['uid'] for result in results],
+                         [11, 12, 13, 10])
+
+        for result in results[1:3]:
+            self.assertEqual(result['error'], NO_CLASSIC_ACCOUNT['message'])
+            self.assertEqual(result['code'], NO_CLASSIC_ACCOUNT['code'])
+
+        with HTTMock(ads_classic_libraries_200):
+            single = self.client.get(url_for('classiclibraries', uid=10))
+        self.assertEqual(results[0]['libraries'], single.json['libraries'])
+        self.assertEqual(results[3]['libraries'], single.json['libraries'])
+
+    def test_timeouts_are_per_user(self):
+        """
+        Test that a user whose libraries time out gets an error, without
+        failing the request
+        """
+        self.helper_classic_users([10])
+
+        with mock.patch('harbour.classic.ClassicClient.get') as mocked_get:
+            mocked_get.side_effect = Timeout
+            r = self.client.post(
+                url_for('bulkclassiclibraries'),
+                data=json.dumps({'uids': [10]})
+            )
+
+        self.assertStatus(r, 200)
+        self.assertEqual(r.json['results'], [{
+            'uid': 10,
+            'error': CLASSIC_TIMEOUT['message'],
+            'code': CLASSIC_TIMEOUT['code']
+        }])
+
+    def test_malformed_requests(self):
+        """
+        Test that a missing, empty or too long list of uids is refused
+        """
+        self.app.config['ADS_CLASSIC_BULK_MAX_UIDS'] = 2
+        for data, error in [({}, BULK_DATA_MALFORMED),
+                            ({'uids': []}, BULK_DATA_MALFORMED),
+                            ({'uids': 10}, BULK_DATA_MALFORMED),
+                            ({'uids': ['a']}, BULK_DATA_MALFORMED),
+                            ({'uids': [1, 2, 3]}, BULK_TOO_MANY_UIDS)]:
+            r = self.client.post(
+                url_for('bulkclassiclibraries'),
+                data=json.dumps(data)
+            )
+            self.assertStatus(r, error['code'])
+            self.assertEqual(r.json['error'], error['message'])
+
+    def test_ndjson(self):
+        """
+        Test that results can be streamed one per line
+        """
+        self.helper_classic_users([10, 11])
+
+        with HTTMock(ads_classic_libraries_200):
+            r = self.client.post(
+                url_for('bulkclassiclibraries', format='ndjson'),
+                data=json.dumps({'uids': [10, 11, 12]})
+            )
+            # The libraries are only fetched as the response is read
+            results = [json.loads(line) for line in r.data.splitlines()]
+
+        self.assertStatus(r, 200)
+        self.assertEqual(r.mimetype, 'application/x-ndjson')
+        self.assertEqual(sorted(result['uid'] for result in results),
+                         [10, 11, 12])
+        self.assertEqual(
+            sorted('libraries' in result for result in results),
+            [False, True, True]
+        )
+
+    def test_concurrency_is_capped_per_mirror(self):
+        """
+        Test that the libraries are fetched concurrently, but with no more
+        requests in flight to a mirror than allowed
+        """
+        self.helper_classic_users(range(10, 16), mirror='mirror.com')
+        self.helper_classic_users(range(20, 26), mirror='other.mirror.com')
+        self.app.config['ADS_CLASSIC_BULK_WORKERS'] = 8
+        self.app.config['ADS_CLASSIC_BULK_MIRROR_CONCURRENCY'] = 2
+
+        lock = threading.Lock()
+        in_flight = {'mirror.com': 0, 'other.mirror.com': 0}
+        most = dict(in_flight, total=0)
+
+        def lookup(uid, source):
+            with lock:
+                in_flight[source[0]] += 1
+                most[source[0]] = max(most[source[0]], in_flight[source[0]])
+                most['total'] = max(most['total'], sum(in_flight.values()))
+            time.sleep(0.05)
+            with lock:
+                in_flight[source[0]] -= 1
+            return [], None, None
+
+        with mock.patch('harbour.views.ClassicLibraries.lookup',
+                        side_effect=lookup):
+            r = self.client.post(
+                url_for('bulkclassiclibraries'),
+                data=json.dumps({'uids': range(10, 16) + range(20, 26)})
+            )
+
+        self.assertStatus(r, 200)
+        self.assertEqual(len(r.json['results']), 12)
+        self.assertLessEqual(most['mirror.com'], 2)
+        self.assertLessEqual(most['other.mirror.com'], 2)
+        self.assertGreater(most['total'], 2)
+
+    def test_mirror_cap_and_threads_are_shared_by_the_requests(self):
+        """
+        Test that the cap per mirror holds across the bulk requests of the
+        process, that a user whose mirror stays busy fails after waiting, and
+        that the requests reuse the same pool of threads
+        """
+        self.helper_classic_users([10], mirror='mirror.com')
+        self.helper_classic_users([20], mirror='other.mirror.com')
+        self.app.config['ADS_CLASSIC_BULK_MIRROR_CONCURRENCY'] = 1
+        self.app.config['ADS_CLASSIC_BULK_QUEUE_TIMEOUT'] = 0.1
+
+        # Another bulk request has the only place of the mirror
+        bulkhead = self.app.extensions['classic'].get_mirror(
+            'mirror.com'
+        ).bulk_bulkhead
+        bulkhead.acquire()
+
+        pools = self.app.extensions['worker_pools']
+        with mock.patch('harbour.views.ClassicLibraries.lookup',
+                        return_value=([], None, None)):
+            try:
+                r = self.client.post(
+                    url_for('bulkclassiclibraries'),
+                    data=json.dumps({'uids': [10, 20]})
+                )
+            finally:
+                bulkhead.release()
+            pool = pools.get('classic-bulk', 1)
+
+            self.assertStatus(r, 200)
+            self.assertEqual(r.json['results'], [
+                {'uid': 10, 'error': CLASSIC_TIMEOUT['message'],
+                 'code': CLASSIC_TIMEOUT['code']},
+                {'uid': 20, 'libraries': []}
+            ])
+
+            r = self.client.post(
+                url_for('bulkclassiclibraries'),
+                data=json.dumps({'uids': [10, 20]})
+            )
+
+        self.assertEqual(r.json['results'], [
+            {'uid': 10, 'libraries': []},
+            {'uid': 20, 'libraries': []}
+        ])
+        self.assertIs(pools.get('classic-bulk', 1), pool)
@@ -0,0 +1,284 @@
+"""
+Memory-mapped index of the ADS 2.0 users, mapping e-mail to library file name.
+
+The index is a flat file written once per host, which every worker then maps
+read-only. The pages are shared between the processes by the kernel, so the
+mapping is held once per host rather than once per worker.
+
+File layout (little-endian):
+    header: magic, number of entries, length of the tag
+    tag: version of users.json the index was built from (the S3 ETag)
+    offsets: number of entries + 1 unsigned ints, start of each record
+    records: "<e-mail>\0<library file name>", sorted by e-mail
+"""
+import os
+import sys
+import mmap
+import time
+import errno
+import fcntl
+import struct
+import tempfile
+
+from contextlib import contextmanager
+
+MAGIC = b'HBU1'
+HEADER = struct.Struct('<4sII')
+OFFSET = struct.Struct('<I')
+
+# Seconds between attempts to take a host lock under gevent
+LOCK_POLL_INTERVAL = 0.05
+
+
+class UsersIndex(object):
+    """
+    Read-only view of an index file, looked up with a binary search over the
+    sorted e-mails. Behaves like the read-only parts of a dict.
+    """
+    def __init__(self, path):
+        """
+        Constructor
+        :param path: path of the index file
+        :type path: str
+        """
+        with open(path, 'rb') as index_file:
+            self._map = mmap.mmap(
+                index_file.fileno(), 0, access=mmap.ACCESS_READ
+            )
+
+        magic, self._count, tag_length = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC:
+            self._map.close()
+            raise ValueError('{0} is not a users index'.format(path))
+
+        self.path = path
+        self.etag = self._map[HEADER.size:HEADER.size + tag_length]
+        self._offsets = HEADER.size + tag_length
+
+    def __len__(self):
+        return self._count
+
+    def __contains__(self, email):
+        return self.get(email) is not None
+
+    def _record(self, position):
+        """
+        Return the e-mail and library file name of the nth record, as bytes
+        """
+        start, end = struct.unpack_from(
+            '<II', self._map, self._offsets + position * OFFSET.size
+        )
+        separator = self._map.find(b'\0', start, end)
+        return self._map[start:separator], self._map[separator + 1:end]
+
+    def get(self, email, default=None):
+        """
+        Look up the library file name of a user
+        :param email: ADS 2.0 e-mail of the user
+        :param default: returned when the e-mail is not in the index
+
+        :return: library file name
+        """
+        if isinstance(email, unicode):
+            email = email.encode('utf-8')
+
+        low, high = 0, self._count
+        while low < high:
+            middle = (low + high) // 2
+            key, value = self._record(middle)
+            if key < email:
+                low = middle + 1
+            elif key > email:
+                high = middle
+            else:
+                return value.decode('utf-8')
+
+        return default
+
+    def iteritems(self):
+        for position in xrange(self._count):
+            key, value = self._record(position)
+            yield key.decode('utf-8'), value.decode('utf-8')
+
+    def items(self):
+        return list(self.iteritems())
+
+    def close(self):
+        self._map.close()
+
+
+def open_users_index(path):
+    """
+    Open an existing index, if there is a valid one
+    :param path: path of the index file
+
+    :return: UsersIndex or None
+    """
+    try:
+        return UsersIndex(path)
+    except (IOError, OSError, ValueError, struct.error):
+        return None
+
+
+def write_users_index(path, items, etag=''):
+    """
+    Write a new index file. It is written to a temporary file first and then
+    renamed over the old index, so that readers never see a partial index and
+    processes that still map the old file are unaffected.
+    :param path: path of the index file
+    :param items: iterable of (e-mail, library file name)
+    :param etag: version of users.json the items came from
+    """
+    encode = lambda text: text.encode('utf-8') \
+        if isinstance(text, unicode) else str(text)
+
+    etag = encode(etag)
+    records = sorted(
+        (encode(email), encode(file_name)) for email, file_name in items
+    )
+    # Duplicate e-mails keep the last file name, as a dict would
+    records = [
+        record for i, record in enumerate(records)
+        if i + 1 == len(records) or records[i + 1][0] != record[0]
+    ]
+
+    directory = os.path.dirname(os.path.abspath(path))
+    handle, tmp_path = tempfile.mkstemp(dir=directory, prefix='.users.')
+    try:
+        with os.fdopen(handle, 'wb') as index_file:
+            index_file.write(HEADER.pack(MAGIC, len(records), len(etag)))
+            index_file.write(etag)
+
+            offset = HEADER.size + len(etag) + \
+                (len(records) + 1) * OFFSET.size
+            for email, file_name in records:
+                index_file.write(OFFSET.pack(offset))
+                offset += len(email) + len(file_name) + 1
+            index_file.write(OFFSET.pack(offset))
+
+            for email, file_name in records:
+                index_file.write(email + b'\0' + file_name)
+
+            index_file.flush()
+            os.fsync(index_file.fileno())
+
+        os.chmod(tmp_path, 0644)
+        os.rename(tmp_path, path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+
+def _cooperative():
+    """
+    Whether the process serves its requests on gevent's event loop (see
+    serving.py), where only sockets and sleeps yield to the other requests
+    """
+    monkey = sys.modules.get('gevent.monkey')
+    return monkey is not None and monkey.is_module_patched('time')
+
+
+def _flock(lock_file):
+    if _cooperative():
+        # Waiting in flock would stall every request of the process, so the
+        # lock is polled instead
+        while True:
+            try:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return
+            except IOError as error:
+                if error.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+                time.sleep(LOCK_POLL_INTERVAL)
+    else:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+
+
+def _is_current(lock_file, lock_path):
+    try:
+        locked, current = os.fstat(lock_file.fileno()), os.stat(lock_path)
+    except OSError:
+        return False
+    return (locked.st_dev, locked.st_ino) == (current.st_dev, current.st_ino)
+
+
+@contextmanager
+def host_lock(path):
+    """
+    Exclusive lock shared by all the processes on the host, so that only one
+    of them builds the index at a time
+    :param path: path of the index file
+    """
+    lock_path = '{0}.lock'.format(path)
+    while True:
+        lock_file = open(lock_path, 'a')
+        try:
+            _flock(lock_file)
+        except BaseException:
+            lock_file.close()
+            raise
+        # The lock file may have been removed while this process waited for
+        # it (see remove_host_lock), in which case the lock is taken again
+        if _is_current(lock_file, lock_path):
+            break
+        lock_file.close()
+
+    try:
+        yield
+    finally:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+        lock_file.close()
+
+
+def remove_host_lock(path):
+    """
+    Remove the lock file of host_lock, unless a process holds the lock
+    :param path: path given to host_lock
+
+    :return: True if the lock file was removed
+    """
+    lock_path = '{0}.lock'.format(path)
+    try:
+        lock_file = open(lock_path, 'r')
+    except IOError:
+        return False
+
+    with lock_file:
+        try:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as error:
+            if error.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            return False
+        try:
+            if not _is_current(lock_file, lock_path):
+                return False
+            os.remove(lock_path)
+            return True
+        finally:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+
+def get_users_index(path, etag, fetch):
+    """
+    Return the index for the given version of users.json. If another process
+    on this host has already built it, it is opened as is, otherwise it is
+    built from the items returned by fetch.
+    :param path: path of the index file
+    :param etag: current version of users.json
+    :param fetch: callable returning (etag, iterable of items)
+
+    :return: UsersIndex
+    """
+    with host_lock(path):
+        index = open_users_index(path)
+        if index is not None and index.etag == etag:
+            return index
+
+        if index is not None:
+            index.close()
+
+        etag, items = fetch()
+        write_users_index(path, items, etag=etag)
+
+    return UsersIndex(path)
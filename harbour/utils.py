@@ -3,6 +3,16 @@ Contains useful functions and utilities that are not neccessarily only useful
 for this module. But are also used in differing modules insidide the same
 project, and so do not belong to anything specific.
 """
+import re
+import json
+import codecs
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+_OBJECT_START = re.compile(r'[ \t\n\r]*\{')
+_KEY_SEPARATOR = re.compile(r'[ \t\n\r]*:[ \t\n\r]*')
+_ITEM_SEPARATOR = re.compile(r'[ \t\n\r]*([,}])')
+_ARRAY_START = re.compile(r'[ \t\n\r]*\[')
+_ELEMENT_SEPARATOR = re.compile(r'[ \t\n\r]*([,\]])')
 
 
 def get_post_data(request, types={}):
@@ -41,3 +51,198 @@ def err(error_dictionary):
     :return: tuple of error message and error number
     """
     return {'error': error_dictionary['message']}, error_dictionary['code']
+
+
+def not_modified(error):
+    """
+    Whether a botocore ClientError is the answer of S3 to a conditional GET
+    (If-None-Match) for an object that has not changed
+    :param error: botocore.exceptions.ClientError
+    :return: bool
+    """
+    code = error.response.get('Error', {}).get('Code')
+    return code in ['304', 'NotModified']
+
+
+def _read_more(stream, decoder, pending, chunk_size):
+    """
+    Read more of a stream, after the text that could not be parsed yet. At
+    least as much again as is pending is read, so that a value spread over
+    many chunks is parsed again a logarithmic number of times, rather than
+    once per chunk, which would take quadratic time.
+    :param stream: file-like object with a read(size) method
+    :param decoder: incremental decoder of the stream
+    :param pending: text read but not parsed yet
+    :param chunk_size: number of bytes to read from the stream at a time
+    :return: the pending text followed by the text read, and whether the
+    stream is exhausted
+    """
+    text, size = [pending], 0
+    while size < max(chunk_size, len(pending)):
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            text.append(decoder.decode(b'', final=True))
+            return u''.join(text), True
+        size += len(chunk)
+        text.append(decoder.decode(chunk))
+    return u''.join(text), False
+
+
+def iter_json_object(stream, chunk_size=64 * 1024):
+    """
+    Incrementally parse a flat JSON object from a file-like stream, yielding
+    each (key, value) pair as soon as it has been read. Only the current chunk
+    and the pair being decoded are held in memory, never the whole document.
+    :param stream: file-like object with a read(size) method
+    :param chunk_size: number of bytes to read from the stream at a time
+    :return: generator of (key, value) tuples
+    """
+    scan_once = json.JSONDecoder().scan_once
+    utf8 = codecs.getincrementaldecoder('utf-8')()
+
+    buf, pos, consumed = u'', 0, 0
+    started, first, eof = False, True, False
+
+    while True:
+        # Decode a whole pair at a time; anything that does not parse is
+        # assumed to be cut short by the end of the chunk until the stream is
+        # exhausted. Requiring the "," or "}" that follows a value also stops
+        # a number split across two chunks being read as two numbers.
+        try:
+            if not started:
+                match = _OBJECT_START.match(buf, pos)
+                if not match:
+                    raise ValueError('Expected a JSON object')
+                pos, started = match.end(), True
+
+            pos = _WHITESPACE.match(buf, pos).end()
+            if first and buf[pos] == u'}':
+                return
+
+            key, end = scan_once(buf, pos)
+            match = _KEY_SEPARATOR.match(buf, end)
+            if not match:
+                raise ValueError('Expected ":" after key')
+
+            value, end = scan_once(buf, match.end())
+            match = _ITEM_SEPARATOR.match(buf, end)
+            if not match:
+                raise ValueError('Expected "," or "}" after value')
+
+        except (StopIteration, ValueError, IndexError):
+            if eof:
+                raise ValueError(
+                    'Could not decode JSON object at character {0}'
+                    .format(consumed + pos)
+                )
+            buf, eof = _read_more(stream, utf8, buf[pos:], chunk_size)
+            consumed, pos = consumed + pos, 0
+            continue
+
+        pos, first = match.end(), False
+        yield key, value
+
+        if match.group(1) == u'}':
+            return
+
+
+def iter_json_array(stream, key, chunk_size=64 * 1024):
+    """
+    Incrementally parse the array under one key of a JSON object from a
+    file-like stream, yielding each element as soon as it has been read. The
+    other members of the object are read and discarded. Only the current
+    chunk and the element being decoded are held in memory.
+    :param stream: file-like object with a read(size) method
+    :param key: key of the array in the object
+    :param chunk_size: number of bytes to read from the stream at a time
+    :return: generator of the elements
+    """
+    scan_once = json.JSONDecoder().scan_once
+    utf8 = codecs.getincrementaldecoder('utf-8')()
+
+    buf, pos, consumed = u'', 0, 0
+    state, eof = 'start', False
+
+    while True:
+        # As in iter_json_object, each step either parses completely and
+        # moves pos on, or is retried once more of the stream has been read
+        try:
+            if state == 'start':
+                match = _OBJECT_START.match(buf, pos)
+                if not match:
+                    raise ValueError('Expected a JSON object')
+                pos, state = match.end(), 'first member'
+
+            elif state in ('first member', 'member'):
+                start = _WHITESPACE.match(buf, pos).end()
+                if state == 'first member' and buf[start] == u'}':
+                    return
+
+                name, end = scan_once(buf, start)
+                match = _KEY_SEPARATOR.match(buf, end)
+                if not match:
+                    raise ValueError('Expected ":" after key')
+
+                if name == key:
+                    match = _ARRAY_START.match(buf, match.end())
+                    if not match:
+                        raise ValueError('Expected an array')
+                    pos, state = match.end(), 'first element'
+                    continue
+
+                _, end = scan_once(buf, match.end())
+                match = _ITEM_SEPARATOR.match(buf, end)
+                if not match:
+                    raise ValueError('Expected "," or "}" after value')
+                if match.group(1) == u'}':
+                    return
+                pos, state = match.end(), 'member'
+
+            elif state in ('first element', 'element'):
+                start = _WHITESPACE.match(buf, pos).end()
+                if state == 'first element' and buf[start] == u']':
+                    pos, state = start + 1, 'after array'
+                    continue
+
+                element, end = scan_once(buf, start)
+                match = _ELEMENT_SEPARATOR.match(buf, end)
+                if not match:
+                    raise ValueError('Expected "," or "]" after element')
+                pos = match.end()
+                state = 'after array' if match.group(1) == u']' else 'element'
+                yield element
+
+            else:
+                match = _ITEM_SEPARATOR.match(buf, pos)
+                if not match:
+                    raise ValueError('Expected "," or "}" after array')
+                if match.group(1) == u'}':
+                    return
+                pos, state = match.end(), 'member'
+
+        except (StopIteration, ValueError, IndexError):
+            if eof:
+                raise ValueError(
+                    'Could not decode JSON object at character {0}'
+                    .format(consumed + pos)
+                )
+            buf, eof = _read_more(stream, utf8, buf[pos:], chunk_size)
+            consumed, pos = consumed + pos, 0
+
+
+class ChunkReader(object):
+    """
+    File-like view of an iterator of chunks, eg., requests'
+    Response.iter_content, that counts the bytes read
+    """
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self.bytes_read = 0
+
+    def read(self, size=None):
+        """
+        Return the next chunk, whatever its size, or b'' at the end
+        """
+        chunk = next(self._chunks, b'')
+        self.bytes_read += len(chunk)
+        return chunk
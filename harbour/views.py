@@ -2,26 +2,32 @@
 """
 Views
 """
+import os
 import re
 import json
-import boto3
+import time
 import requests
+import threading
 import traceback
 
-from utils import get_post_data, err
-from flask import current_app, request, send_file
+from utils import get_post_data, err, not_modified, iter_json_array, \
+    ChunkReader
+from flask import current_app, request, send_file, Response
 from flask.ext.restful import Resource
 from flask.ext.discoverer import advertise
 from client import client
-from models import db, Users
+from models import db, Users, select_users
+from dbpool import pool_stats
 from zipfile import ZipFile
 from StringIO import StringIO
 from http_errors import CLASSIC_AUTH_FAILED, CLASSIC_DATA_MALFORMED, \
     CLASSIC_TIMEOUT, CLASSIC_BAD_MIRROR, CLASSIC_NO_COOKIE, \
     CLASSIC_UNKNOWN_ERROR, NO_CLASSIC_ACCOUNT, NO_TWOPOINTOH_ACCOUNT, \
     NO_TWOPOINTOH_LIBRARIES, TWOPOINTOH_AWS_PROBLEM, EXPORT_SERVICE_FAIL, \
-    TWOPOINTOH_WRONG_EXPORT_TYPE
+    TWOPOINTOH_WRONG_EXPORT_TYPE, TWOPOINTOH_USERS_NOT_READY, \
+    TWOPOINTOH_EXPORT_NOT_AVAILABLE, BULK_DATA_MALFORMED, BULK_TOO_MANY_UIDS
 from sqlalchemy.orm.exc import NoResultFound
+from botocore.exceptions import ClientError
 
 USER_ID_KEYWORD = 'X-Adsws-Uid'
 
@@ -49,6 +55,190 @@ class BaseView(Resource):
             current_app.logger.error('Unknow error with API')
             raise
 
+    @staticmethod
+    def helper_get_users(absolute_uids):
+        """
+        Helper function: get the users rows of many users, from the cache of
+        the process where possible, and otherwise with a single compiled
+        query, whose results are then cached (including the uids without a
+        row)
+        :param absolute_uids: user IDs for the API
+        :return: UserRecord by user ID, for those with a row
+        """
+        cache = current_app.extensions['users_cache']
+
+        # Users without a row are cached as an empty tuple
+        users, missing = {}, []
+        for absolute_uid in absolute_uids:
+            user = cache.get(absolute_uid)
+            if user is None:
+                missing.append(absolute_uid)
+            elif user:
+                users[absolute_uid] = user
+
+        if not missing:
+            return users
+
+        for user in select_users(missing):
+            users[user.absolute_uid] = BaseView.helper_cache_user(user)
+
+        for absolute_uid in missing:
+            if absolute_uid not in users:
+                cache.set(
+                    absolute_uid,
+                    (),
+                    size=len(repr(absolute_uid)),
+                    ttl=current_app.config['HARBOUR_USERS_CACHE_MISSING_TTL']
+                )
+
+        return users
+
+    @staticmethod
+    def helper_cache_user(user):
+        """
+        Helper function: cache the users row of a user in this process, eg.,
+        after it has been written
+        :param user: UserRecord
+        :return: user
+        """
+        current_app.extensions['users_cache'].set(
+            user.absolute_uid,
+            user,
+            size=len(repr(user))
+        )
+        return user
+
+    @staticmethod
+    def helper_get_user(absolute_uid):
+        """
+        Helper function: get the users row of a user, from the cache of the
+        process where possible, otherwise raise a NoResultFound exception
+        :param absolute_uid: user ID for the API
+        :return: UserRecord
+        """
+        user = BaseView.helper_get_users([absolute_uid]).get(absolute_uid)
+        if user is None:
+            raise NoResultFound
+        return user
+
+    @staticmethod
+    def helper_get_twopointoh_users():
+        """
+        Helper function: get the mapping of ADS 2.0 e-mail to library file
+        name, loading it first if the application loads it lazily
+        :return: mapping, or None if the users have not been loaded
+        """
+        if not current_app.config['ADS_TWO_POINT_OH_LOADED_USERS'] and \
+                'twopointoh_users_loader' in current_app.extensions:
+            current_app.extensions['twopointoh_users_loader']()
+
+        if not current_app.config['ADS_TWO_POINT_OH_LOADED_USERS']:
+            return None
+
+        return current_app.config['ADS_TWO_POINT_OH_USERS']
+
+    @staticmethod
+    def helper_get_bulk_uids(max_uids):
+        """
+        Helper function: get the list of user IDs posted to a bulk end point,
+        each once and in the order given
+        :param max_uids: most user IDs allowed in one request
+        :return: list of user IDs, or None and an error dictionary
+        """
+        try:
+            post_data = get_post_data(request, types=dict(uids=list))
+            uids = post_data['uids']
+            uids = [int(uid) for uid in uids if not isinstance(uid, bool)] \
+                if isinstance(uids, list) else None
+        except (KeyError, TypeError, ValueError):
+            uids = None
+
+        if not uids:
+            current_app.logger.warning('No list of uids was provided')
+            return None, BULK_DATA_MALFORMED
+
+        seen = set()
+        uids = [uid for uid in uids if not (uid in seen or seen.add(uid))]
+
+        if len(uids) > max_uids:
+            return None, BULK_TOO_MANY_UIDS
+
+        return uids, None
+
+    @staticmethod
+    def helper_classic_error(exception):
+        """
+        Helper function: the error to return when a request to ADS Classic
+        failed. A mirror that could not be reached, or stopped answering, is
+        reported as timing out.
+        :param exception: requests.exceptions.RequestException
+        :return: error dictionary
+        """
+        if isinstance(exception, (requests.exceptions.Timeout,
+                                  requests.exceptions.ConnectionError)):
+            return CLASSIC_TIMEOUT
+        return CLASSIC_UNKNOWN_ERROR
+
+    @staticmethod
+    def helper_bulk_error(uid, error):
+        """
+        Helper function: the result of a user for which a bulk end point
+        failed
+        :param uid: user ID for the API
+        :param error: error dictionary
+        :return: result dictionary
+        """
+        return {'uid': uid, 'error': error['message'], 'code': error['code']}
+
+    @staticmethod
+    def helper_bulk_response(uids, results, jobs, function, pool, workers):
+        """
+        Helper function: run the jobs of a bulk end point on the pool of
+        threads of the process, and return their results along with those
+        already known. With ?format=ndjson, the results are streamed one per
+        line as they complete, otherwise they are returned together in the
+        order of the user IDs. The jobs of a request that fails or is gone
+        are skipped, rather than left to hold up the pool.
+        :param uids: user IDs, in the order of the results
+        :param results: results already known, by user ID
+        :param jobs: tuples of arguments to function
+        :param function: takes the arguments of a job, and returns the result
+        dictionary of its user
+        :param pool: name of the pool of threads
+        :param workers: threads of the pool, if it has to be started
+        :return: flask.Response, or the results and status code
+        """
+        app = current_app._get_current_object()
+        cancelled = threading.Event()
+
+        def run(job):
+            if cancelled.is_set():
+                return None
+            with app.app_context():
+                return function(*job)
+
+        pool = current_app.extensions['worker_pools'].get(pool, workers)
+
+        if request.args.get('format') == 'ndjson':
+            def generate():
+                try:
+                    for result in results.values():
+                        yield json.dumps(result) + '\n'
+                    for result in pool.imap_unordered(run, jobs):
+                        yield json.dumps(result) + '\n'
+                finally:
+                    cancelled.set()
+
+            return Response(generate(), mimetype='application/x-ndjson')
+
+        try:
+            for result in pool.imap_unordered(run, jobs):
+                results[result['uid']] = result
+        finally:
+            cancelled.set()
+
+        return {'results': [results[uid] for uid in uids]}, 200
+
 
 class ClassicUser(BaseView):
     """
@@ -81,7 +271,7 @@ class ClassicUser(BaseView):
         absolute_uid = self.helper_get_user_id()
 
         try:
-            user = Users.query.filter(Users.absolute_uid == absolute_uid).one()
+            user = self.helper_get_user(absolute_uid)
             return {
                 'classic_email': user.classic_email,
                 'classic_mirror': user.classic_mirror,
@@ -107,6 +297,11 @@ class AllowedMirrors(BaseView):
         with this end point. Any end points not listed by this method cannot be
         used for any of the other methods related to this service.
 
+        Query parameters
+        ----------------
+        ranked: <boolean> healthy mirrors first, fastest first, and those that
+        are down last
+
         Return data (on success)
         ------------------------
         list[<string>]
@@ -119,8 +314,111 @@ class AllowedMirrors(BaseView):
 
         Any other responses will be default Flask errors
         """
+        mirrors = current_app.config.get('ADS_CLASSIC_MIRROR_LIST', [])
+
+        if request.args.get('ranked', '').lower() in ('1', 'true'):
+            return current_app.extensions['classic'].ranked(mirrors)
+
+        return mirrors
+
+
+class Readiness(BaseView):
+    """
+    End point that tells a load balancer or orchestrator whether this process
+    is ready to serve all of the end points. This is separate from liveness:
+    a process that is still loading the ADS 2.0 users is alive, and serves
+    everything else, but is not ready.
+    """
+
+    decorators = [advertise('scopes', 'rate_limit')]
+    scopes = []
+    rate_limit = [1000, 60*60*24]
+
+    def get(self):
+        """
+        HTTP GET request that returns whether the process is ready
+
+        Return data (on success)
+        ------------------------
+        ready: <boolean> is the process ready
+        twopointoh_users: <boolean> have the ADS 2.0 users been loaded
+
+        HTTP Responses:
+        --------------
+        Ready: 200
+        ADS 2.0 users are still loading: 503
+
+        Any other responses will be default Flask errors
+        """
+        loaded = current_app.config['ADS_TWO_POINT_OH_LOADED_USERS']
+
+        # Lazily loaded users are only loaded when a request needs them
+        lazy = current_app.config['ADS_TWO_POINT_OH_USERS_LOAD'] == 'lazy'
+
+        if not loaded and not lazy:
+            message, status_code = err(TWOPOINTOH_USERS_NOT_READY)
+            message.update(ready=False, twopointoh_users=False)
+            return message, status_code
+
+        return {'ready': True, 'twopointoh_users': loaded}, 200
+
+
+class Metrics(BaseView):
+    """
+    End point that returns the internal counters of the process that serves
+    the request, for monitoring
+    """
+
+    decorators = [advertise('scopes', 'rate_limit')]
+    scopes = ['adsws:internal']
+    rate_limit = [1000, 60*60*24]
+
+    def get(self):
+        """
+        HTTP GET request that returns the counters of this process
 
-        return current_app.config.get('ADS_CLASSIC_MIRROR_LIST', [])
+        Return data (on success)
+        ------------------------
+        pid: <int> process that served the request
+        s3: <dict> number of calls, errors and their timings by S3 operation
+        presigned_url_cache: <dict> hits and misses of the export URL cache
+        export_index: <dict> when the export index was built, and its size
+        classic: <dict> circuit breaker state and requests in flight by
+        ADS Classic mirror
+        twopointoh_library_cache: <dict> hits, misses, evictions, etc., of the
+        ADS 2.0 library cache
+        classic_libraries_cache: <dict> the same, for the ADS Classic
+        libraries
+        users_cache: <dict> the same, for the users rows
+        single_flight: <dict> upstream calls made, those shared with
+        concurrent requests, and the files swept from its directory
+        database: <dict> connections of the database pool checked out, in
+        overflow, etc., the time waited for a free one, the time taken to
+        open and to test them, and invalidations
+
+        HTTP Responses:
+        --------------
+        Succeed getting the counters: 200
+
+        Any other responses will be default Flask errors
+        """
+        return {
+            'pid': os.getpid(),
+            's3': current_app.extensions['s3'].stats(),
+            'presigned_url_cache':
+                current_app.extensions['presigned_url_cache'].stats(),
+            'export_index': current_app.extensions['export_index'].stats(),
+            'classic': current_app.extensions['classic'].stats(),
+            'twopointoh_library_cache':
+                current_app.extensions['library_cache'].stats(),
+            'classic_libraries_cache':
+                current_app.extensions['classic_libraries_cache'].stats(),
+            'users_cache': current_app.extensions['users_cache'].stats(),
+            'single_flight': current_app.extensions['single_flight'].stats(),
+            'database': pool_stats(
+                db.get_engine(current_app, bind='harbour').pool
+            )
+        }, 200
 
 
 class TwoPointOhLibraries(BaseView):
@@ -140,26 +438,108 @@ class TwoPointOhLibraries(BaseView):
     def get_s3_library(library_file_name):
         """
         Get the JSON MongoDB dump of the ADS 2.0 library of a specific user.
-        These files are stored on S3.
+        These files are stored on S3, and cached in the process as their JSON,
+        which takes several times less memory than the decoded library, and
+        is what ADS_TWO_POINT_OH_LIBRARY_CACHE_BYTES bounds.
 
         :param library_file_name: name of library file
         :type library_file_name: str
 
         :return: dict
         """
-        s3_resource = boto3.resource('s3')
-        bucket = s3_resource.Object(
+        cache = current_app.extensions['library_cache']
+        library_data = cache.get(library_file_name)
+        if library_data is not None:
+            return json.loads(library_data)
+
+        # The dumps rarely change, so an expired copy is revalidated rather
+        # than downloaded again
+        kwargs = {}
+        stale = cache.get_stale(library_file_name)
+        if stale is not None and stale.etag:
+            kwargs['IfNoneMatch'] = stale.etag
+
+        bucket = current_app.config['ADS_TWO_POINT_OH_S3_MONGO_BUCKET']
+
+        def fetch():
+            try:
+                response = current_app.extensions['s3'].get_object(
+                    bucket,
+                    library_file_name,
+                    **kwargs
+                )
+            except ClientError as error:
+                if kwargs and not_modified(error):
+                    return None
+                raise
+
+            body = response['Body']
+            library_data = StringIO()
+            for chunk in iter(lambda: body.read(1024), b''):
+                library_data.write(chunk)
+
+            return library_data.getvalue(), response.get('ETag')
+
+        # Concurrent requests for the same file share one download
+        fetched = current_app.extensions['single_flight'].do(
+            ('s3', bucket, library_file_name, kwargs.get('IfNoneMatch')),
+            fetch
+        )
+        if fetched is None:
+            cache.revalidated(library_file_name)
+            return json.loads(stale.value)
+
+        library_data, etag = fetched
+        library = json.loads(library_data)
+        cache.set(
+            library_file_name,
+            library_data,
+            size=len(library_data),
+            etag=etag
+        )
+
+        return library
+
+    @staticmethod
+    def stream_s3_library(library_file_name):
+        """
+        Stream the JSON MongoDB dump of the ADS 2.0 library of a specific user
+        from S3 to the client, wrapped in {"libraries": ...}, without decoding
+        it. Only one chunk is held in memory, however large the library is.
+        These are not cached.
+
+        :param library_file_name: name of library file
+        :type library_file_name: str
+
+        :return: flask.Response
+        """
+        response = current_app.extensions['s3'].get_object(
             current_app.config['ADS_TWO_POINT_OH_S3_MONGO_BUCKET'],
             library_file_name
         )
-        body = bucket.get()['Body']
-        library_data = StringIO()
-        for chunk in iter(lambda: body.read(1024), b''):
-            library_data.write(chunk)
-
-        library = json.loads(library_data.getvalue())
 
-        return library
+        body = response['Body']
+        chunk_size = current_app.config['ADS_TWO_POINT_OH_LIBRARY_CHUNK_SIZE']
+        prefix, suffix = b'{"libraries": ', b'}'
+
+        def generate():
+            yield prefix
+            for chunk in iter(lambda: body.read(chunk_size), b''):
+                yield chunk
+            yield suffix
+
+        headers = {}
+        if response.get('ContentLength') is not None:
+            headers['Content-Length'] = \
+                len(prefix) + response['ContentLength'] + len(suffix)
+
+        return Response(
+            generate(),
+            status=200,
+            headers=headers,
+            mimetype='application/json',
+            direct_passthrough=True
+        )
 
     def get(self, uid):
         """
@@ -185,14 +565,15 @@ class TwoPointOhLibraries(BaseView):
 
         Any other responses will be default Flask errors
         """
-        if not current_app.config['ADS_TWO_POINT_OH_LOADED_USERS']:
+        twopointoh_users = self.helper_get_twopointoh_users()
+        if twopointoh_users is None:
             current_app.logger.error(
                 'Users from MongoDB have not been loaded into the app'
             )
             return err(TWOPOINTOH_AWS_PROBLEM)
 
         try:
-            user = Users.query.filter(Users.absolute_uid == uid).one()
+            user = self.helper_get_user(uid)
 
             # Have they got an email for ADS 2.0?
             if not user.twopointoh_email:
@@ -204,7 +585,7 @@ class TwoPointOhLibraries(BaseView):
             )
             return err(NO_TWOPOINTOH_ACCOUNT)
 
-        library_file_name = current_app.config['ADS_TWO_POINT_OH_USERS'].get(
+        library_file_name = twopointoh_users.get(
             user.twopointoh_email,
             None
         )
@@ -216,6 +597,11 @@ class TwoPointOhLibraries(BaseView):
             return err(NO_TWOPOINTOH_LIBRARIES)
 
         try:
+            if current_app.config['ADS_TWO_POINT_OH_LIBRARY_PASSTHROUGH']:
+                return TwoPointOhLibraries.stream_s3_library(
+                    library_file_name
+                )
+
             library = TwoPointOhLibraries.get_s3_library(library_file_name)
         except Exception as error:
             current_app.logger.error(
@@ -226,6 +612,113 @@ class TwoPointOhLibraries(BaseView):
         return {'libraries': library}, 200
 
 
+class BulkTwoPointOhLibraries(BaseView):
+    """
+    End point to collect the ADS 2.0 libraries of many users at once, eg., to
+    migrate a whole cohort of users, rather than one request per user
+    """
+    decorators = [advertise('scopes', 'rate_limit')]
+    scopes = ['adsws:internal']
+    rate_limit = [100, 60*60*24]
+
+    @staticmethod
+    def get_libraries(uid, library_file_name):
+        """
+        Get the libraries of a user, for the bulk response. These are always
+        decoded (and cached), as they are embedded in the bulk response.
+
+        :param uid: user ID for the API
+        :param library_file_name: name of the library file of the user
+
+        :return: result dictionary of the user
+        """
+        try:
+            library = TwoPointOhLibraries.get_s3_library(library_file_name)
+        except Exception as error:
+            current_app.logger.error(
+                'Unknown error with AWS: {}'.format(error)
+            )
+            return BaseView.helper_bulk_error(uid, TWOPOINTOH_AWS_PROBLEM)
+
+        return {'uid': uid, 'libraries': library}
+
+    def post(self):
+        """
+        HTTP POST request that gets the ADS 2.0 libraries of a list of users.
+        The users are looked up in one query, and their library files fetched
+        from S3 concurrently (ADS_TWO_POINT_OH_BULK_WORKERS).
+
+        Post body:
+        ----------
+        KEYWORD, VALUE
+        uids: <list<int>> user IDs for the API, at most
+        ADS_TWO_POINT_OH_BULK_MAX_UIDS
+
+        Query parameters
+        ----------------
+        format: 'ndjson' to stream one result per line, as each library file
+        is fetched, rather than all of them in one document
+
+        Return data (on success)
+        ------------------------
+        results: <list<dict>> in the order of the uids, each with:
+            uid: <int> user ID for the API
+            libraries: <list<dict>> as for /libraries/twopointoh/<uid>, or
+            error: <string> why the libraries could not be obtained, and
+            code: <int> HTTP status of the error for a single user
+
+        HTTP Responses:
+        --------------
+        Succeed getting the results: 200
+        Malformed request: 400
+        Unknown error: 500
+
+        Any other responses will be default Flask errors
+        """
+        uids, error = self.helper_get_bulk_uids(
+            current_app.config['ADS_TWO_POINT_OH_BULK_MAX_UIDS']
+        )
+        if error is not None:
+            return err(error)
+
+        twopointoh_users = self.helper_get_twopointoh_users()
+        if twopointoh_users is None:
+            current_app.logger.error(
+                'Users from MongoDB have not been loaded into the app'
+            )
+            return err(TWOPOINTOH_AWS_PROBLEM)
+
+        users = self.helper_get_users(uids)
+
+        results = {}
+        jobs = []
+        for uid in uids:
+            user = users.get(uid)
+            if user is None or not user.twopointoh_email:
+                results[uid] = self.helper_bulk_error(
+                    uid, NO_TWOPOINTOH_ACCOUNT
+                )
+                continue
+
+            library_file_name = twopointoh_users.get(user.twopointoh_email)
+            if not library_file_name:
+                results[uid] = self.helper_bulk_error(
+                    uid, NO_TWOPOINTOH_LIBRARIES
+                )
+                continue
+
+            jobs.append((uid, library_file_name))
+
+        return self.helper_bulk_response(
+            uids,
+            results,
+            jobs,
+            BulkTwoPointOhLibraries.get_libraries,
+            'twopointoh-bulk',
+            current_app.config['ADS_TWO_POINT_OH_BULK_WORKERS']
+        )
+
+
 class ExportTwoPointOhLibraries(BaseView):
     """
     End point to return ADS 2.0 libraries in a format that users can use to
@@ -257,6 +750,7 @@ class ExportTwoPointOhLibraries(BaseView):
         Succeed getting libraries: 200
         User does not have a classic/ADS 2.0 account: 400
         User does not have any libraries in their ADS 2.0 account: 400
+        There is no export of this type for the user: 404
         Unknown error: 500
 
         Any other responses will be default Flask errors
@@ -264,7 +758,8 @@ class ExportTwoPointOhLibraries(BaseView):
         if export not in current_app.config['HARBOUR_EXPORT_TYPES']:
             return err(TWOPOINTOH_WRONG_EXPORT_TYPE)
 
-        if not current_app.config['ADS_TWO_POINT_OH_LOADED_USERS']:
+        twopointoh_users = self.helper_get_twopointoh_users()
+        if twopointoh_users is None:
             current_app.logger.error(
                 'Users from MongoDB have not been loaded into the app'
             )
@@ -273,7 +768,7 @@ class ExportTwoPointOhLibraries(BaseView):
         absolute_uid = self.helper_get_user_id()
 
         try:
-            user = Users.query.filter(Users.absolute_uid == absolute_uid).one()
+            user = self.helper_get_user(absolute_uid)
 
             # Have they got an email for ADS 2.0?
             if not user.twopointoh_email:
@@ -285,7 +780,7 @@ class ExportTwoPointOhLibraries(BaseView):
             )
             return err(NO_TWOPOINTOH_ACCOUNT)
 
-        library_file_name = current_app.config['ADS_TWO_POINT_OH_USERS'].get(
+        library_file_name = twopointoh_users.get(
             user.twopointoh_email,
             None
         )
@@ -296,15 +791,20 @@ class ExportTwoPointOhLibraries(BaseView):
             )
             return err(NO_TWOPOINTOH_LIBRARIES)
 
+        # Until the first listing of the bucket, URLs are handed out unchecked
+        export_index = current_app.extensions['export_index']
+        if export_index.available(library_file_name, export) is False:
+            current_app.logger.warning(
+                'User does not have a {} export in ADS 2.0'.format(export)
+            )
+            return err(TWOPOINTOH_EXPORT_NOT_AVAILABLE)
+
+        url_cache = current_app.extensions['presigned_url_cache']
         try:
-            s3 = boto3.client('s3')
-            s3_presigned_url = s3.generate_presigned_url(
-                ClientMethod='get_object',
-                Params={
-                    'Bucket': current_app.config['ADS_TWO_POINT_OH_S3_MONGO_BUCKET'],
-                    'Key': library_file_name.replace('.json', '.{}.zip'.format(export))
-                },
-                ExpiresIn=1800
+            s3_presigned_url, expires_in = url_cache.get(
+                current_app.config['ADS_TWO_POINT_OH_S3_MONGO_BUCKET'],
+                library_file_name.replace('.json', '.{}.zip'.format(export)),
+                current_app.extensions['s3'].generate_presigned_url
             )
         except Exception as error:
             current_app.logger.error(
@@ -312,7 +812,44 @@ class ExportTwoPointOhLibraries(BaseView):
             )
             return err(TWOPOINTOH_AWS_PROBLEM)
 
-        return {'url': s3_presigned_url}, 200
+        # The same URL is handed out until it is close to expiring, so the
+        # user can keep it until then too
+        max_age = max(expires_in - url_cache.min_validity, 0)
+
+        return {'url': s3_presigned_url}, 200, \
+            {'Cache-Control': 'private, max-age={}'.format(max_age)}
+
+
+class ClassicLibrariesStream(object):
+    """
+    Libraries of a user that are too large to hold in memory: those already
+    read from the ADS Classic response, then the rest of the response, read
+    one library at a time. The response is closed once they have all been
+    read, or by close.
+    """
+    def __init__(self, libraries, rest, response):
+        """
+        Constructor
+        :param libraries: libraries already read
+        :param rest: generator of the libraries not read yet
+        :param response: requests.Response from ADS Classic
+        """
+        self.libraries = libraries
+        self.rest = rest
+        self.response = response
+
+    def __iter__(self):
+        try:
+            libraries, self.libraries = self.libraries, []
+            for library in libraries:
+                yield library
+            for library in self.rest:
+                yield library
+        finally:
+            self.close()
+
+    def close(self):
+        self.response.close()
 
 
 class ClassicLibraries(BaseView):
@@ -325,10 +862,304 @@ class ClassicLibraries(BaseView):
     scopes = ['adsws:internal']
     rate_limit = [1000, 60*60*24]
 
+    @staticmethod
+    def open_classic_libraries(mirror, cookie):
+        """
+        Request the libraries of a user from ADS Classic, without reading them
+        yet
+
+        :param mirror: ADS Classic mirror of the user
+        :param cookie: ADS Classic cookie of the user
+
+        :return: requests.Response, or None if ADS Classic did not return the
+        libraries
+        """
+        url = current_app.config['ADS_CLASSIC_LIBRARIES_URL'].format(
+            mirror=mirror,
+            cookie=cookie
+        )
+
+        current_app.logger.debug('Obtaining libraries via: {}'.format(url))
+        try:
+            response = current_app.extensions['classic'].get(
+                url,
+                operation='libraries',
+                stream=True
+            )
+        except requests.exceptions.RequestException as exception:
+            current_app.logger.warning(
+                'ADS Classic failed before finishing: {}: {}'
+                .format(url, exception)
+            )
+            raise
+
+        if response.status_code != 200:
+            current_app.logger.warning(
+                'ADS Classic returned an unkown status code: "{}" [code: {}]'
+                .format(response.text, response.status_code)
+            )
+            response.close()
+            return None
+
+        return response
+
+    @staticmethod
+    def iter_classic_libraries(reader):
+        """
+        Read the libraries of a user from an ADS Classic response, in the
+        format of this service, one library at a time
+
+        :param reader: ChunkReader of the response
+
+        :return: generator of libraries
+        """
+        for library in iter_json_array(reader, 'libraries'):
+            yield dict(
+                name=library['name'],
+                description=library.get('desc', ''),
+                documents=[entry['bibcode'] for entry in library['entries']]
+            )
+
+    @staticmethod
+    def read_classic_libraries(response):
+        """
+        Read the libraries of a user from an ADS Classic response, unless
+        they turn out to be too large to be held in memory: once more than
+        ADS_CLASSIC_LIBRARIES_STREAM_BYTES have been read, or straight away
+        if the response says it is larger than that, the rest is left to be
+        streamed through to the client rather than cached
+
+        :param response: requests.Response from ADS Classic, closed unless it
+        is returned in a ClassicLibrariesStream
+
+        :return: libraries, or ClassicLibrariesStream if they are too large,
+        and the size of the response read
+        """
+        chunk_size = current_app.config['ADS_CLASSIC_LIBRARIES_CHUNK_SIZE']
+        limit = current_app.config['ADS_CLASSIC_LIBRARIES_STREAM_BYTES']
+
+        reader = ChunkReader(response.iter_content(chunk_size))
+        rest = ClassicLibraries.iter_classic_libraries(reader)
+
+        length = response.headers.get('Content-Length')
+        if length is not None and int(length) > limit:
+            return ClassicLibrariesStream([], rest, response), 0
+
+        libraries = []
+        try:
+            for library in rest:
+                libraries.append(library)
+                if reader.bytes_read > limit:
+                    stream = ClassicLibrariesStream(libraries, rest, response)
+                    return stream, reader.bytes_read
+        except Exception:
+            response.close()
+            raise
+
+        response.close()
+        return libraries, reader.bytes_read
+
+    @staticmethod
+    def fetch_classic_libraries(source):
+        """
+        Get the libraries of a user from ADS Classic. Requests made for the
+        same mirror and cookie at the same time share one request to ADS
+        Classic, unless the libraries are too large to hold in memory, in
+        which case they are returned as a stream.
+
+        :param source: ADS Classic mirror and cookie of the user
+
+        :return: libraries, or None if ADS Classic did not return them, the
+        size of the ADS Classic response, and the ClassicLibrariesStream if
+        they are to be streamed
+        """
+        large = {}
+
+        def fetch():
+            response = ClassicLibraries.open_classic_libraries(*source)
+            if response is None:
+                return None, 0
+
+            libraries, size = ClassicLibraries.read_classic_libraries(response)
+            if isinstance(libraries, ClassicLibrariesStream):
+                large['stream'] = libraries
+                return None, -1
+
+            return libraries, size
+
+        libraries, size = current_app.extensions['single_flight'].do(
+            ('classic',) + tuple(source),
+            fetch
+        )
+
+        if size < 0:
+            # Only the caller that made the request can stream its response,
+            # the others make their own
+            stream = large.get('stream')
+            if stream is None:
+                response = ClassicLibraries.open_classic_libraries(*source)
+                if response is None:
+                    return None, 0, None
+                stream = ClassicLibrariesStream(
+                    [],
+                    ClassicLibraries.iter_classic_libraries(ChunkReader(
+                        response.iter_content(current_app.config[
+                            'ADS_CLASSIC_LIBRARIES_CHUNK_SIZE'
+                        ])
+                    )),
+                    response
+                )
+            return None, 0, stream
+
+        return libraries, size, None
+
+    @staticmethod
+    def stream_classic_libraries(uid, stream):
+        """
+        Stream the libraries of a user from ADS Classic to the client,
+        transforming them one library at a time, so that only one library is
+        held in memory however many there are.
+
+        The status is sent before the libraries are read. If ADS Classic fails
+        part way through, the error is logged and the document is cut short,
+        so that it is not valid JSON: a client cannot mistake the libraries
+        sent until then for all of them.
+
+        :param uid: user ID for the API
+        :param stream: ClassicLibrariesStream
+
+        :return: flask.Response
+        """
+        chunk_size = current_app.config['ADS_CLASSIC_LIBRARIES_CHUNK_SIZE']
+        logger = current_app.logger
+
+        def generate():
+            buf = [b'{"libraries": [']
+            buffered, sent = 0, 0
+            try:
+                for library in stream:
+                    chunk = json.dumps(library)
+                    buf.append(b', ' + chunk if sent else chunk)
+                    buffered += len(chunk)
+                    sent += 1
+                    if buffered >= chunk_size:
+                        yield b''.join(buf)
+                        buf, buffered = [], 0
+            except Exception as error:
+                logger.error(
+                    'ADS Classic failed while the libraries of {} were '
+                    'streamed, the response was cut short after {} '
+                    'libraries: {}'.format(uid, sent, error)
+                )
+                if buf:
+                    yield b''.join(buf)
+                return
+            finally:
+                stream.close()
+
+            buf.append(b']}')
+            yield b''.join(buf)
+
+        response = Response(
+            generate(),
+            status=200,
+            mimetype='application/json',
+            direct_passthrough=True
+        )
+        # A client that goes away before the first chunk never starts the
+        # generator, which then never closes the stream itself
+        response.call_on_close(stream.close)
+        return response
+
+    @staticmethod
+    def refresh_in_background(uid, source):
+        """
+        Fetch the libraries of a user again on the pool of threads of the
+        process, and cache them, unless they are already being fetched. If
+        ADS_CLASSIC_LIBRARIES_REFRESH_WORKERS are already busy, the refresh is
+        dropped rather than queued: the stale libraries are returned until a
+        later request refreshes them.
+
+        :param uid: user ID for the API
+        :param source: ADS Classic mirror and cookie of the user
+        """
+        cache = current_app.extensions['classic_libraries_cache']
+        workers = current_app.config['ADS_CLASSIC_LIBRARIES_REFRESH_WORKERS']
+        if not cache.start_refresh(uid, limit=workers):
+            return
+
+        app = current_app._get_current_object()
+
+        def refresh():
+            try:
+                with app.app_context():
+                    libraries, size, stream = \
+                        ClassicLibraries.fetch_classic_libraries(source)
+                    if stream is not None:
+                        stream.close()
+                    elif libraries is not None:
+                        cache.set(uid, (source, libraries), size=size)
+            except Exception as error:
+                app.logger.warning(
+                    'Could not refresh the libraries of {}: {}'
+                    .format(uid, error)
+                )
+            finally:
+                cache.end_refresh(uid)
+
+        current_app.extensions['worker_pools'].get(
+            'classic-refresh', workers
+        ).apply_async(refresh)
+
+    @staticmethod
+    def lookup(uid, source):
+        """
+        Get the libraries of a user, from the cache if possible. Libraries
+        are cached for a while, and once expired are still returned while
+        they are fetched again in the background.
+
+        :param uid: user ID for the API
+        :param source: ADS Classic mirror and cookie of the user
+
+        :return: libraries, or an error dictionary, or a
+        ClassicLibrariesStream if they are too large to be held in memory
+        """
+        # Cached libraries are only used while the user still has the same
+        # mirror and cookie, which other workers may have changed
+        cache = current_app.extensions['classic_libraries_cache']
+
+        cached = cache.get(uid)
+        if cached is not None and cached[0] == source:
+            return cached[1], None, None
+
+        stale = cache.get_stale(uid)
+        if stale is not None and stale.value[0] == source and \
+                time.time() < stale.expires + \
+                current_app.config['ADS_CLASSIC_LIBRARIES_CACHE_STALE']:
+            ClassicLibraries.refresh_in_background(uid, source)
+            return stale.value[1], None, None
+
+        try:
+            libraries, size, stream = \
+                ClassicLibraries.fetch_classic_libraries(source)
+        except requests.exceptions.RequestException as exception:
+            return None, BaseView.helper_classic_error(exception), None
+
+        if stream is not None:
+            return None, None, stream
+
+        if libraries is None:
+            return None, CLASSIC_UNKNOWN_ERROR, None
+
+        cache.set(uid, (source, libraries), size=size)
+        return libraries, None, None
+
     def get(self, uid):
         """
         HTTP GET request that contacts the ADS Classic libraries end point to
-        obtain all the libraries relevant to that user.
+        obtain all the libraries relevant to that user. Libraries are cached
+        (see lookup), and those too large to be held in memory are streamed
+        through instead.
 
         :param uid: user ID for the API
         :type uid: int
@@ -348,11 +1179,15 @@ class ClassicLibraries(BaseView):
         ADS Classic give unknown messages: 500
         ADS Classic times out: 504
 
+        Libraries that are streamed are sent with a 200 before they are read:
+        if ADS Classic fails part way through, the document is cut short, and
+        is not valid JSON.
+
         Any other responses will be default Flask errors
         """
 
         try:
-            user = Users.query.filter(Users.absolute_uid == uid).one()
+            user = self.helper_get_user(uid)
             if not user.classic_email:
                 raise NoResultFound
         except NoResultFound:
@@ -361,36 +1196,133 @@ class ClassicLibraries(BaseView):
             )
             return err(NO_CLASSIC_ACCOUNT)
 
-        url = current_app.config['ADS_CLASSIC_LIBRARIES_URL'].format(
-            mirror=user.classic_mirror,
-            cookie=user.classic_cookie
+        libraries, error, stream = ClassicLibraries.lookup(
+            uid,
+            (user.classic_mirror, user.classic_cookie)
         )
 
-        current_app.logger.debug('Obtaining libraries via: {}'.format(url))
-        try:
-            response = requests.get(url)
-        except requests.exceptions.Timeout:
+        if stream is not None:
+            return ClassicLibraries.stream_classic_libraries(uid, stream)
+
+        if error is not None:
+            return err(error)
+
+        return {'libraries': libraries}, 200
+
+
+class BulkClassicLibraries(BaseView):
+    """
+    End point to collect the ADS Classic libraries of many users at once, eg.,
+    for a migration, rather than one request per user
+    """
+
+    decorators = [advertise('scopes', 'rate_limit')]
+    scopes = ['adsws:internal']
+    rate_limit = [100, 60*60*24]
+
+    @staticmethod
+    def get_libraries(uid, source):
+        """
+        Get the libraries of a user, for the bulk response, once the mirror of
+        the user has fewer than ADS_CLASSIC_BULK_MIRROR_CONCURRENCY requests
+        of the bulk end point in flight
+
+        :param uid: user ID for the API
+        :param source: ADS Classic mirror and cookie of the user
+
+        :return: result dictionary of the user
+        """
+        bulkhead = current_app.extensions['classic'].get_mirror(
+            source[0]
+        ).bulk_bulkhead
+        if not bulkhead.acquire(
+                current_app.config['ADS_CLASSIC_BULK_QUEUE_TIMEOUT']):
             current_app.logger.warning(
-                'ADS Classic timed out before finishing: {}'.format(url)
+                'Mirror {} too busy for the libraries of {}'
+                .format(source[0], uid)
             )
-            return err(CLASSIC_TIMEOUT)
+            return BaseView.helper_bulk_error(uid, CLASSIC_TIMEOUT)
 
-        if response.status_code != 200:
-            current_app.logger.warning(
-                'ADS Classic returned an unkown status code: "{}" [code: {}]'
-                .format(response.text, response.status_code)
+        try:
+            libraries, error, stream = ClassicLibraries.lookup(uid, source)
+
+            if stream is not None:
+                # All of the results are returned together, so there is
+                # nothing to stream this one into
+                libraries = list(stream)
+        except Exception as exception:
+            current_app.logger.error(
+                'Could not get the libraries of {}: {}'.format(uid, exception)
             )
-            return err(CLASSIC_UNKNOWN_ERROR)
+            error = CLASSIC_UNKNOWN_ERROR
+        finally:
+            bulkhead.release()
 
-        data = response.json()
+        if error is not None:
+            return BaseView.helper_bulk_error(uid, error)
 
-        libraries = [dict(
-            name=i['name'],
-            description=i.get('desc', ''),
-            documents=[j['bibcode'] for j in i['entries']]
-        ) for i in data['libraries']]
+        return {'uid': uid, 'libraries': libraries}
 
-        return {'libraries': libraries}, 200
+    def post(self):
+        """
+        HTTP POST request that gets the ADS Classic libraries of a list of
+        users. The users are looked up in one query, and their libraries
+        fetched concurrently (ADS_CLASSIC_BULK_WORKERS), with at most
+        ADS_CLASSIC_BULK_MIRROR_CONCURRENCY requests in flight to any one
+        mirror across the bulk requests of the process.
+
+        Post body:
+        ----------
+        KEYWORD, VALUE
+        uids: <list<int>> user IDs for the API, at most
+        ADS_CLASSIC_BULK_MAX_UIDS
+
+        Query parameters
+        ----------------
+        format: 'ndjson' to stream one result per line, in the order they
+        complete, rather than all of them in one document
+
+        Return data (on success)
+        ------------------------
+        results: <list<dict>> in the order of the uids, each with:
+            uid: <int> user ID for the API
+            libraries: <list<dict>> as for /libraries/classic/<uid>, or
+            error: <string> why the libraries could not be obtained, and
+            code: <int> HTTP status of the error for a single user
+
+        HTTP Responses:
+        --------------
+        Succeed getting the results: 200
+        Malformed request: 400
+
+        Any other responses will be default Flask errors
+        """
+        uids, error = self.helper_get_bulk_uids(
+            current_app.config['ADS_CLASSIC_BULK_MAX_UIDS']
+        )
+        if error is not None:
+            return err(error)
+
+        users = self.helper_get_users(uids)
+
+        results = {}
+        jobs = []
+        for uid in uids:
+            user = users.get(uid)
+            if user is None or not user.classic_email:
+                results[uid] = self.helper_bulk_error(uid, NO_CLASSIC_ACCOUNT)
+                continue
+
+            jobs.append((uid, (user.classic_mirror, user.classic_cookie)))
+
+        return self.helper_bulk_response(
+            uids,
+            results,
+            jobs,
+            BulkClassicLibraries.get_libraries,
+            'classic-bulk',
+            current_app.config['ADS_CLASSIC_BULK_WORKERS']
+        )
 
 
 class AuthenticateUserClassic(BaseView):
@@ -471,15 +1403,17 @@ class AuthenticateUserClassic(BaseView):
             .format(email=classic_email, mirror=classic_mirror)
         )
         try:
-            response = requests.post(
+            response = current_app.extensions['classic'].post(
                 url,
-                params=params
+                params=params,
+                operation='elogin'
             )
-        except requests.exceptions.Timeout:
+        except requests.exceptions.RequestException as exception:
             current_app.logger.warning(
-                'ADS Classic end point timed out, returning to user'
+                'ADS Classic end point failed, returning to user: {}'
+                .format(exception)
             )
-            return err(CLASSIC_TIMEOUT)
+            return err(self.helper_classic_error(exception))
 
         if response.status_code >= 500:
             message, status_code = err(CLASSIC_UNKNOWN_ERROR)
@@ -494,7 +1428,8 @@ class AuthenticateUserClassic(BaseView):
             return message, status_code
 
         # Sanity check the response
-        email = response.json()['email']
+        data = response.json()
+        email = data['email']
         if email != classic_email:
             current_app.logger.warning(
                 'User email "{}" does not match ADS return email "{}"'
@@ -504,8 +1439,8 @@ class AuthenticateUserClassic(BaseView):
 
         # Respond to the user based on whether they were successful or not
         if response.status_code == 200 \
-                and response.json()['message'] == 'LOGGED_IN' \
-                and int(response.json()['loggedin']):
+                and data['message'] == 'LOGGED_IN' \
+                and int(data['loggedin']):
             current_app.logger.info(
                 'Authenticated successfully "{email}" at mirror "{mirror}"'
                 .format(email=classic_email, mirror=classic_mirror)
@@ -513,35 +1448,28 @@ class AuthenticateUserClassic(BaseView):
 
             # Save cookie in myADS
             try:
-                cookie = response.json()['cookie']
+                cookie = data['cookie']
             except KeyError:
                 current_app.logger.warning(
                     'Classic returned no cookie, cannot continue: {}'
-                    .format(response.json())
+                    .format(data)
                 )
                 return err(CLASSIC_NO_COOKIE)
 
             absolute_uid = self.helper_get_user_id()
-            try:
-                user = Users.query.filter(
-                    Users.absolute_uid == absolute_uid
-                ).one()
-
-                current_app.logger.info('User already exists in database')
-                user.classic_mirror = classic_mirror
-                user.classic_cookie = cookie
-                user.classic_email = classic_email
-            except NoResultFound:
-                current_app.logger.info('Creating entry in database for user')
-                user = Users(
-                    absolute_uid=absolute_uid,
-                    classic_cookie=cookie,
-                    classic_email=classic_email,
-                    classic_mirror=classic_mirror
-                )
-
-            db.session.add(user)
+            user = Users.upsert(
+                absolute_uid,
+                classic_cookie=cookie,
+                classic_email=classic_email,
+                classic_mirror=classic_mirror
+            )
             db.session.commit()
+            self.helper_cache_user(user)
+
+            # Libraries cached for the old cookie or mirror are out of date
+            current_app.extensions['classic_libraries_cache'].delete(
+                absolute_uid
+            )
 
             current_app.logger.info(
                 'Successfully saved content for "{}" to database: {{"cookie": "{}"}}'
@@ -628,15 +1556,17 @@ class AuthenticateUserTwoPointOh(BaseView):
             .format(email=twopointoh_email)
         )
         try:
-            response = requests.post(
+            response = current_app.extensions['classic'].post(
                 url,
-                params=params
+                params=params,
+                operation='elogin'
             )
-        except requests.exceptions.Timeout:
+        except requests.exceptions.RequestException as exception:
             current_app.logger.warning(
-                'ADS Classic end point timed out, returning to user'
+                'ADS Classic end point failed, returning to user: {}'
+                .format(exception)
             )
-            return err(CLASSIC_TIMEOUT)
+            return err(self.helper_classic_error(exception))
 
         if response.status_code >= 500:
             message, status_code = err(CLASSIC_UNKNOWN_ERROR)
@@ -651,7 +1581,8 @@ class AuthenticateUserTwoPointOh(BaseView):
             return message, status_code
 
         # Sanity check the response
-        email = response.json()['email']
+        data = response.json()
+        email = data['email']
         if email != twopointoh_email:
             current_app.logger.warning(
                 'User email "{}" does not match ADS return email "{}"'
@@ -661,30 +1592,20 @@ class AuthenticateUserTwoPointOh(BaseView):
 
         # Respond to the user based on whether they were successful or not
         if response.status_code == 200 \
-                and response.json()['message'] == 'LOGGED_IN' \
-                and int(response.json()['loggedin']):
+                and data['message'] == 'LOGGED_IN' \
+                and int(data['loggedin']):
             current_app.logger.info(
                 'Authenticated successfully "{email}"'
                 .format(email=twopointoh_email)
             )
 
             absolute_uid = self.helper_get_user_id()
-            try:
-                user = Users.query.filter(
-                    Users.absolute_uid == absolute_uid
-                ).one()
-
-                current_app.logger.info('User already exists in database')
-                user.twopointoh_email = twopointoh_email
-            except NoResultFound:
-                current_app.logger.info('Creating entry in database for user')
-                user = Users(
-                    absolute_uid=absolute_uid,
-                    twopointoh_email=twopointoh_email
-                )
-
-            db.session.add(user)
+            user = Users.upsert(
+                absolute_uid,
+                twopointoh_email=twopointoh_email
+            )
             db.session.commit()
+            self.helper_cache_user(user)
 
             current_app.logger.info(
                 'Successfully saved content for "{}" to database'
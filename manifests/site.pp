@@ -1,12 +1,20 @@
 # Some const. variables
 $path_var = '/usr/bin:/usr/sbin:/bin:/usr/local/sbin:/usr/sbin:/sbin'
-$build_packages = ['python', 'python-dev', 'python-pip', 'git', 'libpq-dev', 'ipython', 'postgresql-client-9.3', 'postgresql-9.3']
+$build_packages = ['python', 'python-dev', 'python-pip', 'git', 'libpq-dev', 'ipython', 'postgresql-client-9.6', 'postgresql-9.6']
 $pip_requirements = '/vagrant/requirements.txt'
 
+# PostgreSQL 9.5+ is needed (INSERT ... ON CONFLICT), trusty only has 9.3
+exec {'apt_pgdg':
+  command => "echo 'deb http://apt.postgresql.org/pub/repos/apt/ trusty-pgdg main' > /etc/apt/sources.list.d/pgdg.list && wget -q -O - https://www.postgresql.org/media/keys/ACCC4CF8.asc | apt-key add -",
+  creates => '/etc/apt/sources.list.d/pgdg.list',
+  path => $path_var,
+}
+
 # Update package list
 exec {'apt_update_1':
   command => 'apt-get update && touch /etc/.apt-updated-by-puppet1',
   creates => '/etc/.apt-updated-by-puppet1',
+  require => Exec['apt_pgdg'],
   path => $path_var,
 }
 
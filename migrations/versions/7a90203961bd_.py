@@ -0,0 +1,39 @@
+"""Index the e-mails of the users regardless of case
+
+Revision ID: 7a90203961bd
+Revises: c73c098fb8c5
+Create Date: 2026-10-18 18:10:00.000000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '7a90203961bd'
+down_revision = 'c73c098fb8c5'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    # CREATE INDEX locks the users table against writes until it is built,
+    # CONCURRENTLY does not, but cannot run inside a transaction. Alembic 0.8
+    # runs the migrations in one, so end it first.
+    op.execute('COMMIT')
+    op.create_index(
+        'ix_users_lower_classic_email',
+        'users',
+        [sa.text('lower(classic_email)')],
+        postgresql_concurrently=True
+    )
+    op.create_index(
+        'ix_users_lower_twopointoh_email',
+        'users',
+        [sa.text('lower(twopointoh_email)')],
+        postgresql_concurrently=True
+    )
+
+
+def downgrade():
+    op.execute('COMMIT')
+    op.execute('DROP INDEX CONCURRENTLY ix_users_lower_twopointoh_email')
+    op.execute('DROP INDEX CONCURRENTLY ix_users_lower_classic_email')
@@ -6,12 +6,22 @@
     entrypoint wsgi script
 """
 
+from harbour import serving
+
+# Before anything else is imported, see harbour/serving.py
+mode = serving.serving_mode()
+serving.patch(mode)
+
 from werkzeug.serving import run_simple
 from harbour import app
 
 application = app.create_app()
 
 if __name__ == "__main__":
-    run_simple(
-        '0.0.0.0', 4000, application, use_reloader=False, use_debugger=True
-    )
+    if mode == serving.GEVENT:
+        serving.serve(application, '0.0.0.0', 4000)
+    else:
+        run_simple(
+            '0.0.0.0', 4000, application, use_reloader=False,
+            use_debugger=True
+        )